@@ -0,0 +1,371 @@
+'''
+Sitebucket benchmarks. Run all of them with:
+
+    > python benchmarks.py
+
+or just some of them by name:
+
+    > python benchmarks.py sinks
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+MESSAGE = ('{"for_user":%s,"message":{"created_at":"Wed Aug 27 13:08:45 '
+           '+0000 2008","id":%s,"text":"%s","user":{"id":%s,"screen_name":'
+           '"someone","followers_count":100},"entities":{"hashtags":[],'
+           '"urls":[],"user_mentions":[]}}}\r\n')
+
+def messages(count):
+    '''Returns a list of count distinct site stream messages.'''
+    return [MESSAGE % (x % 1000, x, 'tweet number %s' % x, x % 5000)
+            for x in xrange(count)]
+
+def report(name, count, elapsed):
+    print "%-40s %10.0f messages/sec" % (name, count / elapsed)
+
+def bench_sinks(count=200000):
+    '''Sustained messages/sec for the SQLite and NDJSON sinks.'''
+    from sitebucket.sinks import SQLiteSink, NDJSONFileSink
+
+    data = messages(count)
+    directory = tempfile.mkdtemp()
+    try:
+        sinks = [
+            ('SQLiteSink', SQLiteSink(os.path.join(directory, 'db'))),
+            ('NDJSONFileSink (gzip)', NDJSONFileSink(directory)),
+            ('NDJSONFileSink (plain)',
+             NDJSONFileSink(directory, prefix='plain', compress=False)),
+        ]
+        for name, sink in sinks:
+            start = time.time()
+            for token in data:
+                sink.parse(token)
+            sink.close()
+            report(name, count, time.time() - start)
+            print "    write latency p50/p99: %s/%s sec, mean batch: %.0f" % (
+                sink.write_latency.percentile(50),
+                sink.write_latency.percentile(99),
+                sink.batch_sizes.mean)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_ring(count=200000, consumers=2):
+    '''Messages/sec from one producer to consumer processes through a
+    RingBuffer and through a multiprocessing.Queue.'''
+    import multiprocessing
+    from sitebucket.parser import BaseParser
+    from sitebucket.ring import RingBuffer, RingParser, RingConsumer
+
+    class NullParser(BaseParser):
+        def parse(self, token):
+            pass
+
+    def drain_queue(queue):
+        while queue.get() is not None:
+            pass
+
+    data = messages(count)
+
+    ring = RingBuffer()
+    processes = [multiprocessing.Process(
+                     target=RingConsumer(ring, NullParser()).run)
+                 for x in xrange(consumers)]
+    [x.start() for x in processes]
+    parser = RingParser(ring)
+    start = time.time()
+    for token in data:
+        parser.parse(token)
+    parser.close()
+    [x.join() for x in processes]
+    report('RingBuffer', count, time.time() - start)
+    print "    producer waits for a full ring: %s" % ring.stats['full_waits']
+
+    queue = multiprocessing.Queue(10000)
+    processes = [multiprocessing.Process(target=drain_queue, args=(queue,))
+                 for x in xrange(consumers)]
+    [x.start() for x in processes]
+    start = time.time()
+    for token in data:
+        queue.put(token)
+    for x in processes:
+        queue.put(None)
+    [x.join() for x in processes]
+    report('multiprocessing.Queue', count, time.time() - start)
+
+def deep_size(obj, seen=None):
+    '''Returns the approximate number of bytes used by an object and
+    everything it refers to.'''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(x, seen) for x in obj)
+    for cls in type(obj).__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+def full_messages(count):
+    '''Returns a list of count distinct site stream messages shaped like
+    real tweets, with a complete user object and entities.'''
+    import simplejson as json
+    from collections import OrderedDict
+
+    user = OrderedDict([('id', 0), ('id_str', '0'), ('name', 'Someone'),
+        ('screen_name', 'someone'), ('location', 'Somewhere, USA'),
+        ('description', 'Writes software. ' * 8), ('url', None),
+        ('entities', {'description': {'urls': []}}), ('protected', False),
+        ('followers_count', 1000), ('friends_count', 500),
+        ('listed_count', 20), ('created_at', 'Wed Aug 27 13:08:45 +0000 2008'),
+        ('favourites_count', 100), ('utc_offset', -18000),
+        ('time_zone', 'Eastern Time (US & Canada)'), ('geo_enabled', True),
+        ('verified', False), ('statuses_count', 5000), ('lang', 'en'),
+        ('profile_background_color', 'C0DEED'),
+        ('profile_image_url', 'http://a0.twimg.com/profile_images/1/a.png'),
+        ('profile_link_color', '0084B4'), ('default_profile', True),
+        ('following', None), ('follow_request_sent', None),
+        ('notifications', None)])
+    entities = {'hashtags': [{'text': 'python', 'indices': [10, 17]}],
+                'urls': [{'url': 'http://t.co/abc', 'indices': [20, 35],
+                          'expanded_url': 'http://example.com/a/long/url',
+                          'display_url': 'example.com/a/long/url'}],
+                'user_mentions': [{'screen_name': 'other', 'id': 2,
+                                   'id_str': '2', 'name': 'Other',
+                                   'indices': [0, 6]}]}
+    data = []
+    for x in xrange(count):
+        user['id'] = x % 5000
+        user['id_str'] = str(x % 5000)
+        tweet = OrderedDict([
+            ('created_at', 'Wed Aug 27 13:08:45 +0000 2008'), ('id', x),
+            ('id_str', str(x)), ('text', 'tweet number %s #python' % x),
+            ('source', '<a href="http://example.com">Example</a>'),
+            ('truncated', False), ('in_reply_to_status_id', None),
+            ('in_reply_to_user_id', None), ('user', user), ('geo', None),
+            ('coordinates', None), ('place', None), ('retweet_count', 0),
+            ('entities', entities), ('favorited', False),
+            ('retweeted', False), ('lang', 'en')])
+        data.append(json.dumps(OrderedDict([('for_user', x % 1000),
+                                            ('message', tweet)])) + '\r\n')
+    return data
+
+def bench_messages(count=100000):
+    '''CPU and memory per message for dictionaries and lazy Messages.'''
+    import simplejson as json
+    from sitebucket.message import Message
+
+    for size, data in (('small', messages(count)),
+                       ('full', full_messages(count))):
+        print "  %s messages, %.0f bytes each:" % (
+            size, sum(map(len, data)) / float(count))
+        for name, decode in (('dict', json.loads), ('Message', Message)):
+            start = time.time()
+            for token in data:
+                content = decode(token)
+                content['for_user'], content['message']['text']
+            report('%s: for_user and text' % name, count, time.time() - start)
+
+            start = time.time()
+            for token in data:
+                decode(token)['message']['user']['screen_name']
+            report('%s: nested field' % name, count, time.time() - start)
+
+            sample = [decode(token) for token in data[:1000]]
+            for content in sample:
+                content['for_user'], content['message']['text']
+            print "    retained bytes per message: %.0f" % (
+                deep_size(sample) / float(len(sample)))
+
+def bench_signing(streams=10000):
+    '''Cost per connection of signing requests during a reconnect storm.'''
+    import oauth2 as oauth
+    from sitebucket import SiteStream
+
+    consumer = oauth.Consumer('key', 'secret')
+    token = oauth.Token('key', 'secret')
+    fleet = [SiteStream(xrange(x * 100, x * 100 + 100), consumer, token)
+             for x in xrange(streams / 100)]
+    rounds = streams / len(fleet)
+
+    for name, sign in (
+            ('oauth2 request and to_url', lambda x: x.request.to_url()),
+            ('signed_request (cold cache)',
+             lambda x: (setattr(x, 'follow', x.follow), x.signed_request())),
+            ('signed_request (warm cache)', lambda x: x.signed_request())):
+        start = time.time()
+        for y in xrange(rounds):
+            for stream in fleet:
+                sign(stream)
+        elapsed = time.time() - start
+        print "%-40s %10.1f us/connection" % (name, elapsed / streams * 1e6)
+
+def bench_keywords(count=20000):
+    '''Messages/sec routed by KeywordRouter and by a loop over compiled
+    regexes as the number of keyword rules grows.'''
+    import re
+    import random
+    from sitebucket.keywords import KeywordRouter
+    from sitebucket.message import Message
+
+    rng = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rng.choice(letters) for y in xrange(rng.randint(4, 9)))
+             for x in xrange(60000)]
+    data = full_messages(count)
+
+    for rules in (100, 10000, 50000):
+        phrases = words[:rules]
+        router = KeywordRouter()
+        start = time.time()
+        router.update(add=dict((x, ([phrase], lambda rule, message: None))
+                               for x, phrase in enumerate(phrases)))
+        print "  %s rules, built in %.2f sec:" % (rules, time.time() - start)
+
+        start = time.time()
+        for token in data:
+            router.parse(token)
+        report('KeywordRouter', count, time.time() - start)
+
+        # The regex loop is too slow to run over every message.
+        sample = data[:max(count * 100 / rules, 100)]
+        patterns = [re.compile(r'\b%s\b' % x, re.I) for x in phrases]
+        start = time.time()
+        for token in sample:
+            text = Message(token)['message']['text']
+            [x for x in patterns if x.search(text)]
+        report('regex loop', len(sample), time.time() - start)
+
+def bench_columnar(count=100000):
+    '''Messages/sec batched by ColumnarSink, and the time to count tweets
+    per author in dictionaries and in columnar batches.'''
+    import simplejson as json
+    from sitebucket.columnar import ColumnarSink
+
+    data = full_messages(count)
+    batches = []
+    sink = ColumnarSink(callback=batches.append, batch_size=5000)
+    start = time.time()
+    for token in data:
+        sink.parse(token)
+    sink.close()
+    report('ColumnarSink', count, time.time() - start)
+
+    decoded = [json.loads(token) for token in data]
+    start = time.time()
+    counts = {}
+    for message in decoded:
+        user_id = message['message']['user']['id']
+        counts[user_id] = counts.get(user_id, 0) + 1
+    report('per-author counts, dictionaries', count, time.time() - start)
+
+    import numpy
+    start = time.time()
+    counts = sum(numpy.bincount(x['user_id'], minlength=5000)
+                 for x in batches)
+    report('per-author counts, columns', count, time.time() - start)
+
+def bench_control_plane(sizes=(1000, 10000, 100000), ticks=10):
+    '''Monitor tick cost, restart latency and consolidation time with
+    simulated streams.'''
+    from sitebucket.simulation import SimulatedMonitor
+    from sitebucket.listener import FOLLOW_LIMIT
+
+    for streams in sizes:
+        start = time.time()
+        monitor = SimulatedMonitor(xrange(1, streams * FOLLOW_LIMIT + 1),
+                                   seed=0)
+        monitor.start_streams()
+        monitor.tick()
+        print "  %s streams, built and connected in %.2f sec:" % (
+            len(monitor.threads), time.time() - start)
+
+        monitor.tick_time.reset()
+        monitor.run_ticks(ticks)
+        print "    idle tick %29.2f ms" % (monitor.tick_time.mean * 1000)
+
+        # Fail 1% of the streams before every tick.
+        monitor.tick_time.reset()
+        monitor.run_ticks(ticks, dict((x, streams / 100)
+                                      for x in xrange(ticks)))
+        print "    tick with 1%% failing %18.2f ms" % (
+            monitor.tick_time.mean * 1000)
+        print "    restart latency p50/p99 %15.0f/%.0f virtual sec" % (
+            monitor.restart_latency.percentile(50),
+            monitor.restart_latency.percentile(99))
+
+        # Streams that take longer than a monitor interval to connect must
+        # not be restarted while they are connecting.
+        monitor.run_ticks(1)
+        monitor.connect_delay = 15
+        monitor.restart_latency.reset()
+        monitor.run_ticks(ticks, {0: streams / 100})
+        print "    slow connect latency p50/p99 %10.0f/%.0f virtual sec" % (
+            monitor.restart_latency.percentile(50),
+            monitor.restart_latency.percentile(99))
+
+        users = 2 * 10 ** 9
+        start = time.time()
+        for x in xrange(100):
+            monitor.add_follows([users + x])
+        print "    add_follows of one user %15.2f ms" % (
+            (time.time() - start) * 10)
+
+        start = time.time()
+        monitor.consolidate_streams()
+        print "    consolidating 100 streams %13.2f ms" % (
+            (time.time() - start) * 1000)
+
+def bench_pipeline(count=50000):
+    '''Messages/sec through a filter, transform and sink pipeline with a
+    CPU heavy transform run inline, in threads and in processes.'''
+    import simplejson as json
+    from sitebucket.pipeline import Pipeline, FilterStage, TransformStage, \
+        SinkStage, INLINE, THREADS, PROCESSES
+
+    def enrich(token):
+        message = json.loads(token)
+        return len(json.dumps(message, sort_keys=True, indent=2))
+
+    data = full_messages(count)
+    for concurrency, workers in ((INLINE, 1), (THREADS, 4), (PROCESSES, 4)):
+        lengths = []
+        pipeline = Pipeline([
+            FilterStage(lambda token: '"for_user"' in token),
+            TransformStage(enrich, concurrency=concurrency, workers=workers),
+            SinkStage(lengths.append, concurrency=THREADS)])
+        pipeline.start()
+        start = time.time()
+        for token in data:
+            pipeline.parse(token)
+        pipeline.close()
+        report('pipeline, %s transform x%s' % (concurrency, workers), count,
+               time.time() - start)
+
+BENCHMARKS = [
+    ('sinks', bench_sinks),
+    ('ring', bench_ring),
+    ('messages', bench_messages),
+    ('signing', bench_signing),
+    ('keywords', bench_keywords),
+    ('columnar', bench_columnar),
+    ('control_plane', bench_control_plane),
+    ('pipeline', bench_pipeline),
+]
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for name, benchmark in BENCHMARKS:
+        if not selected or name in selected:
+            print "\n%s: %s" % (name, benchmark.__doc__)
+            benchmark()
@@ -9,6 +9,7 @@ setup(name="sitebucket",
       author_email="info@matchstrike.net",
       url="http://github.com/thomasw/sitebucket",
       install_requires=["oauth2", "simplejson"],
+      extras_require={"async": ["trollius"], "columnar": ["numpy"]},
       packages = find_packages(),
       keywords= "twitter sitestream site stream library consumer oauth threaded",
       zip_safe = False)
@@ -7,6 +7,9 @@ from listener import SiteStream
 from thread import ListenThread
 from parser import DefaultParser
 from monitor import ListenThreadMonitor
+from follow import FollowSet
+from startup import StartupScheduler
+from dispatch import LaneDispatcher
 
 __version__ = '0.0.2'
 __author__ = 'Thomas Welfley'
@@ -0,0 +1,189 @@
+import re
+import threading
+import collections
+import logging
+import simplejson as json
+
+from parser import BaseParser, DefaultParser
+from message import LazyObject
+from error import SitebucketError
+from util import extract_for_user, find_object_end, MESSAGE_RE
+
+logger = logging.getLogger("sitebucket")
+
+DECODE_CACHE_SIZE = 10000
+
+STATUS_ID_RE = re.compile(r'"id"\s*:\s*(\d+)')
+
+
+class DecodeCache(object):
+    '''A bounded, thread safe LRU cache of decoded messages keyed by status
+    id. Each entry also keeps the raw JSON it was decoded from and a lookup
+    only hits if the raw JSON is identical, so a stale or mismatched entry
+    is never returned.
+
+    * size -- the maximum number of decoded messages to keep
+
+    >>> cache = DecodeCache(size=2)
+    >>> cache.get(1, '{"id":1}') is None
+    True
+    >>> cache.put(1, '{"id":1}', {'id': 1})
+    >>> cache.get(1, '{"id":1}')
+    {'id': 1}
+    >>> cache.put(2, '{"id":2}', {'id': 2})
+    >>> cache.put(3, '{"id":3}', {'id': 3})
+    >>> cache.get(1, '{"id":1}') is None
+    True
+    >>> cache.hits, cache.misses, cache.evictions
+    (1, 2, 1)
+
+    '''
+    def __init__(self, size=DECODE_CACHE_SIZE):
+        '''Returns a DecodeCache object.'''
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, raw):
+        '''Returns the decoded message cached under key if it was decoded
+        from raw, or None.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != raw:
+                if entry is not None:
+                    self._entries[key] = entry
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+            self.bytes_saved += len(raw)
+            return entry[1]
+
+    def put(self, key, raw, decoded):
+        '''Caches a decoded message, evicting the least recently used
+        entry if the cache is full.'''
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (raw, decoded)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    @property
+    def hit_rate(self):
+        '''Returns the fraction of lookups that were served from the cache.
+
+        >>> DecodeCache().hit_rate
+        0.0
+
+        '''
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return self.hits / float(lookups)
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of cache metrics.
+
+        >>> sorted(DecodeCache().stats.keys())
+        ['bytes_saved', 'evictions', 'hit_rate', 'hits', 'misses', 'size']
+
+        '''
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+class CachingParser(BaseParser):
+    '''A parser that decodes the inner message of each site stream envelope
+    through a shared DecodeCache. With stream_with='followings', a popular
+    tweet is delivered once for every followed user who follows its author.
+    The CachingParser decodes that tweet once and passes the same decoded
+    message to the wrapped parser's handle method for every for_user
+    envelope. Since the message object is shared, parsers must not modify
+    it.
+
+    Messages that don't have a status id, or whose envelope can't be split
+    cheaply, are passed to the wrapped parser's parse method unchanged.
+
+    If the wrapped parser is lazy (DefaultParser(lazy=True)), the cache
+    holds message.LazyObjects instead of dictionaries, so a shared tweet is
+    still only decoded when one of its nested fields is used.
+
+    To parse in parallel, wrap the CachingParser in a LaneDispatcher, not
+    the other way around: LaneDispatcher(CachingParser(DefaultParser())).
+    The cache is thread safe, so every lane shares it. ListenThreadMonitor's
+    decode_cache option does this when its parser is a LaneDispatcher.
+
+    Keyword arguments:
+
+    * parser -- a DefaultParser instance (or subclass) that will handle the decoded messages
+    * cache -- the DecodeCache to use. Share one cache between every stream to share decoded messages.
+
+    >>> parser = CachingParser(DefaultParser())
+    >>> tweet = '{"id":5,"text":"hi!"}'
+    >>> parser.parse('{"for_user":1,"message":%s}\\r\\n' % tweet)
+    For user 1: hi!
+    >>> parser.parse('{"for_user":2,"message":%s}\\r\\n' % tweet)
+    For user 2: hi!
+    >>> parser.cache.hits
+    1
+
+    '''
+    def __init__(self, parser, cache=None):
+        '''Returns a CachingParser object.'''
+        if not isinstance(parser, DefaultParser):
+            raise SitebucketError('parser must extend DefaultParser. To '
+                                  'use a LaneDispatcher, wrap the '
+                                  'CachingParser in it instead.')
+
+        self.parser = parser
+        self.cache = cache if cache is not None else DecodeCache()
+
+    def parse(self, token):
+        '''Decodes the envelope's inner message through the cache and passes
+        the envelope to the wrapped parser's handle method.'''
+        match = MESSAGE_RE.search(token)
+        if not match:
+            return self.parser.parse(token)
+
+        start = match.end()
+        end = find_object_end(token, start)
+        # Envelopes with more fields after the message are parsed whole.
+        if end is None or token[end:].strip() != '}':
+            return self.parser.parse(token)
+        raw = token[start:end]
+        status_id = STATUS_ID_RE.search(raw)
+        for_user = extract_for_user(token[:start])
+
+        if status_id is None or for_user is None or not raw.startswith('{'):
+            return self.parser.parse(token)
+
+        key = long(status_id.group(1))
+        message = self.cache.get(key, raw)
+        if message is None:
+            if getattr(self.parser, 'lazy', False):
+                message = LazyObject(raw)
+            else:
+                try:
+                    message = json.loads(raw)
+                except ValueError:
+                    return self.parser.parse(token)
+            self.cache.put(key, raw, message)
+
+        self.parser.handle({'for_user': for_user, 'message': message})
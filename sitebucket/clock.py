@@ -0,0 +1,71 @@
+import time
+import threading
+
+
+class Clock(object):
+    '''The Clock is the source of time for the monitor's control loop: the
+    current time, sleeps and timed waits all go through it. The default
+    SYSTEM_CLOCK uses the real time. Pass a VirtualClock to a
+    ListenThreadMonitor to run its loop in simulated time.
+
+    >>> clock = Clock()
+    >>> clock.wait(threading.Event(), 0)
+    False
+
+    '''
+    def time(self):
+        '''Returns the current time in seconds since the epoch.'''
+        return time.time()
+
+    def sleep(self, seconds):
+        '''Sleeps for a number of seconds.'''
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        '''Waits up to timeout seconds for a threading.Event to be set.
+        Returns True if it was set.'''
+        return event.wait(timeout)
+
+SYSTEM_CLOCK = Clock()
+
+
+class VirtualClock(Clock):
+    '''A Clock whose time only moves when it is told to. Sleeping and
+    waiting advance the clock instantly instead of blocking, so a
+    simulation can run hours of monitor time in moments. Sleeps made from
+    several threads each advance the shared time, so VirtualClocks are
+    meant for single threaded simulations.
+
+    * start -- the initial time
+
+    >>> clock = VirtualClock(100)
+    >>> clock.sleep(30)
+    >>> clock.time()
+    130.0
+    >>> clock.wait(threading.Event(), 10)
+    False
+    >>> clock.time()
+    140.0
+
+    '''
+    def __init__(self, start=0):
+        '''Returns a VirtualClock object.'''
+        self.now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        '''Moves the clock forward a number of seconds.'''
+        with self._lock:
+            self.now += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        self.advance(timeout)
+        return event.is_set()
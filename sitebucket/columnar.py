@@ -0,0 +1,184 @@
+import os
+import re
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sinks import BatchSink, SINK_BATCH_SIZE, SINK_MAX_DELAY
+from message import Message
+from error import SitebucketError
+from util import extract_for_user, extract_timestamp
+
+COLUMNS = ('id', 'for_user', 'user_id', 'created_at', 'received_at',
+           'text_offsets', 'text_data')
+
+# Finds a tweet's user object, and the author's id if it is the object's
+# first field, as it is in every tweet Twitter sends.
+USER_ID_RE = re.compile(r'"user"\s*:\s*\{\s*("id"\s*:\s*(\d+))?')
+
+
+class ColumnarBatch(object):
+    '''A batch of tweets stored as one numpy array per field, so analytics
+    code can aggregate a whole batch with vectorized operations instead of
+    looping over dictionaries. Columns are accessed by name:
+
+    * id, for_user, user_id -- int64 arrays. Missing ids are -1.
+    * created_at, received_at -- float64 arrays of seconds since the epoch. A missing created_at is NaN.
+    * text_offsets, text_data -- the UTF-8 text of every tweet concatenated into one uint8 array. The text of tweet i is text_data[text_offsets[i]:text_offsets[i + 1]].
+
+    Batches can be saved to and loaded from .npz files, one array per
+    column.
+
+    >>> batch = ColumnarBatch.from_rows([(1, 10, 100, 5.0, 6.0, 'hi'),
+    ...                                  (2, 10, -1, None, 7.0, 'yo!')])
+    >>> len(batch), batch['id'].tolist(), batch['text_offsets'].tolist()
+    (2, [1, 2], [0, 2, 5])
+    >>> batch.text(1)
+    u'yo!'
+    >>> numpy.isnan(batch['created_at'][1])
+    True
+
+    '''
+    def __init__(self, columns):
+        '''Returns a ColumnarBatch object for a dictionary mapping the
+        names in COLUMNS to arrays.'''
+        if numpy is None:
+            raise SitebucketError('Columnar batches require numpy.')
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Returns a ColumnarBatch for a list of (id, for_user, user_id,
+        created_at, received_at, text) tuples, where text is a UTF-8
+        string.'''
+        if numpy is None:
+            raise SitebucketError('Columnar batches require numpy.')
+        ids, for_users, user_ids, created_at, received_at, texts = \
+            zip(*rows) if rows else ((),) * 6
+
+        offsets = numpy.zeros(len(texts) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(x) for x in texts], out=offsets[1:])
+        return cls({
+            'id': numpy.array(ids, dtype=numpy.int64),
+            'for_user': numpy.array(for_users, dtype=numpy.int64),
+            'user_id': numpy.array(user_ids, dtype=numpy.int64),
+            'created_at': numpy.array(created_at, dtype=numpy.float64),
+            'received_at': numpy.array(received_at, dtype=numpy.float64),
+            'text_offsets': offsets,
+            'text_data': numpy.frombuffer(''.join(texts), dtype=numpy.uint8),
+        })
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the ColumnarBatch saved in a .npz file.'''
+        if numpy is None:
+            raise SitebucketError('Columnar batches require numpy.')
+        with numpy.load(path) as data:
+            return cls(dict((x, data[x]) for x in COLUMNS))
+
+    def save(self, path):
+        '''Saves the batch to an uncompressed .npz file.'''
+        with open(path, 'wb') as f:
+            numpy.savez(f, **self.columns)
+
+    def text(self, index):
+        '''Returns the text of a tweet as unicode.'''
+        offsets = self.columns['text_offsets']
+        data = self.columns['text_data'][offsets[index]:offsets[index + 1]]
+        return data.tostring().decode('utf-8')
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+
+class ColumnarSink(BatchSink):
+    '''A sink that accumulates tweets into ColumnarBatch micro-batches.
+    Each batch is passed to callback, saved to a new .npz file in
+    directory, or both. Messages that aren't tweets are ignored.
+
+    Tweets are read as lazy message.Message objects. The for_user id,
+    creation time and author id are read from the raw message, so tweets
+    are only decoded if their author isn't the user object's first field.
+    received_at is the time the stream received the message.
+
+    Columnar sinks require numpy (pip install sitebucket[columnar]).
+
+    Keyword arguments are identical to BatchSink with the following
+    additions:
+
+    * callback -- (optional) a callable taking each ColumnarBatch
+    * directory -- (optional) the directory batch files are saved in
+    * prefix -- the prefix of every file name
+
+    >>> batches = []
+    >>> sink = ColumnarSink(callback=batches.append, batch_size=2)
+    >>> for x in range(3):
+    ...     sink.parse('{"for_user":1,"message":{"id":%s,"text":"hi!",'
+    ...                '"user":{"id":2}}}\\r\\n' % x)
+    >>> sink.parse('{"friends":[1,2]}\\r\\n')
+    >>> sink.close()
+    0
+    >>> [batch['id'].tolist() for batch in batches]
+    [[0, 1], [2]]
+    >>> batches[0]['user_id'].tolist()
+    [2, 2]
+
+    '''
+    def __init__(self, callback=None, directory=None, prefix='sitebucket',
+                 batch_size=SINK_BATCH_SIZE, max_delay=SINK_MAX_DELAY):
+        '''Returns a ColumnarSink object.'''
+        if numpy is None:
+            raise SitebucketError('Columnar sinks require numpy.')
+        if callback is None and directory is None:
+            raise SitebucketError('Columnar sinks need a callback or a '
+                                  'directory.')
+        super(ColumnarSink, self).__init__(batch_size, max_delay)
+        self.callback = callback
+        self.directory = directory
+        self.prefix = prefix
+        self.files = []
+
+    def convert(self, token):
+        '''Returns a row for a tweet, or None if the message isn't a
+        tweet.'''
+        tweet = Message(token).get('message')
+        if tweet is None or not hasattr(tweet, 'get'):
+            return None
+        text = tweet.get('text')
+        if text is None:
+            return None
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        raw = getattr(tweet, 'raw', None)
+        match = USER_ID_RE.search(raw) if raw else None
+        if match and match.group(2):
+            user_id = int(match.group(2))
+        else:
+            user_id = (tweet.get('user') or {}).get('id', -1)
+
+        for_user = extract_for_user(token)
+        created_at = extract_timestamp(raw or token)
+        received_at = getattr(token, 'received_at', None) or time.time()
+        return (tweet.get('id', -1), -1 if for_user is None else for_user,
+                user_id, created_at, received_at, text)
+
+    def write(self, batch):
+        '''Converts a list of rows to a ColumnarBatch and passes it to the
+        callback and saves it.'''
+        batch = ColumnarBatch.from_rows(batch)
+        if self.directory is not None:
+            name = '%s-%s-%s.npz' % (self.prefix,
+                                     time.strftime('%Y%m%d-%H%M%S'),
+                                     len(self.files))
+            path = os.path.join(self.directory, name)
+            batch.save(path)
+            self.files.append(path)
+        if self.callback is not None:
+            self.callback(batch)
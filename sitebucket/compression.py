@@ -0,0 +1,123 @@
+import zlib
+
+from error import SitebucketError
+
+# Sent by streams that request compressed output.
+ACCEPT_ENCODING = 'gzip, deflate'
+
+# zlib window bits for each supported Content-Encoding. Adding 16 makes
+# zlib expect a gzip header and trailer.
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def has_zlib_header(data):
+    '''Returns True if data starts with a zlib header: the deflate method
+    and a header checksum that is a multiple of 31.
+
+    >>> has_zlib_header(zlib.compress('hi')), has_zlib_header('hi')
+    (True, False)
+
+    '''
+    cmf, flg = ord(data[0]), ord(data[1])
+    return cmf & 0x0f == 8 and (cmf * 256 + flg) % 31 == 0
+
+
+class StreamDecompressor(object):
+    '''Incrementally decompresses a gzip or deflate encoded stream. Pass it
+    the compressed data as it is read off the connection, in pieces of any
+    size, and it returns whatever decompressed data those pieces complete.
+    Messages are framed after decompression, so a message may be split
+    across any number of compressed pieces.
+
+    Some servers send deflate streams without the zlib header, so a deflate
+    stream that doesn't start with one is decoded as a raw deflate stream.
+    The first two bytes of a deflate stream are held until both have
+    arrived, so the header can be checked even when the stream is read one
+    byte at a time.
+
+    The decompressor counts the compressed bytes it has been passed and the
+    decompressed bytes it has returned.
+
+    * encoding -- the response's Content-Encoding: 'gzip' or 'deflate'
+
+    >>> compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS['gzip'])
+    >>> data = compressor.compress('{"some":"json"}\\r\\n' * 10)
+    >>> data += compressor.flush()
+    >>> decompressor = StreamDecompressor('gzip')
+    >>> output = ''.join(decompressor.decompress(x) for x in data)
+    >>> output.count('{"some":"json"}\\r\\n')
+    10
+    >>> decompressor.decompressed_bytes
+    170
+    >>> decompressor.compressed_bytes == len(data)
+    True
+
+    '''
+    def __init__(self, encoding):
+        '''Returns a StreamDecompressor object.'''
+        encoding = (encoding or '').strip().lower()
+        if encoding not in WBITS:
+            raise SitebucketError("'%s' is an unsupported content encoding."
+                                  % encoding)
+
+        self.encoding = encoding
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self._decompressor = zlib.decompressobj(WBITS[encoding])
+        # Deflate data held until the zlib header can be checked.
+        self._header = '' if encoding == 'deflate' else None
+
+    def decompress(self, data):
+        '''Returns the decompressed data that the compressed data completes,
+        which may be an empty string.
+
+        >>> compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        >>> data = compressor.compress('{"some":"json"}') + compressor.flush()
+        >>> StreamDecompressor('deflate').decompress(data)
+        '{"some":"json"}'
+
+        A deflate stream without the zlib header, read one byte at a time:
+
+        >>> decompressor = StreamDecompressor('deflate')
+        >>> ''.join(decompressor.decompress(x) for x in data)
+        '{"some":"json"}'
+
+        '''
+        self.compressed_bytes += len(data)
+        if self._header is not None:
+            data = self._header + data
+            if len(data) < 2:
+                self._header = data
+                return ''
+            self._header = None
+            if not has_zlib_header(data):
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        output = self._decompressor.decompress(data)
+        self.decompressed_bytes += len(output)
+        return output
+
+    @property
+    def ratio(self):
+        '''Returns the number of decompressed bytes per compressed byte.'''
+        if not self.compressed_bytes:
+            return None
+        return self.decompressed_bytes / float(self.compressed_bytes)
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of compression metrics.
+
+        >>> sorted(StreamDecompressor('deflate').stats.keys())
+        ['compressed_bytes', 'decompressed_bytes', 'encoding', 'ratio']
+
+        '''
+        return {
+            'encoding': self.encoding,
+            'compressed_bytes': self.compressed_bytes,
+            'decompressed_bytes': self.decompressed_bytes,
+            'ratio': self.ratio,
+        }
@@ -0,0 +1,181 @@
+import time
+import threading
+import logging
+
+try:
+    import trollius as asyncio
+    from trollius import From
+except ImportError:
+    asyncio = None
+
+from parser import BaseParser
+from error import SitebucketError
+
+logger = logging.getLogger("sitebucket")
+
+ASYNC_CONCURRENCY = 100
+ASYNC_PENDING = 1000
+
+
+class AsyncBaseParser(object):
+    '''AsyncBaseParser is a prototype for parsers whose parse method is a
+    coroutine. Use one when handling a message mostly means waiting on the
+    network (posting a webhook, writing to a cache): many messages can be
+    waiting at once on a single thread. Coroutine parsers require trollius,
+    the Python 2 port of asyncio (pip install sitebucket[async]).
+
+    Streams can't call a coroutine directly, so wrap the parser in an
+    EventLoopParser and pass that to the stream or monitor instead.
+
+    >>> class WebhookParser(AsyncBaseParser):
+    ...     posted = []
+    ...     @asyncio.coroutine
+    ...     def parse(self, token):
+    ...         yield From(asyncio.sleep(0))
+    ...         self.posted.append(token.strip())
+    >>> parser = EventLoopParser(WebhookParser())
+    >>> parser.parse('{"some":"json"}\\r\\n')
+    >>> parser.close()
+    0
+    >>> WebhookParser.posted
+    ['{"some":"json"}']
+
+    '''
+    def parse(self, token):
+        '''This method must be overridden with a coroutine. It raises a
+        NotImplementedError.'''
+        raise NotImplementedError
+
+
+class EventLoopParser(BaseParser):
+    '''The EventLoopParser runs an AsyncBaseParser on a dedicated event
+    loop thread. parse schedules the coroutine and returns immediately, so
+    the stream keeps reading while up to concurrency messages are being
+    handled at once.
+
+    At most pending messages may be scheduled or running. When that many
+    are outstanding, parse blocks until one finishes, which slows down the
+    streams feeding the parser instead of buffering without limit.
+
+    Keyword arguments:
+
+    * parser -- an object that extends AsyncBaseParser
+    * concurrency -- the maximum number of coroutines running at once
+    * pending -- the maximum number of messages scheduled or running
+
+    '''
+    def __init__(self, parser, concurrency=ASYNC_CONCURRENCY,
+                 pending=ASYNC_PENDING):
+        '''Returns an EventLoopParser object.'''
+        if asyncio is None:
+            raise SitebucketError('Coroutine parsers require trollius.')
+        if not isinstance(parser, AsyncBaseParser):
+            raise SitebucketError('parser must extend AsyncBaseParser.')
+        if pending < concurrency:
+            raise SitebucketError('pending must be at least concurrency.')
+
+        self.parser = parser
+        self.concurrency = concurrency
+        self.pending = pending
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+        self._limit = asyncio.Semaphore(concurrency, loop=self.loop)
+        self._slots = threading.BoundedSemaphore(pending)
+        self._outstanding = 0
+        self._idle = threading.Condition()
+        self._lock = threading.Lock()
+
+    def parse(self, token):
+        '''Schedules the parser's coroutine for the message. Starts the event
+        loop if it isn't running yet. Blocks while pending messages are
+        outstanding.'''
+        if self.thread is None:
+            self.start()
+        self._slots.acquire()
+        with self._idle:
+            self._outstanding += 1
+        self.loop.call_soon_threadsafe(self.__schedule, token)
+
+    def start(self):
+        '''Starts the event loop thread. This is called automatically when
+        the first message is received.'''
+        with self._lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.__run_loop,
+                                           name='EventLoop')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def __schedule(self, token):
+        self.loop.create_task(self.__handle(token))
+
+    def __handle(self, token):
+        '''Runs the parser's coroutine for a message once fewer than
+        concurrency coroutines are running.'''
+        yield From(self._limit.acquire())
+        self.running += 1
+        try:
+            yield From(self.parser.parse(token))
+            self.completed += 1
+        except Exception:
+            self.failed += 1
+            logger.error("Unhandled exception encountered in coroutine "
+                         "parser.", exc_info=True)
+        finally:
+            self.running -= 1
+            self._limit.release()
+            with self._idle:
+                self._outstanding -= 1
+                self._idle.notify_all()
+            self._slots.release()
+
+    def close(self, timeout=None):
+        '''Waits up to timeout seconds (forever if None) for outstanding
+        messages to be handled and stops the event loop. Returns the number
+        of messages that were still outstanding.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._idle:
+            while self._outstanding:
+                if deadline is None:
+                    self._idle.wait(1)
+                elif time.time() < deadline:
+                    self._idle.wait(deadline - time.time())
+                else:
+                    break
+            outstanding = self._outstanding
+
+        with self._lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join(timeout)
+        return outstanding
+
+    @property
+    def outstanding(self):
+        '''Returns the number of messages scheduled or running.'''
+        return self._outstanding
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of coroutine parser metrics.
+
+        >>> sorted(EventLoopParser(AsyncBaseParser()).stats.keys())
+        ['completed', 'failed', 'outstanding', 'running']
+
+        '''
+        return {
+            'outstanding': self.outstanding,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
@@ -0,0 +1,282 @@
+import sys
+import time
+import Queue
+import itertools
+import threading
+import logging
+
+from parser import BaseParser
+from error import SitebucketError
+from util import extract_for_user, remaining
+from startup import DEFAULT_TIER
+
+logger = logging.getLogger("sitebucket")
+
+LANE_COUNT = 4
+LANE_QUEUE_SIZE = 1000
+
+# Sentinel placed on a lane's queue to stop its worker.
+_STOP = object()
+
+
+class LaneDispatcher(BaseParser):
+    '''The LaneDispatcher parses messages in parallel while preserving the
+    order of each user's messages. Messages are hashed by their for_user id
+    into one of several serial lanes. Each lane has its own queue and
+    worker thread that passes the lane's messages to the wrapped parser one
+    at a time, so a user's messages are always parsed in the order they
+    were received (a delete can't overtake its tweet). Messages without a
+    for_user id, like control messages, always go to the first lane.
+
+    Lane queues are bounded. When a lane is full, parse blocks, which slows
+    down the stream that delivered the message instead of buffering
+    without limit.
+
+    Keyword arguments:
+
+    * parser -- an object that extends BaseParser. Its parse method is called from the lane worker threads, so it must be thread safe.
+    * lanes -- the number of serial lanes
+    * queue_size -- the maximum number of messages waiting in each lane
+    * lag -- (optional) a lag.LagTracker. Since messages finish parsing in the lane workers, the workers record lag instead of the streams. ListenThreadMonitor sets this automatically.
+    * tiers -- (optional) a dictionary mapping user ids to priority tiers. When set, each lane parses messages from lower (more important) tiers ahead of queued messages from higher tiers. A user's messages are still parsed in order: while a user has messages queued, their new messages keep the tier of the queued ones, so a user moved to another tier can't overtake their own messages. ListenThreadMonitor sets this to its own tiers automatically when it has any.
+
+    Pass a LaneDispatcher to a stream or monitor in place of its parser:
+
+    >>> class ListParser(BaseParser):
+    ...     parsed = []
+    ...     def parse(self, token):
+    ...         self.parsed.append(token)
+    >>> dispatcher = LaneDispatcher(ListParser(), lanes=2)
+    >>> for x in range(1, 5):
+    ...     dispatcher.parse('{"for_user":%s,"message":{"text":"hi!"}}' % x)
+    >>> dispatcher.close()
+    0
+    >>> len(ListParser.parsed)
+    4
+    >>> dispatcher.processed
+    [2, 2]
+
+    '''
+    def __init__(self, parser, lanes=LANE_COUNT, queue_size=LANE_QUEUE_SIZE,
+                 lag=None, tiers=None):
+        '''Returns a LaneDispatcher object.'''
+        if not isinstance(parser, BaseParser):
+            raise SitebucketError('parser must extend BaseParser.')
+
+        self.parser = parser
+        self.lag = lag
+        self.queue_size = queue_size
+        self.tiers = None
+        self.queues = [Queue.Queue(queue_size) for x in xrange(lanes)]
+        self.processed = [0] * lanes
+        self.workers = []
+        self._lock = threading.Lock()
+        # Breaks ties between queued messages of the same tier, keeping
+        # them in the order they arrived.
+        self._sequence = itertools.count()
+        # Maps users with prioritized messages in a lane to the tier of
+        # those messages and how many there are.
+        self._queued = {}
+        if tiers is not None:
+            self.prioritize(tiers)
+
+    def prioritize(self, tiers):
+        '''Parses messages from lower tiers first, using the tiers
+        dictionary, which may be changed later. The first call must come
+        before the first message is parsed. Later calls replace the tiers
+        dictionary.
+
+        >>> from sitebucket import DefaultParser
+        >>> dispatcher = LaneDispatcher(DefaultParser())
+        >>> dispatcher.prioritize({1: 0})
+        >>> dispatcher.tier('{"for_user":1}'), dispatcher.tier('{"for_user":2}')
+        (0, 100)
+
+        '''
+        with self._lock:
+            if self.tiers is not None:
+                self.tiers = tiers
+                return
+            if self.workers:
+                raise SitebucketError('Lanes can only be prioritized before '
+                                      'the dispatcher starts.')
+            self.tiers = tiers
+            self.queues = [Queue.PriorityQueue(self.queue_size)
+                           for x in self.queues]
+
+    def tier(self, token):
+        '''Returns the priority tier of a message.'''
+        return self.tiers.get(extract_for_user(token), DEFAULT_TIER)
+
+    def lane(self, token):
+        '''Returns the index of the lane a message belongs to.
+
+        >>> from sitebucket import DefaultParser
+        >>> dispatcher = LaneDispatcher(DefaultParser(), lanes=4)
+        >>> dispatcher.lane('{"for_user":7}') == dispatcher.lane('{"for_user":7}')
+        True
+        >>> dispatcher.lane('{"control":{}}')
+        0
+
+        '''
+        return self.__lane(extract_for_user(token))
+
+    def __lane(self, for_user):
+        if for_user is None:
+            return 0
+        # Scramble the id so that sequential ids still spread evenly.
+        return (for_user * 2654435761 & 0xffffffff) % len(self.queues)
+
+    def parse(self, token):
+        '''Places the message in its lane. Starts the lane workers if they
+        aren't running yet. Blocks while the lane is full.'''
+        if not self.workers:
+            self.start()
+        if self.tiers is None:
+            self.queues[self.lane(token)].put(token)
+            return
+
+        for_user = extract_for_user(token)
+        with self._lock:
+            tier, count = self._queued.get(for_user) or \
+                (self.tiers.get(for_user, DEFAULT_TIER), 0)
+            self._queued[for_user] = (tier, count + 1)
+            sequence = next(self._sequence)
+        self.queues[self.__lane(for_user)].put(
+            (tier, sequence, for_user, token))
+
+    def start(self):
+        '''Starts a daemon worker thread for every lane. This is called
+        automatically when the first message is received.'''
+        with self._lock:
+            if self.workers:
+                return
+            for index in xrange(len(self.queues)):
+                worker = threading.Thread(target=self.__work, args=(index,),
+                                          name='Lane-%s' % index)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def __work(self, index):
+        '''Passes the messages in a lane to the parser, one at a time.'''
+        queue = self.queues[index]
+        prioritized = self.tiers is not None
+        while True:
+            token = queue.get()
+            if prioritized:
+                tier, sequence, for_user, token = token
+                if token is not _STOP:
+                    self.__dequeued(for_user)
+            try:
+                if token is _STOP:
+                    break
+                self.parser.parse(token)
+                if self.lag is not None:
+                    self.lag.observe(token)
+            except Exception:
+                logger.error("Unhandled exception encountered in lane %s."
+                             % index, exc_info=True)
+            finally:
+                if token is not _STOP:
+                    self.processed[index] += 1
+                queue.task_done()
+
+    def __dequeued(self, for_user):
+        '''Forgets the tier of a user's queued messages once the last one
+        has been taken from its lane.'''
+        with self._lock:
+            tier, count = self._queued[for_user]
+            if count == 1:
+                del self._queued[for_user]
+            else:
+                self._queued[for_user] = (tier, count - 1)
+
+    def close(self, timeout=None):
+        '''Stops the lane workers after they have parsed the messages already
+        in their lanes, then closes the wrapped parser. Waits up to timeout
+        seconds (forever if None) and returns the number of messages that
+        were left unparsed.
+
+        >>> from sitebucket import DefaultParser
+        >>> LaneDispatcher(DefaultParser()).close()
+        0
+
+        '''
+        with self._lock:
+            workers, self.workers = self.workers, []
+
+        deadline = None if timeout is None else time.time() + timeout
+        for queue in self.queues:
+            if not workers:
+                break
+            # A stop sorts after every queued message.
+            stop = (sys.maxint, next(self._sequence), None, _STOP) \
+                if self.tiers is not None else _STOP
+            try:
+                queue.put(stop, timeout=remaining(deadline))
+            except Queue.Full:
+                logger.warning("Lane is full. Its worker wasn't stopped.")
+
+        for worker in workers:
+            worker.join(remaining(deadline))
+
+        dropped = sum(self.__unparsed(queue) for queue in self.queues)
+        return dropped + self.parser.close(remaining(deadline))
+
+    def __unparsed(self, queue):
+        '''Returns the number of messages waiting in a lane, not counting
+        stops.'''
+        with queue.mutex:
+            items = list(queue.queue)
+        if self.tiers is not None:
+            items = [x[3] for x in items]
+        return len([x for x in items if x is not _STOP])
+
+    @property
+    def lane_depths(self):
+        '''Returns a list of the number of messages waiting in each lane.
+
+        >>> from sitebucket import DefaultParser
+        >>> LaneDispatcher(DefaultParser(), lanes=3).lane_depths
+        [0, 0, 0]
+
+        '''
+        return [x.qsize() for x in self.queues]
+
+    @property
+    def imbalance(self):
+        '''Returns the ratio of the busiest lane's message count to the
+        average message count of all lanes. A value of 1.0 means messages
+        are spread perfectly evenly.
+
+        >>> from sitebucket import DefaultParser
+        >>> dispatcher = LaneDispatcher(DefaultParser(), lanes=2)
+        >>> dispatcher.imbalance
+        1.0
+        >>> dispatcher.processed = [30, 10]
+        >>> dispatcher.imbalance
+        1.5
+
+        '''
+        counts = [processed + depth for processed, depth
+                  in zip(self.processed, self.lane_depths)]
+        if not sum(counts):
+            return 1.0
+        return max(counts) / (float(sum(counts)) / len(counts))
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of lane metrics.
+
+        >>> from sitebucket import DefaultParser
+        >>> sorted(LaneDispatcher(DefaultParser()).stats.keys())
+        ['depths', 'imbalance', 'lanes', 'processed']
+
+        '''
+        return {
+            'lanes': len(self.queues),
+            'depths': self.lane_depths,
+            'processed': list(self.processed),
+            'imbalance': self.imbalance,
+        }
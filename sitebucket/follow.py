@@ -0,0 +1,276 @@
+import bisect
+import heapq
+import collections
+import itertools
+from array import array
+
+# Use 64 bit signed integers for user ids. Python 2's array module doesn't
+# support the 'q' typecode, so fall back to 'l', which is 64 bits wide on
+# LP64 platforms.
+try:
+    array('q')
+    TYPECODE = 'q'
+except ValueError:
+    TYPECODE = 'l'
+
+# Number of ids sorted in memory at a time while building a FollowSet.
+SORT_CHUNK_SIZE = 65536
+
+# Set operations with an operand less than this fraction of the size of the
+# other look up the smaller operand's ids in the larger array and copy the
+# runs between them, instead of merging element by element.
+SPLICE_FRACTION = .25
+
+
+def _sorted_runs(iterable):
+    '''Splits an iterable of ids into sorted, de-duplicated arrays of
+    SORT_CHUNK_SIZE ids or fewer.
+
+    >>> [x.tolist() for x in _sorted_runs([3, 1, 2, 1])]
+    [[1, 2, 3]]
+
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = array(TYPECODE, itertools.islice(iterator, SORT_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield array(TYPECODE, sorted(set(chunk)))
+
+
+def _merge(runs):
+    '''Merges sorted arrays into a single sorted, de-duplicated array.
+
+    >>> _merge([array(TYPECODE, [1, 3]), array(TYPECODE, [2, 3])]).tolist()
+    [1, 2, 3]
+
+    '''
+    if len(runs) == 1:
+        return runs[0]
+
+    result = array(TYPECODE)
+    last = None
+    for x in heapq.merge(*runs):
+        if x != last:
+            result.append(x)
+            last = x
+    return result
+
+
+def read_ids(f):
+    '''Lazily reads user ids from a file object. Ids may be separated by
+    commas, spaces or newlines.
+
+    >>> from StringIO import StringIO
+    >>> list(read_ids(StringIO('1,2\\n3 4\\n\\n5')))
+    [1, 2, 3, 4, 5]
+
+    '''
+    for line in f:
+        for token in line.replace(',', ' ').split():
+            yield int(token)
+
+
+def _splice(ids, changes, insert):
+    '''Returns a copy of a sorted array with the sorted ids in changes
+    inserted (or removed, if insert is False). The result is allocated once
+    and the runs of ids between changes are copied into it as slices, so
+    the cost is mostly a memory copy of ids plus a binary search per change.
+
+    >>> ids = array(TYPECODE, [1, 3, 5])
+    >>> _splice(ids, [2, 3, 6], True).tolist()
+    [1, 2, 3, 5, 6]
+    >>> _splice(ids, [3, 4], False).tolist()
+    [1, 5]
+
+    '''
+    positions = []
+    start = 0
+    for x in changes:
+        index = bisect.bisect_left(ids, x, start)
+        found = index < len(ids) and ids[index] == x
+        if found != insert:
+            positions.append((index, x))
+        start = index + 1 if found else index
+
+    size = len(ids) + len(positions) * (1 if insert else -1)
+    result = array(TYPECODE, [0]) * size
+    start = end = 0
+    for index, x in positions:
+        result[end:end + index - start] = ids[start:index]
+        end += index - start
+        if insert:
+            result[end] = x
+            end += 1
+            start = index
+        else:
+            start = index + 1
+    result[end:] = ids[start:]
+    return result
+
+
+class FollowSet(object):
+    '''An immutable, sorted set of user ids stored in a compact array of
+    64 bit integers. A FollowSet uses 8 bytes per user id, which is a
+    fraction of the memory a list of Python ints requires. Membership tests
+    use binary search and set operations merge the underlying arrays.
+
+    A FollowSet can be built from any iterable of ids, including a
+    generator. Ids are sorted SORT_CHUNK_SIZE at a time, so the whole
+    follow list never needs to exist as a list of Python ints.
+
+    * follow -- an iterable of user ids
+
+    >>> follow = FollowSet([3, 1, 2, 3])
+    >>> follow
+    FollowSet([1, 2, 3])
+    >>> len(follow)
+    3
+    >>> 2 in follow, 4 in follow
+    (True, False)
+    >>> follow[0], follow[-1]
+    (1, 3)
+    >>> follow[:2]
+    FollowSet([1, 2])
+    >>> follow | FollowSet([4, 5])
+    FollowSet([1, 2, 3, 4, 5])
+    >>> follow & [2, 3, 4]
+    FollowSet([2, 3])
+    >>> follow - [2]
+    FollowSet([1, 3])
+    >>> follow == [1, 2, 3]
+    True
+
+    '''
+    __slots__ = ('_ids',)
+
+    def __init__(self, follow=()):
+        '''Returns a FollowSet object.'''
+        if isinstance(follow, FollowSet):
+            self._ids = follow._ids
+        else:
+            self._ids = _merge(list(_sorted_runs(follow))
+                               or [array(TYPECODE)])
+
+    @classmethod
+    def from_file(cls, f):
+        '''Returns a FollowSet built from a file of user ids separated by
+        commas, spaces or newlines. f may be a path or a file object. The
+        file is read incrementally.
+
+        >>> import os, tempfile
+        >>> path = tempfile.mktemp()
+        >>> open(path, 'w').write('5\\n3\\n4,1\\n')
+        >>> FollowSet.from_file(path)
+        FollowSet([1, 3, 4, 5])
+        >>> os.remove(path)
+
+        '''
+        if isinstance(f, basestring):
+            with open(f) as fp:
+                return cls(read_ids(fp))
+
+        return cls(read_ids(f))
+
+    @classmethod
+    def _from_sorted(cls, ids):
+        '''Wraps an already sorted and de-duplicated array.'''
+        instance = cls.__new__(cls)
+        instance._ids = ids
+        return instance
+
+    @property
+    def nbytes(self):
+        '''Returns the number of bytes used to store the user ids.
+
+        >>> FollowSet(range(100)).nbytes
+        800
+
+        '''
+        return len(self._ids) * self._ids.itemsize
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, user):
+        index = bisect.bisect_left(self._ids, user)
+        return index < len(self._ids) and self._ids[index] == user
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._from_sorted(self._ids[index])
+        return self._ids[index]
+
+    def __eq__(self, other):
+        '''FollowSets are equal to any iterable of the same ids. They are
+        never equal to anything else.
+
+        >>> FollowSet([2, 1]) == [1, 2], FollowSet([1]) != (1, 2)
+        (True, True)
+        >>> FollowSet([1]) == None, FollowSet([1]) != 5
+        (False, True)
+        >>> None in [FollowSet([1])]
+        False
+
+        '''
+        if not isinstance(other, FollowSet):
+            if isinstance(other, basestring) or \
+               not isinstance(other, collections.Iterable):
+                return NotImplemented
+            other = FollowSet(other)
+        return self._ids == other._ids
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FollowSet(%s)' % self._ids.tolist()
+
+    def sort(self):
+        '''FollowSets are always sorted. This method exists so that a
+        FollowSet can be used anywhere a sorted follow list was expected.'''
+        pass
+
+    def tolist(self):
+        '''Returns the user ids as a list.
+
+        >>> FollowSet([2, 1]).tolist()
+        [1, 2]
+
+        '''
+        return self._ids.tolist()
+
+    def union(self, other):
+        '''Returns a FollowSet containing the ids in either set.'''
+        other = FollowSet(other)
+        small, large = sorted((self, other), key=len)
+        if len(small) < len(large) * SPLICE_FRACTION:
+            return self._from_sorted(_splice(large._ids, small._ids, True))
+        return self._from_sorted(_merge([self._ids, other._ids]))
+
+    def intersection(self, other):
+        '''Returns a FollowSet containing the ids in both sets.'''
+        other = FollowSet(other)
+        small, large = sorted((self, other), key=len)
+        return self._from_sorted(
+            array(TYPECODE, (x for x in small if x in large)))
+
+    def difference(self, other):
+        '''Returns a FollowSet containing the ids that aren't in other.'''
+        other = FollowSet(other)
+        if len(other) < len(self) * SPLICE_FRACTION:
+            return self._from_sorted(_splice(self._ids, other._ids, False))
+        return self._from_sorted(
+            array(TYPECODE, (x for x in self._ids if x not in other)))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
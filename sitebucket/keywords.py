@@ -0,0 +1,313 @@
+import collections
+import threading
+import logging
+
+from parser import BaseParser
+from message import Message
+
+logger = logging.getLogger("sitebucket")
+
+# Rules added since the main automaton was built are matched by a small
+# delta automaton. Once it holds this many rules, both are merged.
+DELTA_RULE_LIMIT = 1000
+
+
+def normalize(phrase):
+    '''Returns a phrase as lower case unicode with runs of whitespace
+    collapsed to single spaces.
+
+    >>> normalize('  Hello   World ')
+    u'hello world'
+
+    '''
+    if isinstance(phrase, str):
+        phrase = phrase.decode('utf-8')
+    return u' '.join(phrase.lower().split())
+
+
+class KeywordAutomaton(object):
+    '''An Aho-Corasick automaton that finds every occurrence of any number
+    of phrases in a single pass over a text. Matching costs time
+    proportional to the length of the text (plus the number of matches),
+    no matter how many phrases there are. Automatons are immutable once
+    built, so they can be shared between threads.
+
+    * phrases -- a dictionary mapping normalized phrases to values
+    * whole_words -- if True, phrases only match whole words, so 'cat' doesn't match 'concatenate'
+
+    >>> automaton = KeywordAutomaton({u'he': 1, u'she': 2, u'hers': 3},
+    ...                              whole_words=False)
+    >>> sorted(automaton.search(u'ushers'))
+    [1, 2, 3]
+    >>> KeywordAutomaton({u'cat': 1}).search(u'concatenate, cat!')
+    set([1])
+
+    '''
+    def __init__(self, phrases, whole_words=True):
+        '''Returns a KeywordAutomaton object.'''
+        self.whole_words = whole_words
+        self.phrases = len(phrases)
+        # State 0 is the root. Each state has a dictionary of transitions,
+        # a failure link and a tuple of (phrase length, value) outputs.
+        goto = [{}]
+        outputs = [()]
+        for phrase, value in phrases.iteritems():
+            state = 0
+            for char in phrase:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    outputs.append(())
+                state = next_state
+            outputs[state] += ((len(phrase), value),)
+
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].iteritems():
+                queue.append(next_state)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                link = goto[link].get(char, 0)
+                fail[next_state] = link if link != next_state else 0
+                # A state also outputs every phrase that is a suffix of it.
+                outputs[next_state] += outputs[fail[next_state]]
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = outputs
+
+    @property
+    def states(self):
+        return len(self._goto)
+
+    def search(self, text):
+        '''Returns the set of values of every phrase found in the text. The
+        text must be normalized like the phrases.'''
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        whole_words = self.whole_words
+        found = set()
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not outputs[state]:
+                continue
+            for length, value in outputs[state]:
+                if whole_words:
+                    start = index - length + 1
+                    if start > 0 and text[start - 1].isalnum():
+                        continue
+                    end = index + 1
+                    if end < len(text) and text[end].isalnum():
+                        continue
+                found.add(value)
+        return found
+
+
+class KeywordRouter(BaseParser):
+    '''The KeywordRouter matches the text of every tweet against any number
+    of keyword rules and passes the tweet to the handler of every rule it
+    matches. Each rule is a set of phrases, and a tweet matches a rule if
+    it contains any of the rule's phrases, ignoring case and whitespace.
+
+    All phrases are compiled into a single KeywordAutomaton, so each tweet
+    is matched in one pass over its text, however many rules there are.
+    Rules can be added, changed and removed while streams are running.
+    Updates never modify an automaton in use: rules added since the main
+    automaton was built are compiled into a small delta automaton, which is
+    rebuilt on every update, and both are merged into a new main automaton
+    once the delta holds DELTA_RULE_LIMIT rules. The new automatons replace
+    the old ones at once, so parsing never waits on an update.
+
+    Messages are read as lazy message.Message objects, so only the
+    envelope and the tweet's text are decoded unless a handler uses other
+    fields. Handlers are called with the rule and the Message, from the
+    stream thread that delivered it.
+
+    * whole_words -- if True, phrases only match whole words
+
+    >>> router = KeywordRouter()
+    >>> def handler(rule, message):
+    ...     print rule, message['for_user']
+    >>> router.add_rule('weather', ['rain', 'snow storm'], handler)
+    >>> router.parse('{"for_user":1,"message":{"text":"More RAIN today"}}')
+    weather 1
+    >>> router.parse('{"for_user":1,"message":{"text":"Snowstorm!"}}')
+
+    '''
+    def __init__(self, whole_words=True):
+        '''Returns a KeywordRouter object.'''
+        self.whole_words = whole_words
+        # Rules map to (frozenset of phrases, handler), and phrases map to
+        # the frozenset of rules using them. Both are only ever updated by
+        # replacing entries, so parse can read them without the lock.
+        self.rules = {}
+        self._index = {}
+        self.messages = 0
+        self.matched = 0
+        self.deliveries = 0
+        self.rebuilds = 0
+
+        self._main_rules = set()
+        empty = KeywordAutomaton({}, whole_words)
+        self._automatons = (empty, empty)
+        self._lock = threading.Lock()
+
+    def add_rule(self, rule, phrases, handler):
+        '''Adds a rule, or replaces the rule's phrases and handler if it
+        already exists.
+
+        * rule -- a hashable rule id
+        * phrases -- an iterable of phrases
+        * handler -- a callable taking the rule and a message.Message
+
+        '''
+        self.update(add={rule: (phrases, handler)})
+
+    def remove_rule(self, rule):
+        '''Removes a rule. Removing a rule that doesn't exist does
+        nothing.'''
+        self.update(remove=[rule])
+
+    def update(self, add=None, remove=()):
+        '''Adds and removes many rules at once, rebuilding the automatons
+        only once.
+
+        * add -- a dictionary mapping rules to (phrases, handler) tuples
+        * remove -- an iterable of rules to remove
+
+        >>> router = KeywordRouter()
+        >>> router.update(add={1: (['a'], None), 2: (['b'], None)})
+        >>> router.update(remove=[1])
+        >>> router.rules.keys()
+        [2]
+
+        '''
+        with self._lock:
+            for rule in remove:
+                self.__unindex(rule)
+                self.rules.pop(rule, None)
+                self._main_rules.discard(rule)
+            for rule, (phrases, handler) in (add or {}).iteritems():
+                phrases = frozenset(normalize(x) for x in phrases) - \
+                    frozenset([u''])
+                self.__unindex(rule)
+                self.rules[rule] = (phrases, handler)
+                for phrase in phrases:
+                    self._index[phrase] = \
+                        self._index.get(phrase, frozenset()) | set([rule])
+                # The main automaton may still hold the rule's old phrases,
+                # which are no longer indexed, so the rule is compiled into
+                # the delta automaton again.
+                self._main_rules.discard(rule)
+            self.__rebuild()
+
+    def __unindex(self, rule):
+        '''Removes a rule from the phrase index. Must be called with the
+        lock held.'''
+        entry = self.rules.get(rule)
+        if entry is None:
+            return
+        for phrase in entry[0]:
+            rules = self._index.get(phrase, frozenset()) - set([rule])
+            if rules:
+                self._index[phrase] = rules
+            else:
+                self._index.pop(phrase, None)
+
+    def __rebuild(self):
+        '''Rebuilds the delta automaton, or merges it into the main
+        automaton if it has grown too large. Must be called with the lock
+        held.'''
+        main, delta = self._automatons
+        pending = [x for x in self.rules if x not in self._main_rules]
+        if len(pending) >= DELTA_RULE_LIMIT:
+            main = self.__compile(self.rules)
+            delta = self.__compile([])
+            self._main_rules = set(self.rules)
+            self.rebuilds += 1
+            logger.debug("Rebuilt keyword automaton with %s rules and %s "
+                         "states.", len(self.rules), main.states)
+        else:
+            delta = self.__compile(pending)
+        self._automatons = (main, delta)
+
+    def __compile(self, rules):
+        '''Returns a KeywordAutomaton mapping the phrases of the specified
+        rules to the phrase itself.'''
+        phrases = {}
+        for rule in rules:
+            for phrase in self.rules[rule][0]:
+                phrases[phrase] = phrase
+        return KeywordAutomaton(phrases, self.whole_words)
+
+    def match(self, text):
+        '''Returns the set of rules whose phrases appear in the text.
+
+        >>> router = KeywordRouter()
+        >>> router.update(add={'a': (['red'], None), 'b': (['blue'], None)})
+        >>> sorted(router.match('Red and BLUE'))
+        ['a', 'b']
+
+        '''
+        main, delta = self._automatons
+        text = normalize(text)
+        phrases = main.search(text) | delta.search(text)
+        rules = set()
+        for phrase in phrases:
+            rules.update(self._index.get(phrase, ()))
+        return rules
+
+    def parse(self, token):
+        '''Passes the message to the handler of every rule its tweet's text
+        matches.'''
+        self.messages += 1
+        message = Message(token)
+        tweet = message.get('message')
+        if tweet is None or not hasattr(tweet, 'get'):
+            return
+        text = tweet.get('text')
+        if not text:
+            return
+
+        rules = self.match(text)
+        if not rules:
+            return
+        self.matched += 1
+        for rule in rules:
+            entry = self.rules.get(rule)
+            if entry is None:
+                continue
+            self.deliveries += 1
+            try:
+                entry[1](rule, message)
+            except Exception:
+                logger.error("Unhandled exception in handler of keyword rule "
+                             "%s.", rule, exc_info=True)
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of keyword routing metrics.
+
+        >>> sorted(KeywordRouter().stats.keys())
+        ['deliveries', 'matched', 'messages', 'phrases', 'rebuilds', 'rules', 'states']
+
+        '''
+        main, delta = self._automatons
+        return {
+            'messages': self.messages,
+            'matched': self.matched,
+            'deliveries': self.deliveries,
+            'rules': len(self.rules),
+            'phrases': main.phrases + delta.phrases,
+            'states': main.states + delta.states,
+            'rebuilds': self.rebuilds,
+        }
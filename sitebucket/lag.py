@@ -0,0 +1,140 @@
+import time
+import threading
+
+from stats import Histogram
+from util import extract_timestamp
+
+
+class LagTracker(object):
+    '''The LagTracker measures how late messages are. Every frame a stream
+    reads is stamped with the time it was received, and the time the
+    message was created is extracted from its timestamp_ms or created_at
+    field without decoding it. Three lags are recorded for each message:
+
+    * delivery -- from creation to receipt. This is time spent at Twitter and on the network.
+    * processing -- from receipt to parse completion. This is time spent queued and parsed by sitebucket.
+    * total -- from creation to parse completion.
+
+    Delivery lag is also recorded per stream, keyed by stream id, so a
+    single slow connection stands out. Total lag is also recorded per
+    priority tier for streams assigned a tier with assign_tier, which
+    ListenThreadMonitor does for every stream it creates. Messages without
+    a creation time only contribute to processing lag.
+
+    Twitter's created_at field only has second resolution, so delivery lag
+    for messages without a timestamp_ms field is only accurate to a second.
+
+    >>> from util import Frame
+    >>> tracker = LagTracker()
+    >>> frame = Frame('{"message":{"timestamp_ms":"1000000"}}',
+    ...               received_at=1002.0, stream_id=1)
+    >>> tracker.observe(frame, completed_at=1002.5)
+    >>> tracker.delivery.max, tracker.processing.max, tracker.total.max
+    (2.0, 0.5, 2.5)
+    >>> tracker.streams[1].count
+    1
+    >>> tracker.last_completed_at
+    1002.5
+
+    '''
+    def __init__(self):
+        '''Returns a LagTracker object.'''
+        self.delivery = Histogram()
+        self.processing = Histogram()
+        self.total = Histogram()
+        self.streams = {}
+        self.tiers = {}
+        self.stream_tiers = {}
+        self.last_completed_at = None
+        self._lock = threading.Lock()
+
+    def stream(self, stream_id):
+        '''Returns the delivery lag histogram of a stream.'''
+        histogram = self.streams.get(stream_id)
+        if histogram is None:
+            with self._lock:
+                histogram = self.streams.setdefault(stream_id, Histogram())
+        return histogram
+
+    def assign_tier(self, stream_id, tier):
+        '''Records the total lag of a stream's messages under a priority
+        tier as well.
+
+        >>> from util import Frame
+        >>> tracker = LagTracker()
+        >>> tracker.assign_tier(1, 0)
+        >>> tracker.observe(Frame('{"message":{"timestamp_ms":"1000000"}}',
+        ...                       received_at=1001.0, stream_id=1),
+        ...                 completed_at=1001.5)
+        >>> tracker.tiers[0].max
+        1.5
+
+        '''
+        with self._lock:
+            self.stream_tiers[stream_id] = tier
+            if tier not in self.tiers:
+                self.tiers[tier] = Histogram()
+
+    def observe(self, frame, completed_at=None):
+        '''Records the lag of a frame whose parsing completed at
+        completed_at (now by default). Frames that weren't stamped when
+        they were received are ignored.'''
+        received_at = getattr(frame, 'received_at', None)
+        if received_at is None:
+            return
+        if completed_at is None:
+            completed_at = time.time()
+
+        self.last_completed_at = completed_at
+        self.processing.record(max(completed_at - received_at, 0))
+
+        created_at = extract_timestamp(frame)
+        if created_at is None:
+            return
+        delivery = max(received_at - created_at, 0)
+        self.delivery.record(delivery)
+        self.stream(frame.stream_id).record(delivery)
+        total = max(completed_at - created_at, 0)
+        self.total.record(total)
+        tier = self.stream_tiers.get(frame.stream_id)
+        if tier is not None:
+            self.tiers[tier].record(total)
+
+    def retain(self, stream_ids):
+        '''Discards the histograms and tiers of every stream not in
+        stream_ids. The monitor calls this to forget streams it has
+        closed.
+
+        >>> tracker = LagTracker()
+        >>> tracker.stream(1), tracker.stream(2) #doctest: +ELLIPSIS
+        (<...Histogram object at ...>, <...Histogram object at ...>)
+        >>> tracker.retain([2])
+        >>> tracker.streams.keys()
+        [2]
+
+        '''
+        stream_ids = set(stream_ids)
+        with self._lock:
+            for stream_id in self.streams.keys():
+                if stream_id not in stream_ids:
+                    del self.streams[stream_id]
+            for stream_id in self.stream_tiers.keys():
+                if stream_id not in stream_ids:
+                    del self.stream_tiers[stream_id]
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of lag metrics.
+
+        >>> sorted(LagTracker().stats.keys())
+        ['delivery', 'last_completed_at', 'processing', 'streams', 'tiers', 'total']
+
+        '''
+        return {
+            'delivery': self.delivery.stats,
+            'processing': self.processing.stats,
+            'total': self.total.stats,
+            'streams': dict((x, y.stats) for x, y in self.streams.items()),
+            'tiers': dict((x, y.stats) for x, y in self.tiers.items()),
+            'last_completed_at': self.last_completed_at,
+        }
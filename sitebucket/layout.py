@@ -0,0 +1,104 @@
+import os
+import time
+import tempfile
+import logging
+import simplejson as json
+
+logger = logging.getLogger("sitebucket")
+
+LAYOUT_VERSION = 1
+LAYOUT_SAVE_INTERVAL = 60
+
+
+class LayoutCheckpoint(object):
+    '''A LayoutCheckpoint saves a monitor's stream layout to a local file
+    so that a restarted process can reconnect the same streams without
+    planning them again. For every stream it records the stream id, the
+    users it follows, its tier and its backoff state (error count and retry
+    time), so a process that crashes while Twitter is refusing connections
+    keeps backing off after it restarts. Control URIs aren't saved, since
+    each new connection is given its own.
+
+    Files are written atomically: the layout is written to a temporary file
+    in the same directory, which then replaces the checkpoint.
+
+    Pass a LayoutCheckpoint to ListenThreadMonitor's layout option. The
+    monitor restores the saved layout when it is created and saves its
+    layout whenever its streams change (at most every save_interval seconds
+    otherwise) and when it is disconnected.
+
+    * path -- the location of the checkpoint file
+    * save_interval -- the maximum number of seconds between saves of an unchanged layout
+
+    >>> import shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> checkpoint = LayoutCheckpoint(os.path.join(directory, 'layout.json'))
+    >>> checkpoint.load() is None
+    True
+    >>> checkpoint.save('user', [{'stream_id': 1, 'follow': [1, 2]}])
+    >>> checkpoint.load('user')[0]['follow']
+    [1, 2]
+    >>> checkpoint.load('followings') is None
+    True
+    >>> shutil.rmtree(directory)
+
+    '''
+    def __init__(self, path, save_interval=LAYOUT_SAVE_INTERVAL):
+        '''Returns a LayoutCheckpoint object.'''
+        self.path = path
+        self.save_interval = save_interval
+        self.saved_at = None
+
+    def save(self, stream_with, streams):
+        '''Atomically replaces the checkpoint with a list of stream
+        dictionaries.'''
+        data = json.dumps({
+            'version': LAYOUT_VERSION,
+            'saved_at': time.time(),
+            'stream_with': stream_with,
+            'streams': streams,
+        })
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp = tempfile.mkstemp(prefix='.layout', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.saved_at = time.time()
+
+    def load(self, stream_with=None):
+        '''Returns the saved list of stream dictionaries, or None if there
+        is no usable checkpoint. A checkpoint saved for a different
+        stream_with value is ignored.'''
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logger.error("Ignoring unreadable layout checkpoint %s."
+                         % self.path, exc_info=True)
+            return None
+
+        if data.get('version') != LAYOUT_VERSION:
+            logger.warning("Ignoring layout checkpoint %s with version %s."
+                           % (self.path, data.get('version')))
+            return None
+        if stream_with is not None and data.get('stream_with') != stream_with:
+            logger.warning("Ignoring layout checkpoint %s saved for "
+                           "stream_with=%s." % (self.path,
+                                                data.get('stream_with')))
+            return None
+        return data['streams']
+
+    def due(self):
+        '''Returns True if save_interval seconds have passed since the last
+        save.'''
+        return self.saved_at is None or \
+            time.time() - self.saved_at >= self.save_interval
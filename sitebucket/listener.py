@@ -1,15 +1,27 @@
 import httplib
+import hmac
+import hashlib
+import binascii
+import socket
 from socket import timeout
 from ssl import SSLError
 import urllib
+import random
+import re
 import time
 import collections
+import itertools
+import threading
 import logging
 import oauth2 as oauth
 import simplejson as json
 
 from parser import DefaultParser, BaseParser
+from follow import FollowSet
+from compression import StreamDecompressor, ACCEPT_ENCODING, WBITS
 from error import SitebucketError
+from util import Frame, grouper
+from profiling import thread_time
 
 logger = logging.getLogger("sitebucket")
 
@@ -20,9 +32,34 @@ TIMEOUT = 40.0
 RETRY_LIMIT = 10
 RETRY_TIME = 2.0
 METHOD = 'GET'
+# The oauth_body_hash python-oauth2 signs for a request without a body.
+EMPTY_BODY_HASH = '2jmj7l5rSw0yVb/vlWAYkK/YBwk='
 
 ALLOWED_STREAM_WITH = ('user', 'followings')
 FOLLOW_LIMIT = 100
+CONTROL_BATCH_SIZE = 100
+CONTROL_URI_RE = re.compile(r'"control_uri"\s*:\s*"([^"]+)"')
+READ_SIZE = 8192
+
+# python-oauth2's generate_nonce creates a SystemRandom per digit.
+_random = random.SystemRandom()
+
+# Source of process-wide unique stream ids.
+_stream_ids = itertools.count(1)
+_stream_ids_lock = threading.Lock()
+
+def reserve_stream_id(stream_id):
+    '''Makes sure streams created from now on get ids above stream_id, so a
+    restored stream id is never handed out again.
+    
+    >>> reserve_stream_id(1000)
+    >>> SiteStream([1], consumer, token).stream_id > 1000
+    True
+    
+    '''
+    global _stream_ids
+    with _stream_ids_lock:
+        _stream_ids = itertools.count(max(next(_stream_ids), stream_id + 1))
 
 
 class SiteStream(object):
@@ -31,11 +68,25 @@ class SiteStream(object):
     
     Keyword arguments:
     
-    * follow -- a list of users that have authenticated your app to follow
+    * follow -- an iterable of users that have authenticated your app to follow. It is stored as a FollowSet.
     * stream_with -- 'user' or 'followings'. A value of 'user' will cause the stream to only return data about actions the users specified in follow take. A value of 'followings' will cause the Stream object to return data about the user's followings (basically their home timeline). This defaults to 'user'.
     * consumer -- a python-oauth2 Consumer object for the app
     * token -- a python-oauth2 Token object for the app's owner account.
     * parser -- an object that extends BaseParser that will handle data returned by the stream.
+    * instrumentation -- (optional) a profiling.Instrumentation object that records read, frame and parse timings and the stream thread's CPU time, and logs slow messages.
+    * lag -- (optional) a lag.LagTracker that records each message's delivery and processing lag once it has been parsed.
+    * stream_id -- (optional) the stream's id. Streams are numbered automatically; pass an id to restore a stream saved by a layout.LayoutCheckpoint.
+    * compression -- (optional) if True, the stream asks Twitter for gzip or deflate compressed output and decompresses it incrementally as it is read. Compressed streams use a fraction of the bandwidth and read far fewer bytes per message.
+    * tier -- (optional) the priority tier of the stream's users. ListenThreadMonitor sets this when it places users by tier.
+    
+    Every stream has a process-wide unique stream_id that is included in
+    log messages. Once connected, the stream's control_uri is set from the
+    control message Twitter sends first, and users can be added to or
+    removed from the running stream with add_users and remove_users.
+    
+    The stream counts the bytes it reads off the connection in
+    bytes_received and the bytes of messages it frames in
+    bytes_decompressed. The two only differ for compressed streams.
     
     To use, first import SiteStream and oauth2:
     
@@ -53,29 +104,61 @@ class SiteStream(object):
     
     '''
     def __init__(self, follow, consumer, token, stream_with="user",
-                 parser=DefaultParser()):
+                 parser=None, instrumentation=None, lag=None,
+                 stream_id=None, compression=False, tier=None):
         '''Returns a SiteStream object.'''
         # Make sure follow is iterable.
         if not isinstance(follow, collections.Iterable):
             follow = [follow]
         
-        follow.sort()
-        self.follow = follow
+        self._signing = None
+        self.follow = FollowSet(follow)
         self.stream_with = stream_with
         self.consumer = consumer
         self.token = token
         self.host = SITE_STREAM_HOST
-        self.parser = parser
+        self.parser = parser if parser is not None else DefaultParser()
+        self.instrumentation = instrumentation
+        self.lag = lag
+        if stream_id is None:
+            with _stream_ids_lock:
+                stream_id = next(_stream_ids)
+        else:
+            reserve_stream_id(stream_id)
+        self.stream_id = stream_id
+        self.compression = compression
+        self.tier = tier
+        self.decompressor = None
+        self.bytes_received = 0
+        self.bytes_decompressed = 0
         
         self.running = False
         self.disconnect_issued = False
         self.initialized = False
         self._last_request = None
+        self.control_uri = None
+        self._last_frame_end = None
+        # The thread and its CPU time when CPU time was last sampled, and
+        # when it should be sampled next.
+        self._cpu_mark = None
+        self._cpu_sample_due = 0
         self.connection = None
+        self._sock = None
         self.reset_throttles()
         
         self.__check_params()
     
+    @property
+    def follow(self):
+        '''The FollowSet of users the stream follows. Assigning a new follow
+        set invalidates the cached signing pieces.'''
+        return self._follow
+    
+    @follow.setter
+    def follow(self, follow):
+        self._follow = follow
+        self._signing = None
+    
     @property
     def url(self):
         ''' Returns the URL based on PROTOCOL, SITE_STREAM_HOST, and URI.
@@ -89,9 +172,10 @@ class SiteStream(object):
     
     @property
     def request(self):
-        ''' Returns an oauth2 request object to be used for connecting to the
-        streaming API endpoint. For debugging purposes, the returned request
-        object is cached in self._last_request.
+        ''' Returns an oauth2 request object for the streaming API endpoint
+        with its parameters signed into the URL. Streams connect with the
+        cheaper signed_request instead; this is kept for debugging, and the
+        returned request object is cached in self._last_request.
             
         >>> req = stream.request
         >>> print req.to_url() #doctest: +ELLIPSIS
@@ -112,9 +196,77 @@ class SiteStream(object):
             oauth.SignatureMethod_HMAC_SHA1(), self.consumer, self.token)
         
         self._last_request = request
-        logger.debug("OAuth Request Object Generated. %s" % request)
+        logger.debug("OAuth Request Object Generated. %s", request)
         return request
     
+    def __signing_pieces(self):
+        '''Returns the parts of a connection request that only change when
+        the follow set does: the query string, the signature base string
+        around the nonce and timestamp, a keyed HMAC to copy and the static
+        part of the Authorization header. They are built once and cached
+        until follow is reassigned.'''
+        if self._signing is None:
+            escape = oauth.escape
+            query = 'follow=%s&with=%s' % (
+                escape(','.join(map(str, self.follow))),
+                escape(self.stream_with))
+            consumer_key = escape(self.consumer.key)
+            token_key = escape(self.token.key)
+            # Parameters sort as follow, oauth_*, with, so the base string
+            # only varies in the nonce and timestamp.
+            base = (
+                '%s&%s&%s' % (METHOD, escape(self.url), escape(
+                    'follow=%s&oauth_body_hash=%s&oauth_consumer_key=%s'
+                    '&oauth_nonce=' % (query[len('follow='):query.index('&')],
+                                       escape(EMPTY_BODY_HASH),
+                                       consumer_key))),
+                escape('&oauth_signature_method=HMAC-SHA1&oauth_timestamp='),
+                escape('&oauth_token=%s&oauth_version=1.0&with=%s' % (
+                    token_key, escape(self.stream_with))),
+            )
+            key = '%s&%s' % (escape(self.consumer.secret),
+                             escape(self.token.secret))
+            header = ('OAuth realm="", oauth_consumer_key="%s", '
+                      'oauth_token="%s", oauth_version="1.0", '
+                      'oauth_signature_method="HMAC-SHA1", '
+                      'oauth_body_hash="%s"' % (consumer_key, token_key,
+                                                escape(EMPTY_BODY_HASH)))
+            self._signing = ('%s?%s' % (URI, query), base,
+                             hmac.new(key, digestmod=hashlib.sha1), header)
+        return self._signing
+    
+    def signed_request(self, nonce=None, timestamp=None):
+        '''Returns the path and headers of a signed connection request. The
+        OAuth credentials are sent in an Authorization header, leaving only
+        the follow and with parameters in the path. The follow string and
+        the static parts of the signature are cached, so signing a request
+        only hashes the base string once.
+        
+        >>> path, headers = stream.signed_request('1234', 1300000000)
+        >>> path
+        '/2b/site.json?follow=1%2C2%2C3&with=user'
+        >>> print headers['Authorization'] #doctest: +ELLIPSIS
+        OAuth realm="", ..., oauth_nonce="1234", oauth_timestamp="1300000000", oauth_signature="..."
+        
+        '''
+        if nonce is None:
+            nonce = str(_random.getrandbits(64))
+        if timestamp is None:
+            timestamp = int(time.time())
+        path, (prefix, middle, suffix), signer, header = \
+            self.__signing_pieces()
+        
+        signer = signer.copy()
+        signer.update('%s%s%s%s%s' % (prefix, nonce, middle, timestamp, suffix))
+        signature = oauth.escape(binascii.b2a_base64(signer.digest())[:-1])
+        headers = {'Authorization':
+                   '%s, oauth_nonce="%s", oauth_timestamp="%s", '
+                   'oauth_signature="%s"' % (header, nonce, timestamp,
+                                             signature)}
+        logger.debug("Stream %s signed a request for %s users.",
+                      self.stream_id, len(self.follow))
+        return path, headers
+    
     @property
     def retry_ok(self):
         '''Returns True or False based on whether or not this SiteStream 
@@ -190,7 +342,7 @@ class SiteStream(object):
                 resp = self.connection.getresponse()
                 ready = True
                 if resp.status != 200:
-                    logger.error("Connection attempt yielded error response: %s" % resp.status)
+                    logger.error("Connection attempt yielded error response: %s", resp.status)
                     resp = None
                     break
                 else:
@@ -225,12 +377,7 @@ class SiteStream(object):
         while self.running and not self.disconnect_issued and resp \
               and not resp.isclosed() and self.retry_ok:
             try:
-                data = ''
-                while not self.disconnect_issued:
-                    data += resp.read(1)
-                    if data.endswith('\r\n'):
-                        self.on_receive(data)
-                        data = ''
+                self.__read_frames(resp)
             except (timeout, SSLError):
                 logger.error("Connection timed out during read loop.")
                 self.sleep()
@@ -244,8 +391,52 @@ class SiteStream(object):
             logger.info("Disconnect issued. Exiting read loop.")
             return None
         
-        return self.listen()
+        if not self.retry_ok:
+            logger.error("Retry limit reached. Exiting read loop.")
+            return None
         
+        return self.listen()
+    
+    def __read_frames(self, resp):
+        '''Reads data from the response in blocks until a disconnect is
+        issued, decompressing it incrementally if the stream is compressed,
+        and passes each complete message to on_receive.'''
+        decompressor = self.decompressor
+        data = ''
+        while not self.disconnect_issued:
+            chunk = self.__read_available(resp)
+            self.bytes_received += len(chunk)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+                if not chunk:
+                    continue
+            self.bytes_decompressed += len(chunk)
+            data += chunk
+            if '\n' in chunk and '\r\n' in data:
+                messages = data.split('\r\n')
+                data = messages.pop()
+                for message in messages:
+                    self.on_receive(message + '\r\n')
+    
+    def __read_available(self, resp):
+        '''Returns up to READ_SIZE bytes of what the server has sent, only
+        blocking until some data arrives. httplib's read(amt) waits for all
+        amt bytes, so reads stay within the current HTTP chunk, or go
+        straight to the socket when the response isn't chunked and httplib
+        doesn't buffer ahead. Falls back to reading a byte at a time.'''
+        if getattr(resp, 'chunked', False):
+            left = resp.chunk_left
+            if left:
+                return resp.read(min(left, READ_SIZE))
+            # Reads the next chunk's size line.
+            return resp.read(1)
+        
+        fp = getattr(resp, 'fp', None)
+        if fp is not None and getattr(resp, 'length', 0) is None \
+           and getattr(fp, '_rbufsize', None) == 1:
+            return fp._sock.recv(READ_SIZE)
+        return resp.read(1)
+    
     def connect(self):
         ''' Repeatedly attempts to connect to the streaming server until
         either the failure conditions are met or a successful connection
@@ -255,7 +446,9 @@ class SiteStream(object):
         >>> stream.connect() #doctest: +SKIP
         
         '''
+        self.initialized = True
         while not self.running and self.retry_ok and not self.disconnect_issued:
+            self.control_uri = None
             try:
                 if PROTOCOL == "http://":
                     self.connection = httplib.HTTPConnection(self.host)
@@ -263,10 +456,19 @@ class SiteStream(object):
                     self.connection = httplib.HTTPSConnection(self.host)
                 self.connection.connect()
                 self.connection.sock.settimeout(self.timeout)
-                self.connection.request('GET', self.request.to_url())
+                # httplib closes the connection's socket object once the
+                # response owns it, which detaches it from the OS socket the
+                # response keeps reading. Keep the OS socket for disconnect.
+                sock = self.connection.sock
+                self._sock = getattr(sock, '_sock', sock)
+                path, headers = self.signed_request()
+                if self.compression:
+                    headers['Accept-Encoding'] = ACCEPT_ENCODING
+                self.connection.request(METHOD, path, headers=headers)
                 resp = self.__wait_for_response()
                 
                 if resp:
+                    self.__start_decompressor(resp)
                     break
             except (timeout, SSLError):
                 logger.error("Connection attempt timed out.")
@@ -286,6 +488,17 @@ class SiteStream(object):
         
         return resp
     
+    def __start_decompressor(self, resp):
+        '''Creates a decompressor for the response if it is compressed.'''
+        self.decompressor = None
+        if not self.compression:
+            return
+        encoding = resp.getheader('content-encoding', '').strip().lower()
+        if encoding in WBITS:
+            self.decompressor = StreamDecompressor(encoding)
+            logger.debug("Stream %s is %s compressed.", self.stream_id,
+                         encoding)
+    
     def reset_throttles(self):
         ''' Resets all stream throttles, flags, and buffers to their default
         value. This can be used to prepare a SiteStream object for a 
@@ -341,7 +554,7 @@ class SiteStream(object):
             self.connection.close()
         
         if stime is None:
-            logger.info("Stream sleeping for %s" % self.retry_time)
+            logger.info("Stream sleeping for %s", self.retry_time)
             time.sleep(self.retry_time)
             self.retry_time *= self.retry_time
         else:
@@ -349,9 +562,9 @@ class SiteStream(object):
             
     def disconnect(self):
         ''' This method sets flags that will cause the stream processing loops
-        to terminate. However, since the listen method blocks, this method
-        will need to be called from another thread to terminate the
-        connection if listen is still running.
+        to terminate and shuts down the connection's socket, which wakes a
+        listen call blocked reading it in another thread immediately instead
+        of after the read times out.
         
         >>> stream.disconnect()
         >>> stream.disconnect_issued
@@ -362,12 +575,101 @@ class SiteStream(object):
         '''
         logger.debug('Disconnect request received.')
         self.disconnect_issued = True
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
         self.sleep(stime=0, update_error_count=False, close_connection=True)
     
+    @property
+    def ready(self):
+        '''Returns True if the stream is connected and has received its
+        control URI.
+        
+        >>> control_stream = SiteStream([1], consumer, token)
+        >>> control_stream.on_receive('{"control":{"control_uri":"/1.1/site/c/1"}}\\r\\n')
+        >>> control_stream.control_uri
+        '/1.1/site/c/1'
+        >>> control_stream.ready
+        False
+        
+        '''
+        return self.running and self.control_uri is not None
+    
+    def add_users(self, follow):
+        '''Adds users to the running stream through its control URI, so
+        their messages start arriving without reconnecting. Raises a
+        SitebucketError if the stream isn't ready, the users would exceed
+        FOLLOW_LIMIT or Twitter rejects the request.
+        
+        * follow -- an iterable of users to add
+        
+        '''
+        follow = FollowSet(follow) - self.follow
+        if len(self.follow) + len(follow) > FOLLOW_LIMIT:
+            raise SitebucketError('Adding %s users would exceed the follow '
+                                  'limit: %s.' % (len(follow), FOLLOW_LIMIT))
+        for users in grouper(CONTROL_BATCH_SIZE, follow):
+            self.__control('add_user.json', users)
+            self.follow = self.follow | users
+    
+    def remove_users(self, follow):
+        '''Removes users from the running stream through its control URI.
+        Raises a SitebucketError if the stream isn't ready or Twitter
+        rejects the request.
+        
+        * follow -- an iterable of users to remove
+        
+        '''
+        follow = FollowSet(follow) & self.follow
+        for users in grouper(CONTROL_BATCH_SIZE, follow):
+            self.__control('remove_user.json', users)
+            self.follow = self.follow - users
+    
+    def __control(self, method, users):
+        '''POSTs a control stream request for the specified users.'''
+        if not self.ready:
+            raise SitebucketError('Stream %s is not ready for control '
+                                  'requests.' % self.stream_id)
+        
+        url = "%s%s%s/%s" % (PROTOCOL, self.host, self.control_uri, method)
+        parameters = {
+            'oauth_version': "1.0",
+            'oauth_nonce': oauth.generate_nonce(),
+            'oauth_timestamp': int(time.time()),
+            'user_id': ','.join(map(str, users)),
+            'oauth_token': self.token.key,
+            'oauth_consumer_key': self.consumer.key
+        }
+        request = oauth.Request('POST', url, parameters=parameters)
+        request.sign_request(
+            oauth.SignatureMethod_HMAC_SHA1(), self.consumer, self.token)
+        
+        if PROTOCOL == "http://":
+            connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPSConnection(self.host,
+                                                 timeout=self.timeout)
+        try:
+            connection.request('POST', "%s/%s" % (self.control_uri, method),
+                               request.to_postdata(), {'Content-Type':
+                               'application/x-www-form-urlencoded'})
+            status = connection.getresponse().status
+        finally:
+            connection.close()
+        
+        if status != 200:
+            raise SitebucketError('Control request %s for stream %s failed '
+                                  'with status %s.' % (method, self.stream_id,
+                                                       status))
+    
     def on_receive(self, data):
         '''When a complete message is received from the stream (json 
         terminated by \\\\r\\\\n), on_receive passes the data to the parser
-        object's parse method and clears the buffer.
+        object's parse method and clears the buffer. The message is passed
+        as a Frame stamped with the time it was received and the stream's id.
         
         If we have a custom parser defined like so:
         
@@ -385,5 +687,44 @@ class SiteStream(object):
         '''
         self.buffer += data
         if data.endswith("\r\n") and self.buffer.strip():
-            self.parser.parse(self.buffer)
+            frame = Frame(self.buffer, time.time(), self.stream_id)
+            if self.control_uri is None:
+                match = CONTROL_URI_RE.search(frame, 0, 200)
+                if match:
+                    self.control_uri = match.group(1)
+                    logger.debug("Stream %s control URI: %s",
+                                 self.stream_id, self.control_uri)
+            if self.instrumentation is None:
+                self.parser.parse(frame)
+            else:
+                self.__parse_instrumented(frame)
+            if self.lag is not None:
+                self.lag.observe(frame)
             self.buffer = ''
+    
+    def __parse_instrumented(self, token):
+        '''Parses a message and records its read, frame and parse timings.
+        Samples the thread's CPU time at most every cpu_interval seconds.'''
+        start = time.time()
+        received_at = token.received_at
+        read_time = received_at - (self._last_frame_end or received_at)
+        try:
+            self.parser.parse(token)
+        finally:
+            self._last_frame_end = end = time.time()
+            self.instrumentation.message(self.stream_id, token, read_time,
+                                         end - start, start - received_at)
+            if end >= self._cpu_sample_due and thread_time is not None:
+                self.__sample_cpu(end)
+    
+    def __sample_cpu(self, now):
+        '''Records the CPU time the stream's thread has used since the last
+        sample. Every message the stream reads is read, framed and parsed
+        on its thread, so the thread's CPU time is the stream's.'''
+        thread, cpu = threading.current_thread(), thread_time()
+        # A restarted stream runs on a new thread, whose CPU clock can't be
+        # compared with the old one's.
+        if self._cpu_mark is not None and self._cpu_mark[0] is thread:
+            self.instrumentation.cpu(self.stream_id, cpu - self._cpu_mark[1])
+        self._cpu_mark = (thread, cpu)
+        self._cpu_sample_due = now + self.instrumentation.cpu_interval
@@ -0,0 +1,181 @@
+import re
+import simplejson as json
+from simplejson.decoder import scanstring
+
+from util import MESSAGE_RE, find_object_end
+
+NESTED_RE = re.compile(r'[{\[]')
+NUMBER_RE = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?')
+CONSTANTS = {'t': ('true', True), 'f': ('false', False), 'n': ('null', None)}
+
+# Marks a field that couldn't be found without decoding.
+_MISSING = object()
+
+# Compiled patterns that find a key, keyed by key.
+_key_patterns = {}
+
+def _key_re(key):
+    pattern = _key_patterns.get(key)
+    if pattern is None:
+        pattern = _key_patterns[key] = re.compile(
+            r'"%s"\s*:\s*' % re.escape(key))
+    return pattern
+
+
+class LazyObject(object):
+    '''A read-only JSON object backed by its raw text. Fields that come
+    before the object's first nested object or array, like a tweet's id
+    and text or an envelope's for_user, are read straight from the raw
+    text. The whole object is only decoded when any other field is first
+    accessed. LazyObjects use __slots__, so an undecoded object costs
+    little more than its raw text.
+
+    LazyObjects support the parts of the dictionary interface parsers
+    normally use: [], get, in and keys.
+
+    >>> tweet = LazyObject('{"id":1,"text":"caf\\\\u00e9","user":{"id":2}}')
+    >>> tweet['id'], tweet['text']
+    (1, u'caf\\xe9')
+    >>> tweet.is_decoded
+    False
+    >>> tweet['user']['id']
+    2
+    >>> tweet.is_decoded
+    True
+    >>> 'geo' in tweet
+    False
+
+    '''
+    __slots__ = ('raw', '_fields', '_decoded', '_boundary')
+
+    def __init__(self, raw):
+        '''Returns a LazyObject for the raw text of a JSON object.'''
+        self.raw = raw
+        self._fields = None
+        self._decoded = None
+        self._boundary = None
+
+    @property
+    def decoded(self):
+        '''Returns the object decoded as a dictionary.'''
+        if self._decoded is None:
+            self._decoded = json.loads(self.raw)
+            self._fields = None
+        return self._decoded
+
+    @property
+    def is_decoded(self):
+        return self._decoded is not None
+
+    def _boundary_index(self):
+        '''Returns the index of the first nested object or array.'''
+        if self._boundary is None:
+            raw = self.raw
+            nested = NESTED_RE.search(raw, raw.find('{') + 1)
+            self._boundary = nested.start() if nested else len(raw)
+        return self._boundary
+
+    def _scan(self, key):
+        '''Returns the value of a scalar field that comes before the first
+        nested value, or _MISSING.'''
+        raw = self.raw
+        pattern = _key_patterns.get(key) or _key_re(key)
+        # A nested value can't start before the boundary, so a match that
+        # ends before it is one of the object's own fields.
+        match = pattern.search(raw, 0, self._boundary or
+                               self._boundary_index())
+        if match is None:
+            return _MISSING
+
+        index = match.end()
+        first = raw[index]
+        if first == '"':
+            return scanstring(raw, index + 1)[0]
+        if first in CONSTANTS:
+            text, value = CONSTANTS[first]
+            if raw.startswith(text, index):
+                return value
+            return _MISSING
+        number = NUMBER_RE.match(raw, index)
+        if number is None:
+            return _MISSING
+        if number.group(1) or number.group(2):
+            return float(number.group())
+        return int(number.group())
+
+    def get(self, key, default=None):
+        '''Returns a field's value, or default if the object doesn't have
+        the field.'''
+        if self._decoded is not None:
+            return self._decoded.get(key, default)
+        fields = self._fields
+        if fields is not None and key in fields:
+            return fields[key]
+
+        value = self._scan(key)
+        if value is _MISSING:
+            return self.decoded.get(key, default)
+        if fields is None:
+            fields = self._fields = {}
+        fields[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def keys(self):
+        return self.decoded.keys()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.raw.strip())
+
+
+class Message(LazyObject):
+    '''A site stream message backed by its raw frame. The envelope's
+    for_user id is read from the raw text, and the message itself is a
+    LazyObject that isn't decoded until one of its nested fields is
+    accessed. Pass lazy=True to a DefaultParser to have it handle Messages
+    instead of dictionaries.
+
+    >>> message = Message('{"for_user":1,"message":{"id":5,"text":"hi!",'
+    ...                   '"user":{"screen_name":"someone"}}}\\r\\n')
+    >>> message['for_user'], message['message']['text']
+    (1, 'hi!')
+    >>> message['message'].is_decoded
+    False
+    >>> message['message']['user']['screen_name']
+    'someone'
+    >>> Message('{"friends":[1,2]}')['friends']
+    [1, 2]
+
+    '''
+    __slots__ = ()
+
+    def _scan(self, key):
+        '''Returns the message field as a LazyObject if it is the envelope's
+        first nested value, otherwise scans for a scalar field. Fields after
+        the message are found by decoding the envelope.
+
+        >>> message = Message('{"for_user":1,"message":{"text":"}"},"x":2}')
+        >>> message['message'].raw, message['x']
+        ('{"text":"}"}', 2)
+
+        '''
+        if key != 'message':
+            return super(Message, self)._scan(key)
+
+        raw = self.raw
+        boundary = self._boundary_index()
+        match = MESSAGE_RE.search(raw, 0, boundary)
+        if match is None or match.end() != boundary:
+            return _MISSING
+        end = find_object_end(raw, boundary)
+        if end is None:
+            return _MISSING
+        return LazyObject(raw[boundary:end])
@@ -1,12 +1,23 @@
 import threading
 import collections
+import itertools
 import time
 import logging
 
 from listener import SiteStream, FOLLOW_LIMIT
+from error import SitebucketError
 from thread import ListenThread
-from util import grouper
+from util import grouper, remaining
 from parser import DefaultParser
+from follow import FollowSet
+from cache import CachingParser
+from traffic import RateTracker, TrafficParser, pack
+from dispatch import LaneDispatcher
+from shaping import ShapingParser
+from profiling import SamplingProfiler, SAMPLE_INTERVAL, TOP_STREAMS, \
+    parser_chain
+from startup import DEFAULT_TIER
+from clock import SYSTEM_CLOCK
 
 logger = logging.getLogger("sitebucket")
 
@@ -14,6 +25,11 @@ NONFULL_STREAM_LIMIT = 10
 RESTART_DEAD_STREAMS = True
 MONITOR_SLEEP_INTERVAL = 10
 CONSOLIDATE_SLEEP_INTERVAL = 30
+REBALANCE_CONNECT_TIMEOUT = 60
+REBALANCE_COOLDOWN = 600
+HOT_USER_FRACTION = .25
+SHUTDOWN_DEADLINE = 30
+PRIORITY_STREAM_SIZE = 25
 
 class ListenThreadMonitor(threading.Thread):
     '''The ListenThreadMonitor takes a follow list of any size, creates
@@ -23,11 +39,32 @@ class ListenThreadMonitor(threading.Thread):
     
     Keyword arguments:
     
-    * follow -- a list of users that have authenticated your app to follow
+    * follow -- an iterable of users that have authenticated your app to follow. It is stored as a FollowSet, so a generator or FollowSet.from_file can be used for very large follow lists.
     * stream_with -- 'user' or 'followings'. A value of 'user' will cause the stream to only return data about actions the users specified in follow take. A value of 'followings' will cause the Stream object to return data about the user's followings (basically their home timeline). This defaults to 'user'.
     * consumer -- a python-oauth2 Consumer object for the app
     * token -- a python-oauth2 Token object for the app's owner account.
     * parser -- an object that extends BaseParser that will handle data returned by the stream.
+    * startup -- (optional) a StartupScheduler that starts the monitor's threads in waves. By default, every thread is started at once.
+    * stream_budget -- (optional) the maximum number of bytes per second a single stream should receive. When set, the monitor tracks every user's traffic and moves hot users onto other streams whenever a stream exceeds the budget.
+    * decode_cache -- (optional) a DecodeCache shared by every stream. When set, parser must be a DefaultParser and is wrapped in a CachingParser so that tweets delivered to several users are only decoded once. If parser is a LaneDispatcher, the DefaultParser it wraps is wrapped instead, so messages are decoded in the lanes. This is most useful with stream_with='followings'.
+    * instrumentation -- (optional) a profiling.Instrumentation object shared by every stream that records read, decode and parse timings and logs slow messages. It also totals every stream's CPU and wall time, which heavy_streams reports.
+    * standby -- (optional) the number of warm standby streams to keep connected. Standby streams connect without any users and wait, authenticated, for a failed stream's users to be moved onto them through their control URI, so a failed stream recovers without waiting for a new connection. Defaults to 0.
+    * layout -- (optional) a layout.LayoutCheckpoint. When set, the monitor restores the stream layout it saved last time (the same users on the same streams, with the same stream ids and backoff state) instead of regrouping the follow list, and checkpoints its layout as it changes. Users that aren't in the saved layout are grouped as usual.
+    * compression -- (optional) if True, every stream requests gzip or deflate compressed output and decompresses it as it is read. The bandwidth property reports the bytes received and decompressed.
+    * tiers -- (optional) a dictionary mapping user ids to priority tiers, as used by StartupScheduler. Lower tiers are more important, and users that aren't listed are in DEFAULT_TIER. Users can also be given a tier when they are added with add_follows.
+    * lag -- (optional) a lag.LagTracker shared by every stream that records delivery lag (tweet creation to receipt) per stream and in total, and processing lag (receipt to parse completion). If parser is a LaneDispatcher, lag is recorded by its lane workers.
+    * clock -- (optional) a clock.Clock that the monitor's loop gets the time from and sleeps and waits with. Pass a clock.VirtualClock to run the monitor in simulated time. Defaults to the system clock.
+    
+    Users in a tier below DEFAULT_TIER are placed on dedicated streams of
+    their own tier with at most PRIORITY_STREAM_SIZE users each, so a
+    priority stream carries little traffic and a failure affects few
+    users. Unhealthy priority streams are restarted first, the startup
+    scheduler starts them first, any LaneDispatcher in the parser chain
+    parses their messages ahead of queued messages from lower tiers, and a
+    LagTracker records lag per tier.
+    
+    Streams are created as stream_class objects wrapped in thread_class
+    threads. simulation.SimulatedMonitor replaces them with in-memory fakes.
     
     The monitor's run method blocks, so invoke it via start method if you want
     to run it in a separate thread.
@@ -55,31 +92,117 @@ class ListenThreadMonitor(threading.Thread):
     
     >>> monitor.start() #doctest: +SKIP
     
+    To share decoded tweets between streams, pass a DecodeCache:
+    
+    >>> from sitebucket.cache import DecodeCache
+    >>> monitor = ListenThreadMonitor([1,2,3], consumer, token,
+    ...                               stream_with='followings',
+    ...                               decode_cache=DecodeCache())
+    >>> monitor.threads[0].stream.parser is monitor.parser
+    True
+    
     It can be killed later via the disconnect method:
     
     >>> monitor.disconnect()
     
     '''
+    stream_class = SiteStream
+    thread_class = ListenThread
+    
     def __init__(self, follow, consumer, token, stream_with="user",
-                 parser=DefaultParser(), *args, **kwargs):
+                 parser=None, startup=None, decode_cache=None,
+                 stream_budget=None, instrumentation=None, lag=None,
+                 standby=0, layout=None, compression=False, tiers=None,
+                 clock=None, *args, **kwargs):
         '''Returns a ListenThreadMonitor object. Parameters are identical to
         the SiteStream object.'''
         # Make sure follow is iterable.
         if not isinstance(follow, collections.Iterable):
             follow = [follow]
-        follow.sort()
         
-        self.follow = follow
+        self.follow = FollowSet(follow)
         self.consumer = consumer
         self.token = token
         self.stream_with = stream_with
+        self.clock = clock or SYSTEM_CLOCK
+        # Each monitor gets its own DefaultParser, since instrumentation
+        # below is set on the parser.
+        if parser is None:
+            parser = DefaultParser()
+        if decode_cache is not None:
+            if isinstance(parser, LaneDispatcher):
+                parser.parser = CachingParser(parser.parser, decode_cache)
+            else:
+                parser = CachingParser(parser, decode_cache)
+        
+        self.traffic = None
+        if stream_budget is not None:
+            self.traffic = RateTracker()
+            parser = TrafficParser(parser, self.traffic)
+        
         self.parser = parser
-        self.threads = self.__create_thread_objects(follow, stream_with)
+        self.startup = startup
+        self.compression = compression
+        self.tiers = dict(tiers or {})
+        if startup is not None:
+            # Share one mapping so users added later are started in order.
+            self.tiers = dict(startup.tiers)
+            self.tiers.update(tiers or {})
+            startup.tiers = self.tiers
+            startup.clock = self.clock
+        self.__prioritize_lanes()
+        self.decode_cache = decode_cache
+        self.stream_budget = stream_budget
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            for x in parser_chain(parser):
+                if isinstance(x, DefaultParser):
+                    x.instrumentation = instrumentation
+        
+        # Lag is recorded wherever parsing completes: by the lane workers
+        # if messages are dispatched, otherwise by the streams.
+        self.lag = lag
+        self._stream_lag = lag
+        if lag is not None:
+            for x in parser_chain(parser):
+                if isinstance(x, LaneDispatcher):
+                    x.lag = lag
+                    self._stream_lag = None
+        
+        self.layout = layout
+        self._saved_layout = None
+        saved = layout.load(stream_with) if layout is not None else None
+        if saved:
+            self.threads = self.__restore_threads(saved)
+        else:
+            self.threads = self.__create_thread_objects(self.follow,
+                                                        stream_with)
+        self.standby = standby
+        self.standby_threads = []
+        # Rebalances waiting for their replacements to connect, as
+        # (old threads, new threads, deadline), and the time each stream
+        # last failed to be rebalanced.
+        self.rebalancing = []
+        self.rebalance_failures = {}
         self.disconnect_issued = False
         self.running = False
+        self._wake = threading.Event()
         
         super(ListenThreadMonitor, self).__init__(*args, **kwargs)
     
+    def __prioritize_lanes(self):
+        '''Prioritizes any LaneDispatcher in the parser chain by tier, once
+        there are tiers.'''
+        if not self.tiers:
+            return
+        for x in parser_chain(self.parser):
+            if isinstance(x, LaneDispatcher) and x.tiers is not self.tiers:
+                try:
+                    x.prioritize(self.tiers)
+                except SitebucketError:
+                    logger.warning("LaneDispatcher has already started. "
+                                   "Its lanes won't be prioritized.")
+    
     def __create_thread_objects(self, follow, stream_with):
         '''Split the specified follow list into groups of CONNECTION_LIMIT
         or smaller and then create ListenThread objects for those groups.
@@ -91,18 +214,136 @@ class ListenThreadMonitor(threading.Thread):
         
         '''
         threads = []
-        chunks = list(grouper(FOLLOW_LIMIT, follow))
         
-        for follow in chunks:
-            stream = SiteStream(follow, self.consumer, self.token,
-                                stream_with, self.parser)
-            thread = ListenThread(stream)
-            thread.daemon = True
-            threads.append(thread)
+        for tier, follow, limit in self.__split_tiers(follow):
+            if self.traffic:
+                chunks = pack(FollowSet(follow), self.traffic.rates(),
+                              self.stream_budget, limit)
+            else:
+                chunks = list(grouper(limit, follow))
+            
+            for chunk in chunks:
+                threads.append(self.__create_thread(chunk, stream_with,
+                                                    tier=tier))
         
         logger.debug("Created %s new thread objects." % len(threads))
         return threads
     
+    def __split_tiers(self, follow):
+        '''Splits a follow list into (tier, follow, users per stream)
+        groups, most important tier first.'''
+        if not self.tiers:
+            return [(DEFAULT_TIER, follow, FOLLOW_LIMIT)]
+        
+        follow = FollowSet(follow)
+        priority = collections.defaultdict(list)
+        for user in follow & FollowSet(self.tiers):
+            tier = self.tiers[user]
+            if tier < DEFAULT_TIER:
+                priority[tier].append(user)
+        
+        groups = [(tier, FollowSet(users), PRIORITY_STREAM_SIZE)
+                  for tier, users in sorted(priority.items())]
+        placed = FollowSet(itertools.chain(*priority.values()))
+        groups.append((DEFAULT_TIER, follow - placed, FOLLOW_LIMIT))
+        return groups
+    
+    def tier(self, user):
+        '''Returns a user's priority tier.
+        
+        >>> monitor = ListenThreadMonitor([1, 2], consumer, token,
+        ...                               tiers={1: 0})
+        >>> monitor.tier(1), monitor.tier(2)
+        (0, 100)
+        
+        '''
+        return self.tiers.get(user, DEFAULT_TIER)
+    
+    def __create_thread(self, follow, stream_with, stream_id=None,
+                        tier=DEFAULT_TIER):
+        '''Creates a daemon ListenThread for a single stream.'''
+        stream = self.stream_class(follow, self.consumer, self.token,
+                                   stream_with, self.parser,
+                                   self.instrumentation, self._stream_lag,
+                                   stream_id, self.compression, tier)
+        if self.lag is not None:
+            self.lag.assign_tier(stream.stream_id, tier)
+        thread = self.thread_class(stream)
+        thread.daemon = True
+        return thread
+    
+    def __restore_threads(self, saved):
+        '''Creates threads for a saved layout. Saved users that are no
+        longer followed are dropped, and followed users that weren't saved
+        are grouped into new threads.'''
+        threads = []
+        placed = []
+        for entry in saved:
+            tier = entry.get('tier', DEFAULT_TIER)
+            follow = FollowSet(entry['follow']) & self.follow
+            if self.tiers:
+                # Users whose tier changed are placed again.
+                follow = FollowSet(x for x in follow if self.tier(x) == tier)
+            if not follow:
+                continue
+            try:
+                thread = self.__create_thread(follow, self.stream_with,
+                                              entry.get('stream_id'), tier)
+            except SitebucketError:
+                logger.error("Ignoring invalid saved stream %s."
+                             % entry.get('stream_id'), exc_info=True)
+                continue
+            thread.stream.error_count = entry.get('error_count', 0)
+            thread.stream.retry_time = entry.get('retry_time',
+                                                 thread.stream.retry_time)
+            threads.append(thread)
+            placed.extend(follow)
+        
+        missing = self.follow - FollowSet(placed)
+        threads.extend(self.__create_thread_objects(missing,
+                                                    self.stream_with))
+        logger.info("Restored %s streams from the saved layout. %s users "
+                    "were not in it." % (len(threads), len(missing)))
+        return threads
+    
+    def save_layout(self, force=False):
+        '''Checkpoints the stream layout if a layout checkpoint is set and
+        the streams have changed since the last save, save_interval seconds
+        have passed or force is True.
+        
+        >>> import tempfile, os, shutil
+        >>> from sitebucket.layout import LayoutCheckpoint
+        >>> directory = tempfile.mkdtemp()
+        >>> layout = LayoutCheckpoint(os.path.join(directory, 'layout.json'))
+        >>> monitor = ListenThreadMonitor(range(1, 151), consumer, token,
+        ...                               layout=layout)
+        >>> monitor.save_layout()
+        >>> restored = ListenThreadMonitor(range(1, 151), consumer, token,
+        ...                                layout=layout)
+        >>> [x.stream.stream_id for x in restored.threads] == \\
+        ...     [x.stream.stream_id for x in monitor.threads]
+        True
+        >>> shutil.rmtree(directory)
+        
+        '''
+        if self.layout is None:
+            return
+        
+        streams = [x.stream for x in self.threads]
+        layout = [x.stream_id for x in streams]
+        if not force and layout == self._saved_layout \
+           and not self.layout.due():
+            return
+        
+        self.layout.save(self.stream_with, [{
+            'stream_id': x.stream_id,
+            'follow': x.follow.tolist(),
+            'error_count': x.error_count,
+            'retry_time': x.retry_time,
+            'tier': x.tier,
+        } for x in streams])
+        self._saved_layout = layout
+    
     def run(self):
         '''Starts all threads and begins monitoring loop. Invoke this via
         the object's start method to run the monitor in a separate thread.
@@ -113,34 +354,101 @@ class ListenThreadMonitor(threading.Thread):
         '''
         if not self.disconnect_issued:
             logger.info("Starting threads...")
-            [thread.start() for thread in self.threads]
+            if self.startup:
+                self.startup.schedule(list(self.threads))
+            else:
+                [thread.start() for thread in self.threads]
         
+        # The startup scheduler ramps up between maintenance passes, so
+        # streams that are already running are maintained meanwhile.
+        next_pass = self.clock.time()
         while not self.disconnect_issued:
             self.running = True
             
-            if RESTART_DEAD_STREAMS:
-                self.restart_unhealthy_streams()
-            
-            if len(self.nonfull_streams) > NONFULL_STREAM_LIMIT:
-                self.consolidate_streams()
+            if self.startup is not None and self.startup.pending:
+                self.startup.step()
             
-            if self.disconnect_issued:
-                logger.info("Disconnect issued. Issuing shutdown requests to streams...")
-                while self.threads:
-                    thread = self.threads.pop()
-                    thread.close()
-                logger.info("Monitor terminating...")
-            else:
-                time.sleep(MONITOR_SLEEP_INTERVAL)
+            if self.clock.time() >= next_pass:
+                self.maintain()
+                next_pass = self.clock.time() + MONITOR_SLEEP_INTERVAL
             
+            if not self.disconnect_issued:
+                wait = next_pass - self.clock.time()
+                if self.startup is not None and self.startup.pending:
+                    wait = min(wait, self.startup.delay())
+                self.clock.wait(self._wake, max(wait, 0))
+        
+        logger.info("Disconnect issued. Issuing shutdown requests to streams...")
+        self.save_layout(force=True)
+        # Threads stay in the lists, so shutdown can join the threads of a
+        # pass that was still running when it was called.
+        replacements = [x for old, new, deadline in self.rebalancing
+                        for x in new]
+        for thread in list(self.threads) + list(self.standby_threads) \
+                + replacements:
+            thread.close()
+        logger.info("Monitor terminating...")
         self.running = False
     
-    def add_follows(self, follow, start=True):
+    def maintain(self):
+        '''Performs a single pass of the monitor's maintenance work: dead
+        streams are restarted (on a warm standby when one is ready), the
+        standby pool is refilled, nonfull streams are consolidated, deferred
+        messages are drained from any ShapingParser, the lag histograms
+        of closed streams are discarded and the layout is checkpointed. The
+        run loop invokes this once every MONITOR_SLEEP_INTERVAL seconds.
+        Extend this method to add work to the monitor loop.
+        
+        >>> monitor = ListenThreadMonitor([1, 2, 3], consumer, token)
+        >>> monitor.maintain()
+        
+        '''
+        if self.startup and not self.startup.complete:
+            self.startup.update()
+        
+        if RESTART_DEAD_STREAMS:
+            self.restart_unhealthy_streams()
+        
+        if self.standby:
+            self.fill_standby()
+        
+        if len(self.nonfull_streams) > NONFULL_STREAM_LIMIT:
+            self.consolidate_streams()
+        
+        if self.stream_budget is not None:
+            self.rebalance_streams()
+        
+        for x in parser_chain(self.parser):
+            if isinstance(x, ShapingParser) and x.spill:
+                x.drain()
+        
+        # Standby streams and pending replacements are kept too, so their
+        # tiers are still known once they take over.
+        stream_ids = [x.stream.stream_id for x in self.threads] + \
+            [x.stream.stream_id for x in self.standby_threads] + \
+            [x.stream.stream_id for old, new, deadline in self.rebalancing
+             for x in new]
+        if self.lag is not None:
+            self.lag.retain(stream_ids)
+        
+        if self.instrumentation is not None:
+            self.instrumentation.retain(stream_ids)
+        
+        self.save_layout()
+    
+    def add_follows(self, follow, start=True, tier=None):
         '''Creates and adds new ListenThreads based on a specified follow
         list. Optionally starts the new threads.
         
         * follow -- list of users to start following
         * start -- (default: True) If true, start running the new threads.
+        * tier -- (optional) the priority tier of the new users. Users in a tier below DEFAULT_TIER are placed on their own lightly loaded streams.
+        
+        >>> monitor = ListenThreadMonitor([], consumer, token)
+        >>> monitor.add_follows(range(1, 31), start=False, tier=0)
+        >>> monitor.add_follows(range(31, 41), start=False)
+        >>> [(x.stream.tier, len(x.stream.follow)) for x in monitor.threads]
+        [(0, 25), (0, 5), (100, 10)]
         
         >>> follow = range(1,FOLLOW_LIMIT*10+1)
         >>> monitor = ListenThreadMonitor([], consumer, token)
@@ -149,12 +457,98 @@ class ListenThreadMonitor(threading.Thread):
         True
         
         '''
+        follow = FollowSet(follow)
+        if tier is not None:
+            for user in follow:
+                self.tiers[user] = tier
+            self.__prioritize_lanes()
         threads = self.__create_thread_objects(follow, self.stream_with)
         
         if start:
             [thread.start() for thread in threads]
         
         self.threads.extend(threads)
+        self.follow = self.follow | follow
+    
+    def remove_follows(self, follow):
+        '''Stops following the users in the specified follow list. Ready
+        streams drop the users in place through their control URIs, and
+        streams that haven't started just forget them. Other running streams
+        are replaced by new threads following their remaining users, which
+        are started before the old threads are closed. Streams left with no
+        users are closed.
+        
+        * follow -- list of users to stop following
+        
+        >>> monitor = ListenThreadMonitor(range(1, 11), consumer, token)
+        >>> monitor.remove_follows([2, 3])
+        >>> monitor.follow
+        FollowSet([1, 4, 5, 6, 7, 8, 9, 10])
+        >>> sum(len(x.stream.follow) for x in monitor.threads)
+        8
+        
+        '''
+        remove = FollowSet(follow)
+        affected = [x for x in self.threads
+                    if self.__follows_any(x.stream.follow, remove)]
+        closed = []
+        replaced = []
+        for x in affected:
+            kept = x.stream.follow - remove
+            if not kept:
+                closed.append(x)
+            elif not self.running:
+                x.stream.follow = kept
+            elif not self.__remove_in_place(x.stream, remove):
+                replaced.append(x)
+        
+        kept = FollowSet(itertools.chain(
+            *[x.stream.follow - remove for x in replaced]))
+        if kept:
+            threads = self.__create_thread_objects(kept, self.stream_with)
+            if self.running:
+                [thread.start() for thread in threads]
+            self.threads.extend(threads)
+        
+        self.__remove_threads(closed + replaced)
+        for x in closed + replaced:
+            x.close()
+        
+        self.follow = self.follow - remove
+        if self.tiers:
+            for user in remove:
+                self.tiers.pop(user, None)
+        
+        logger.info("Stopped following %s users." % len(remove))
+    
+    @staticmethod
+    def __remove_in_place(stream, follow):
+        '''Removes users from a ready stream through its control URI.
+        Returns False if the stream has to be replaced instead.'''
+        if not getattr(stream, 'ready', False):
+            return False
+        try:
+            stream.remove_users(follow)
+        except Exception:
+            logger.error("Removing users from stream %s failed."
+                         % stream.stream_id, exc_info=True)
+            return False
+        return True
+    
+    @staticmethod
+    def __follows_any(follow, users):
+        '''Returns True if a FollowSet contains any of users, searching
+        the larger set for each member of the smaller one.'''
+        if len(users) < len(follow):
+            return any(user in follow for user in users)
+        return any(user in users for user in follow)
+    
+    def __remove_threads(self, threads):
+        '''Removes threads from the thread list in a single pass.'''
+        if not threads:
+            return
+        removed = set(id(x) for x in threads)
+        self.threads[:] = [x for x in self.threads if id(x) not in removed]
         
     def consolidate_streams(self):
         '''Find all streams that aren't following the maximum number of users
@@ -173,9 +567,9 @@ class ListenThreadMonitor(threading.Thread):
         '''
         logger.info("Attempting to minimize active stream connections.")
         nonfull_streams = self.nonfull_streams
-        # Create a list of all the users in nonfull_streams
-        follow = []
-        [follow.extend(x.stream.follow) for x in nonfull_streams]
+        # Create a set of all the users in nonfull_streams
+        follow = FollowSet(itertools.chain(
+            *[x.stream.follow for x in nonfull_streams]))
         
         consolidated_threads = \
             self.__create_thread_objects(follow, self.stream_with)
@@ -194,11 +588,11 @@ class ListenThreadMonitor(threading.Thread):
         # and wait for them to start receiving duplicate data
         # (The best way to do this is to wrap the stream's parsers with
         # some sort of object that keeps track of that. )
-        time.sleep(CONSOLIDATE_SLEEP_INTERVAL)
+        self.clock.sleep(CONSOLIDATE_SLEEP_INTERVAL)
         
         # Remove the old threads from the thread list and disconnect them.
+        self.__remove_threads(nonfull_streams)
         for x in nonfull_streams:
-            self.threads.remove(x)
             x.close()
             
         # Add the new threads to the thread list
@@ -207,13 +601,248 @@ class ListenThreadMonitor(threading.Thread):
         self.threads.extend(consolidated_threads)
         
         
+    def rebalance_streams(self):
+        '''Finds streams whose traffic exceeds stream_budget and splits their
+        users into new streams that fit within the budget. Replacements are
+        make-before-break: when the monitor is running, the new streams are
+        started, and a later pass closes the old streams once the new ones
+        have connected. If they don't connect within
+        REBALANCE_CONNECT_TIMEOUT seconds, they are closed, the old streams
+        are kept and aren't split again for REBALANCE_COOLDOWN seconds.
+        
+        >>> monitor = ListenThreadMonitor(range(1, 11), consumer, token,
+        ...                               stream_budget=1000)
+        >>> monitor.traffic.record(1, 200000)
+        >>> monitor.traffic.record(2, 200000)
+        >>> len(monitor.threads)
+        1
+        >>> monitor.rebalance_streams()
+        >>> sorted(len(x.stream.follow) for x in monitor.threads)
+        [1, 1, 8]
+        
+        '''
+        self.__finish_rebalancing()
+        
+        now = self.clock.time()
+        busy = set(id(x) for old, new, deadline in self.rebalancing
+                   for x in old)
+        rates = self.traffic.rates()
+        overloaded = [x for x in self.threads if id(x) not in busy
+                      and now - self.rebalance_failures.get(
+                          x.stream.stream_id, -REBALANCE_COOLDOWN)
+                      >= REBALANCE_COOLDOWN
+                      and self.stream_rate(x, rates) > self.stream_budget]
+        
+        # A stream following a single user can't be split any further.
+        overloaded = [x for x in overloaded if len(x.stream.follow) > 1]
+        if not overloaded:
+            return
+        
+        follow = FollowSet(itertools.chain(
+            *[x.stream.follow for x in overloaded]))
+        replacements = self.__create_thread_objects(follow, self.stream_with)
+        
+        logger.info("Splitting %s streams over the %s bytes/sec budget into "
+                    "%s streams." % (len(overloaded), self.stream_budget,
+                                     len(replacements)))
+        self.__replace_threads(overloaded, replacements)
+    
+    @property
+    def hot_users(self):
+        '''Returns a list of users receiving more than HOT_USER_FRACTION of
+        stream_budget bytes per second, hottest first. Requires
+        stream_budget to be set.
+        
+        >>> monitor = ListenThreadMonitor([1, 2], consumer, token,
+        ...                               stream_budget=1000)
+        >>> monitor.traffic.record(2, 200000)
+        >>> monitor.hot_users
+        [2]
+        
+        '''
+        return self.traffic.hot_users(self.stream_budget * HOT_USER_FRACTION)
+    
+    def stream_rate(self, thread, rates=None):
+        '''Returns the combined byte rate of the users a thread's stream
+        follows. Requires stream_budget to be set.
+        
+        >>> monitor = ListenThreadMonitor([1, 2], consumer, token,
+        ...                               stream_budget=1000)
+        >>> monitor.stream_rate(monitor.threads[0])
+        0
+        
+        '''
+        if rates is None:
+            rates = self.traffic.rates()
+        
+        if len(rates) < len(thread.stream.follow):
+            return sum(rates[x] for x in rates if x in thread.stream.follow)
+        return sum(rates.get(x, 0) for x in thread.stream.follow)
+    
+    def heavy_streams(self, count=TOP_STREAMS, key='cpu'):
+        '''Returns the count streams that have used the most CPU time (or
+        another profiling.StreamUsage field), heaviest first, to find the
+        streams with hot users or slow parsers. Each stream is a dictionary
+        of its StreamUsage totals plus its stream_id, its number of users
+        and its tier. Requires instrumentation to be set.
+        
+        >>> from sitebucket.profiling import Instrumentation
+        >>> monitor = ListenThreadMonitor([1], consumer, token,
+        ...                               instrumentation=Instrumentation())
+        >>> stream = monitor.threads[0].stream
+        >>> stream.on_receive('{"some":"json"}\\r\\n')
+        >>> heavy = monitor.heavy_streams()
+        >>> heavy[0]['stream_id'] == stream.stream_id, heavy[0]['messages']
+        (True, 1)
+        
+        '''
+        if self.instrumentation is None:
+            raise SitebucketError('heavy_streams requires instrumentation.')
+        
+        streams = dict((x.stream.stream_id, x.stream) for x in self.threads)
+        heavy = []
+        for stream_id, usage in self.instrumentation.top(len(streams), key):
+            stream = streams.get(stream_id)
+            if stream is None:
+                continue
+            usage.update(stream_id=stream_id, users=len(stream.follow),
+                         tier=stream.tier)
+            heavy.append(usage)
+        return heavy[:count]
+    
+    def __replace_threads(self, old, new):
+        '''Replaces the old threads with the new threads. When the monitor is
+        running, the new threads are started instead, and replace the old
+        threads once they connect on a later pass.'''
+        if self.running:
+            [x.start() for x in new]
+            deadline = self.clock.time() + REBALANCE_CONNECT_TIMEOUT
+            self.rebalancing.append((old, new, deadline))
+            return
+        
+        self.__remove_threads(old)
+        for x in old:
+            x.close()
+        self.threads.extend(new)
+    
+    def __finish_rebalancing(self):
+        '''Swaps in the replacement threads that have connected, and closes
+        those that haven't connected by their deadline. Replacements are
+        also closed if an old thread has meanwhile been replaced by a
+        standby.'''
+        now = self.clock.time()
+        current = set(id(x) for x in self.threads)
+        pending = []
+        for old, new, deadline in self.rebalancing:
+            if not all(id(x) in current for x in old):
+                [x.close() for x in new]
+            elif all(x.stream.running for x in new):
+                self.__remove_threads(old)
+                for x in old:
+                    x.close()
+                self.threads.extend(new)
+                if self.lag is not None:
+                    for x in new:
+                        self.lag.assign_tier(x.stream.stream_id,
+                                             x.stream.tier)
+            elif now >= deadline:
+                logger.error("Replacement streams failed to connect. "
+                             "Keeping the existing streams.")
+                [x.close() for x in new]
+                for x in old:
+                    self.rebalance_failures[x.stream.stream_id] = now
+            else:
+                pending.append((old, new, deadline))
+        self.rebalancing = pending
+        
+        for stream_id, failed_at in self.rebalance_failures.items():
+            if now - failed_at >= REBALANCE_COOLDOWN:
+                del self.rebalance_failures[stream_id]
+    
     def restart_unhealthy_streams(self):
-        '''Restart all unhealthy streaming ListenThreads.'''
-        unhealthy = self.unhealthy_streams
-        if len(unhealthy) > 0:
-            logger.info('%s unhealthy streams detected.' % len(unhealthy))
-        [self.threads.remove(x) for x in unhealthy]
-        [self.threads.append(x.restart()) for x in unhealthy]
+        '''Restart all unhealthy streaming ListenThreads. The users of an
+        unhealthy stream are moved onto a ready standby stream if there is
+        one, otherwise the stream is restarted. A failed thread that is
+        still running is closed instead, and restarted by a later pass once
+        it has exited, so a stream is never read by two threads.'''
+        unhealthy = sorted(self.unhealthy_streams, key=lambda x: x.stream.tier)
+        if not unhealthy:
+            return
+        logger.info('%s unhealthy streams detected.' % len(unhealthy))
+        # Each replacement takes its failed thread's place in the list.
+        index = dict((id(x), i) for i, x in enumerate(self.threads))
+        for x in unhealthy:
+            replacement = self.__failover(x)
+            if replacement is None:
+                if x.is_alive():
+                    x.close()
+                    continue
+                replacement = x.restart()
+            self.threads[index[id(x)]] = replacement
+    
+    def __failover(self, thread):
+        '''Moves a failed thread's users onto a ready standby stream and
+        closes the failed thread. Returns the standby thread, or None if no
+        standby could take the users.'''
+        for standby in [x for x in self.standby_threads if x.stream.ready]:
+            self.standby_threads.remove(standby)
+            try:
+                standby.stream.add_users(thread.stream.follow)
+            except Exception:
+                logger.error("Failing over to standby stream %s failed."
+                             % standby.stream.stream_id, exc_info=True)
+                standby.close()
+                continue
+            
+            thread.close()
+            standby.stream.tier = thread.stream.tier
+            if self.lag is not None:
+                self.lag.assign_tier(standby.stream.stream_id,
+                                     thread.stream.tier)
+            logger.info("Moved %s users from stream %s to standby stream %s."
+                        % (len(thread.stream.follow), thread.stream.stream_id,
+                           standby.stream.stream_id))
+            return standby
+        return None
+    
+    def fill_standby(self):
+        '''Discards failed standby streams and starts new ones until standby
+        streams are connected or connecting.
+        
+        >>> monitor = ListenThreadMonitor([1], consumer, token, standby=2)
+        >>> monitor.fill_standby() #doctest: +SKIP
+        >>> len(monitor.standby_threads) #doctest: +SKIP
+        2
+        
+        '''
+        for x in [x for x in self.standby_threads if not x.connection_healthy]:
+            self.standby_threads.remove(x)
+            x.close()
+        
+        while len(self.standby_threads) < self.standby:
+            thread = self.__create_thread(FollowSet(), self.stream_with)
+            thread.start()
+            self.standby_threads.append(thread)
+    
+    def profile(self, duration, interval=SAMPLE_INTERVAL):
+        '''Samples the call stacks of the monitor's ListenThreads every
+        interval seconds for duration seconds and returns the
+        SamplingProfiler. This can be called from another thread while the
+        monitor is running. Use the profiler's top and dump methods to see
+        the results.
+        
+        >>> monitor = ListenThreadMonitor([1], consumer, token)
+        >>> profiler = monitor.profile(0)
+        >>> profiler.samples
+        0
+        
+        '''
+        idents = [x.ident for x in self.threads if x.ident is not None]
+        profiler = SamplingProfiler(idents, interval)
+        logger.info("Profiling %s threads for %s seconds."
+                    % (len(idents), duration))
+        profiler.run(duration)
+        return profiler
     
     def disconnect(self):
         '''Sets the disconnect flag to True, which will cause the monitor's
@@ -226,6 +855,78 @@ class ListenThreadMonitor(threading.Thread):
         '''
         logger.debug("Disconnect received.")
         self.disconnect_issued = True
+        self._wake.set()
+    
+    def shutdown(self, deadline=SHUTDOWN_DEADLINE):
+        '''Stops the monitor, its streams and its parsers within deadline
+        seconds, for fast and predictable restarts.
+        
+        Every stream (including standbys) is told to disconnect at once and
+        has its socket shut down, so streams blocked reading stop right away
+        instead of waiting for the read to time out. The stream threads and
+        the monitor's own thread are then joined, and the parser chain is
+        closed, which parses messages already queued in lanes, spill queues
+        or sink batches. Everything shares the one deadline.
+        
+        Returns a report dictionary:
+        
+        * streams -- the number of stream threads stopped
+        * unstopped -- the stream_ids of threads still running at the deadline
+        * dropped -- the number of queued messages that were discarded
+        * elapsed -- the number of seconds the shutdown took
+        
+        >>> monitor = ListenThreadMonitor([1, 2, 3], consumer, token)
+        >>> report = monitor.shutdown(deadline=5)
+        >>> report['streams'], report['unstopped'], report['dropped']
+        (1, [], 0)
+        
+        '''
+        start = time.time()
+        end = start + deadline
+        self.disconnect()
+        self.save_layout(force=True)
+        
+        threads = self.__close_threads([])
+        logger.info("Shutting down %s streams.", len(threads))
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(remaining(end))
+        # A maintenance pass that was running when the disconnect arrived
+        # may have started new threads before the monitor thread stopped.
+        threads = self.__close_threads(threads)
+        for thread in threads:
+            if thread.is_alive():
+                thread.join(remaining(end))
+        
+        try:
+            dropped = self.parser.close(remaining(end))
+        except Exception:
+            logger.error("Unhandled exception closing the parser.",
+                         exc_info=True)
+            dropped = None
+        
+        report = {
+            'streams': len(threads),
+            'unstopped': [x.stream.stream_id for x in threads
+                          if x.is_alive()],
+            'dropped': dropped,
+            'elapsed': time.time() - start,
+        }
+        logger.info("Shutdown finished in %.2f seconds. %s streams still "
+                    "running, %s messages dropped.", report['elapsed'],
+                    len(report['unstopped']), dropped)
+        return report
+    
+    def __close_threads(self, closed):
+        '''Closes the stream, standby and rebalancing replacement threads
+        that aren't in the list of already closed threads. Returns the list of every closed thread.'''
+        seen = set(id(x) for x in closed)
+        replacements = [x for old, new, deadline in list(self.rebalancing)
+                        for x in new]
+        threads = [x for x in list(self.threads) + list(self.standby_threads)
+                   + replacements if id(x) not in seen]
+        for thread in threads:
+            thread.close()
+        return closed + threads
     
     @property
     def nonfull_streams(self):
@@ -267,4 +968,20 @@ class ListenThreadMonitor(threading.Thread):
         True
         
         '''
-        return [x for x in self.threads if x.connection_healthy == False]
\ No newline at end of file
+        return [x for x in self.threads if x.connection_healthy == False]
+    
+    @property
+    def bandwidth(self):
+        '''Returns the total bytes received off the connections of the
+        current streams and the bytes of messages they decompressed. The two
+        only differ when compression is on.
+        
+        >>> ListenThreadMonitor([1], consumer, token).bandwidth
+        {'received': 0, 'decompressed': 0}
+        
+        '''
+        streams = [x.stream for x in self.threads]
+        return {
+            'received': sum(x.bytes_received for x in streams),
+            'decompressed': sum(x.bytes_decompressed for x in streams),
+        }
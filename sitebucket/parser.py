@@ -1,5 +1,8 @@
+import time
 import simplejson as json
 
+from message import Message
+
 class BaseParser(object):
     '''BaseParser is a prototype for Stream Parser objects. All parsers should
     extend this class.'''
@@ -9,9 +12,44 @@ class BaseParser(object):
         '''
         raise NotImplementedError
     
+    def close(self, timeout=None):
+        '''Flushes any messages the parser is holding and releases its
+        resources, waiting up to timeout seconds (forever if None). Returns
+        the number of messages that were dropped. Parsers that wrap another
+        parser in their parser attribute close it too, so closing the
+        outermost parser closes the whole chain.
+        
+        >>> BaseParser().close()
+        0
+        
+        '''
+        parser = getattr(self, 'parser', None)
+        if isinstance(parser, BaseParser):
+            return parser.close(timeout)
+        return 0
+    
 class DefaultParser(BaseParser):
     '''A simple Stream parser that converts the returned data to JSON and
-    prints tweets. '''
+    prints tweets. If the instrumentation attribute is set to a
+    profiling.Instrumentation object, the time spent decoding JSON is
+    recorded.
+    
+    If lazy is True, messages are passed to handle as message.Message
+    objects instead of dictionaries. Messages are backed by the raw frame
+    and only decode the fields that are used, which is much cheaper when
+    only the envelope and a tweet's text and id are needed.
+    
+    >>> parser = DefaultParser(lazy=True)
+    >>> parser.parse('{"for_user":1, "message":{"text":"hi!"}}')
+    For user 1: hi!
+    
+    '''
+    
+    instrumentation = None
+    
+    def __init__(self, lazy=False):
+        '''Returns a DefaultParser object.'''
+        self.lazy = lazy
     
     def parse(self, token):
         ''' Converts input data to JSON and calls the tweet method if the 
@@ -28,8 +66,26 @@ class DefaultParser(BaseParser):
         For user 1: hi!
         
         '''
-        content = json.loads(token)
+        decode = Message if self.lazy else json.loads
+        if self.instrumentation is None:
+            self.handle(decode(token))
+            return
+        
+        start = time.time()
+        content = decode(token)
+        self.instrumentation.record('decode', time.time() - start)
+        self.handle(content)
+    
+    def handle(self, content):
+        ''' Calls the tweet method if the decoded message is a tweet. Parsers
+        that decode messages themselves, like CachingParser, pass decoded
+        messages straight to this method.
         
+        >>> parser = DefaultParser()
+        >>> parser.handle({'for_user':1, 'message':{'text':'hi!'}})
+        For user 1: hi!
+        
+        '''
         if 'message' in content and 'text' in content['message']:
             self.tweet(content['for_user'], content['message'])
     
@@ -37,7 +93,7 @@ class DefaultParser(BaseParser):
         ''' Prints a tweet based on a tweet message and who the user is for.
         
         * for_user -- the id of the user the tweet is for.
-        * tweet -- a dictionary containing a 'text' entry
+        * tweet -- a dictionary (or message.LazyObject) containing a 'text' entry
         
         >>> parser = DefaultParser()
         >>> parser.tweet(1, {'text':'hi!'})
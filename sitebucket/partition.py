@@ -0,0 +1,469 @@
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from monitor import ListenThreadMonitor
+from listener import FOLLOW_LIMIT
+from startup import DEFAULT_TIER
+from follow import FollowSet
+from error import SitebucketError
+
+logger = logging.getLogger("sitebucket")
+
+VIRTUAL_NODES = 100
+MEMBERSHIP_TTL = 60
+
+
+def ring_hash(key):
+    '''Hashes a key to a position on the ring. Positions are 64 bit integers
+    derived from the key's md5 digest, so they are stable across processes
+    and hosts.
+
+    >>> ring_hash('node-1') == ring_hash('node-1')
+    True
+    >>> 0 <= ring_hash(12345) < 2**64
+    True
+
+    '''
+    return long(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    '''A consistent hash ring that maps user ids to node names. Each node
+    is placed on the ring replicas times (virtual nodes) so that users are
+    spread evenly, and adding or removing a node only moves about 1/N of
+    the users.
+
+    * nodes -- an iterable of node names
+    * replicas -- the number of virtual nodes placed on the ring per node
+
+    >>> ring = HashRing(['a', 'b', 'c'])
+    >>> ring.get_node(12345) in ('a', 'b', 'c')
+    True
+    >>> ring.get_node(12345) == HashRing(['c', 'b', 'a']).get_node(12345)
+    True
+
+    Only about 1/N of the users move when a node joins:
+
+    >>> follow = range(1, 10001)
+    >>> before = dict((x, ring.get_node(x)) for x in follow)
+    >>> ring.add_node('d')
+    >>> moved = [x for x in follow if ring.get_node(x) != before[x]]
+    >>> 0.15 < len(moved) / float(len(follow)) < 0.35
+    True
+    >>> set(ring.get_node(x) for x in moved)
+    set(['d'])
+
+    '''
+    def __init__(self, nodes=(), replicas=VIRTUAL_NODES):
+        '''Returns a HashRing object.'''
+        self.replicas = replicas
+        self._positions = []
+        self._owners = {}
+        self._nodes = set()
+
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self):
+        '''Returns a sorted list of the nodes on the ring.
+
+        >>> HashRing(['b', 'a']).nodes
+        ['a', 'b']
+
+        '''
+        return sorted(self._nodes)
+
+    def add_node(self, node):
+        '''Places a node's virtual nodes on the ring. Adding a node that
+        is already on the ring does nothing.
+
+        >>> ring = HashRing()
+        >>> ring.add_node('a')
+        >>> len(ring._positions) == ring.replicas
+        True
+
+        '''
+        if node in self._nodes:
+            return
+
+        self._nodes.add(node)
+        for replica in xrange(self.replicas):
+            position = ring_hash('%s#%s' % (node, replica))
+            bisect.insort(self._positions, position)
+            self._owners[position] = node
+
+    def remove_node(self, node):
+        '''Removes a node's virtual nodes from the ring.
+
+        >>> ring = HashRing(['a', 'b'])
+        >>> ring.remove_node('a')
+        >>> ring.nodes
+        ['b']
+        >>> len(ring._positions) == ring.replicas
+        True
+
+        '''
+        if node not in self._nodes:
+            return
+
+        self._nodes.remove(node)
+        self._positions = [x for x in self._positions
+                           if self._owners[x] != node]
+        for position in self._owners.keys():
+            if self._owners[position] == node:
+                del self._owners[position]
+
+    def get_node(self, key):
+        '''Returns the node responsible for the specified key, which is the
+        owner of the first virtual node clockwise from the key's hash.
+        Raises a SitebucketError if the ring is empty.
+
+        >>> HashRing().get_node(1)
+        Traceback (most recent call last):
+          ...
+        SitebucketError: Cannot assign users on an empty hash ring.
+
+        '''
+        if not self._positions:
+            raise SitebucketError('Cannot assign users on an empty hash ring.')
+
+        index = bisect.bisect(self._positions, ring_hash(key))
+        if index == len(self._positions):
+            index = 0
+        return self._owners[self._positions[index]]
+
+    def assign(self, follow, node):
+        '''Returns the subset of the follow list that belongs to the
+        specified node.
+
+        >>> ring = HashRing(['a', 'b'])
+        >>> follow = range(1, 101)
+        >>> len(ring.assign(follow, 'a')) + len(ring.assign(follow, 'b'))
+        100
+
+        '''
+        return FollowSet(x for x in follow if self.get_node(x) == node)
+
+
+class BaseMembership(object):
+    '''BaseMembership is a prototype for cluster membership backends. A
+    membership backend keeps track of which nodes are currently sharing a
+    follow list. All membership backends should extend this class.'''
+
+    def nodes(self):
+        '''This method must be overridden. It should return a list of the
+        names of all live nodes.'''
+        raise NotImplementedError
+
+    def join(self, node):
+        '''This method must be overridden. It should register the node as
+        live. It is called periodically by live nodes as a heartbeat.'''
+        raise NotImplementedError
+
+    def leave(self, node):
+        '''This method must be overridden. It should remove the node.'''
+        raise NotImplementedError
+
+
+class FileMembership(BaseMembership):
+    '''A membership backend that stores node names and their last heartbeat
+    in a local text file, one node per line. Nodes that haven't sent a
+    heartbeat (via join) within ttl seconds are no longer considered live.
+    Useful for testing and for clusters that share a filesystem.
+
+    Updates hold an exclusive flock on a lock file next to the membership
+    file, so nodes in several processes don't overwrite each other's
+    heartbeats. Where fcntl isn't available, updates are only serialized
+    within the process.
+
+    * path -- the location of the membership file
+    * ttl -- seconds after a node's last heartbeat before it expires
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> membership = FileMembership(path)
+    >>> membership.nodes()
+    []
+    >>> membership.join('a')
+    >>> membership.join('b')
+    >>> membership.join('a')
+    >>> membership.nodes()
+    ['a', 'b']
+    >>> membership.leave('a')
+    >>> membership.nodes()
+    ['b']
+    >>> membership.ttl = -1
+    >>> membership.nodes()
+    []
+    >>> os.remove(path)
+    >>> os.remove(path + '.lock')
+
+    '''
+    def __init__(self, path, ttl=MEMBERSHIP_TTL):
+        '''Returns a FileMembership object.'''
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def nodes(self):
+        '''Returns a sorted list of nodes with a recent heartbeat.'''
+        expires = time.time() - self.ttl
+        return sorted(node for node, heartbeat in self.__read().items()
+                      if heartbeat > expires)
+
+    def join(self, node):
+        '''Adds the node or refreshes its heartbeat.'''
+        with self._lock:
+            lock = self.__lock()
+            try:
+                heartbeats = self.__read()
+                heartbeats[node] = time.time()
+                self.__write(heartbeats)
+            finally:
+                lock.close()
+
+    def leave(self, node):
+        '''Removes the node.'''
+        with self._lock:
+            lock = self.__lock()
+            try:
+                heartbeats = self.__read()
+                if heartbeats.pop(node, None) is not None:
+                    self.__write(heartbeats)
+            finally:
+                lock.close()
+
+    def __lock(self):
+        '''Opens the lock file and takes an exclusive lock on it, which is
+        released when the file is closed.'''
+        lock = open(self.path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def __read(self):
+        '''Returns a dictionary mapping every node in the file to its last
+        heartbeat.'''
+        if not os.path.exists(self.path):
+            return {}
+
+        heartbeats = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    node, heartbeat = line.rsplit(None, 1)
+                    heartbeats[node] = float(heartbeat)
+                except ValueError:
+                    continue
+        return heartbeats
+
+    def __write(self, heartbeats):
+        '''Atomically replaces the membership file, leaving out expired
+        nodes.'''
+        expires = time.time() - self.ttl
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(''.join('%s %r\n' % (node, heartbeat) for node, heartbeat
+                            in sorted(heartbeats.items())
+                            if heartbeat > expires))
+        os.rename(tmp_path, self.path)
+
+
+class SQLiteMembership(BaseMembership):
+    '''A membership backend that stores nodes and their last heartbeat in a
+    SQLite database. Nodes that haven't sent a heartbeat (via join) within
+    ttl seconds are no longer considered live.
+
+    * path -- the location of the SQLite database
+    * ttl -- seconds after a node's last heartbeat before it expires
+
+    >>> membership = SQLiteMembership(':memory:')
+    >>> membership.join('a')
+    >>> membership.join('b')
+    >>> membership.nodes()
+    ['a', 'b']
+    >>> membership.leave('b')
+    >>> membership.nodes()
+    ['a']
+    >>> membership.ttl = -1
+    >>> membership.nodes()
+    []
+
+    '''
+    def __init__(self, path, ttl=MEMBERSHIP_TTL):
+        '''Returns a SQLiteMembership object.'''
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS members '
+                         '(node TEXT PRIMARY KEY, heartbeat REAL)')
+        self._db.commit()
+
+    def nodes(self):
+        '''Returns a sorted list of nodes with a recent heartbeat.'''
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT node FROM members WHERE heartbeat > ? ORDER BY node',
+                (time.time() - self.ttl,)).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def join(self, node):
+        '''Adds the node or refreshes its heartbeat.'''
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO members VALUES (?, ?)',
+                             (node, time.time()))
+            self._db.commit()
+
+    def leave(self, node):
+        '''Removes the node.'''
+        with self._lock:
+            self._db.execute('DELETE FROM members WHERE node = ?', (node,))
+            self._db.commit()
+
+
+class PartitionedMonitor(ListenThreadMonitor):
+    '''A ListenThreadMonitor that only follows its own share of a follow
+    list that is shared by several nodes. Users are assigned to nodes with
+    a consistent hash ring built from the nodes listed by a membership
+    backend. Whenever membership changes, the monitor starts following the
+    users it gained and stops following the users it lost. Only about 1/N
+    of the users move when a node joins or leaves.
+
+    Keyword arguments are identical to ListenThreadMonitor with the
+    following additions. Optional ListenThreadMonitor arguments must be
+    passed by keyword.
+
+    * node -- this node's name. It must be unique within the cluster.
+    * membership -- an object that extends BaseMembership
+    * replicas -- the number of virtual nodes placed on the ring per node
+
+    >>> membership = SQLiteMembership(':memory:')
+    >>> membership.join('other')
+    >>> follow = range(1, 1001)
+    >>> monitor = PartitionedMonitor('local', membership, follow,
+    ...                              consumer, token)
+    >>> 0 < len(monitor.follow) < len(follow)
+    True
+
+    When another node leaves, this node picks up its users:
+
+    >>> membership.leave('other')
+    >>> monitor.rebalance()
+    >>> len(monitor.follow) == len(follow)
+    True
+
+    '''
+    def __init__(self, node, membership, follow, consumer, token,
+                 stream_with="user", parser=None,
+                 replicas=VIRTUAL_NODES, **kwargs):
+        '''Returns a PartitionedMonitor object.'''
+        if not isinstance(membership, BaseMembership):
+            raise SitebucketError('membership must extend BaseMembership.')
+
+        self.node = node
+        self.membership = membership
+        self.all_follow = FollowSet(follow)
+
+        membership.join(node)
+        self.ring = HashRing(membership.nodes(), replicas)
+        self.ring.add_node(node)
+
+        super(PartitionedMonitor, self).__init__(
+            self.ring.assign(self.all_follow, node), consumer, token,
+            stream_with, parser, **kwargs)
+
+    def maintain(self):
+        '''Refreshes this node's heartbeat and rebalances the follow list
+        before performing the monitor's regular maintenance work.'''
+        self.membership.join(self.node)
+        self.rebalance()
+        super(PartitionedMonitor, self).maintain()
+
+    def rebalance(self):
+        '''Rebuilds the hash ring from the membership backend. If the set of
+        live nodes has changed, starts following newly assigned users and
+        stops following users that now belong to other nodes. Lost users are
+        dropped from the streams they're on without reconnecting them where
+        possible (see remove_follows). Gained users are added to ready
+        streams with room through their control URIs, and the rest get new
+        streams, so no stream is closed before its users are followed
+        elsewhere.'''
+        nodes = set(self.membership.nodes())
+        nodes.add(self.node)
+
+        if nodes == set(self.ring.nodes):
+            return
+
+        self.ring = HashRing(nodes, self.ring.replicas)
+        assigned = self.ring.assign(self.all_follow, self.node)
+        gained = assigned - self.follow
+        lost = self.follow - assigned
+        logger.info("Cluster membership changed (%s nodes). Gained %s users "
+                    "and lost %s users." % (len(nodes), len(gained), len(lost)))
+
+        if lost:
+            self.remove_follows(lost)
+        if gained and self.running:
+            gained = self.__fill_ready_streams(gained)
+        if gained:
+            self.add_follows(gained, start=self.running)
+
+    def __fill_ready_streams(self, follow):
+        '''Adds default tier users to ready default tier streams that have
+        room through their control URIs. Returns the users that still need
+        a stream.'''
+        fill = FollowSet(x for x in follow if self.tier(x) == DEFAULT_TIER)
+        for thread in self.threads:
+            stream = thread.stream
+            room = FOLLOW_LIMIT - len(stream.follow)
+            if not fill:
+                break
+            if room <= 0 or stream.tier != DEFAULT_TIER or \
+               not getattr(stream, 'ready', False):
+                continue
+            users = FollowSet(itertools.islice(fill, room))
+            try:
+                stream.add_users(users)
+            except Exception:
+                logger.error("Adding users to stream %s failed."
+                             % stream.stream_id, exc_info=True)
+            added = users & stream.follow
+            fill = fill - users
+            follow = follow - added
+            self.follow = self.follow | added
+        return follow
+
+    def add_cluster_follows(self, follow, start=True):
+        '''Adds users to the cluster-wide follow list and follows those that
+        are assigned to this node. Arguments are identical to add_follows.
+
+        >>> monitor = PartitionedMonitor('solo', SQLiteMembership(':memory:'),
+        ...                              [], consumer, token)
+        >>> monitor.add_cluster_follows([1, 2, 3], start=False)
+        >>> monitor.follow
+        FollowSet([1, 2, 3])
+
+        '''
+        self.all_follow = self.all_follow | follow
+        assigned = self.ring.assign(follow, self.node)
+        if assigned:
+            self.add_follows(assigned, start=start)
+
+    def disconnect(self):
+        '''Removes this node from the membership backend and sets the
+        monitor's disconnect flag.'''
+        self.membership.leave(self.node)
+        super(PartitionedMonitor, self).disconnect()
@@ -0,0 +1,464 @@
+import time
+import Queue
+import threading
+import traceback
+import multiprocessing
+import logging
+
+from parser import BaseParser
+from message import Message
+from error import SitebucketError
+from stats import Histogram
+from util import remaining
+
+logger = logging.getLogger("sitebucket")
+
+INLINE = 'inline'
+THREADS = 'threads'
+PROCESSES = 'processes'
+CONCURRENCY = (INLINE, THREADS, PROCESSES)
+
+STAGE_QUEUE_SIZE = 1000
+# Workers take up to this many waiting items at a time (but no more than
+# their share of the queue), so the cost of waking a worker thread or of a
+# round trip to a worker process is shared between them.
+STAGE_BATCH_SIZE = 64
+
+# Sentinel placed on a stage's queue to stop one of its workers.
+_STOP = object()
+
+# The function of the stage a pool worker process belongs to. It is set
+# when the process starts, so it is inherited instead of pickled and any
+# callable can run in a process stage.
+_process_function = None
+
+
+def _init_process(function):
+    global _process_function
+    _process_function = function
+
+
+def _apply_batch(items):
+    '''Applies the process's stage function to a batch of items. Returns a
+    list of (True, result) or (False, traceback) tuples.'''
+    results = []
+    for item in items:
+        try:
+            results.append((True, _process_function(item)))
+        except Exception:
+            results.append((False, traceback.format_exc()))
+    return results
+
+
+class Stage(object):
+    '''A Stage is one step of a Pipeline. It applies its function to every
+    item it receives and passes the result to the next stage. A result of
+    None drops the item. Use the sub-classes, which give results their
+    meaning: FilterStage, DecodeStage, TransformStage and SinkStage.
+
+    Each stage has its own concurrency:
+
+    * INLINE -- the function runs in the thread that passed the item in: the stream thread for the first stage, otherwise the previous stage's worker.
+    * THREADS -- items wait in a bounded queue and worker threads run the function. Use it for functions that block, like network or database calls.
+    * PROCESSES -- items wait in a bounded queue and are sent in batches to a multiprocessing.Pool of worker processes, so CPU heavy functions aren't limited by the GIL. Items and results must be picklable (raw messages are, lazy message.Message objects aren't), so process stages usually come before the decode stage or decode items themselves. The pool is forked when the stage starts.
+
+    When a queue is full, the stage feeding it blocks, which slows down the
+    streams instead of buffering without limit. With more than one worker,
+    items may leave a stage in a different order than they entered it.
+
+    Keyword arguments:
+
+    * function -- a callable taking an item
+    * concurrency -- INLINE, THREADS or PROCESSES
+    * workers -- the number of worker threads or processes
+    * queue_size -- the maximum number of items waiting for the workers
+    * name -- (optional) the stage's name in metrics. Defaults to its kind.
+
+    Each stage counts the items it receives, processes and passes on, and
+    records the time spent on each item, the time producers spent blocked
+    on its full queue, and its queue's depth. utilization is the fraction
+    of its workers' time spent processing, so a stage near 1.0 is the
+    pipeline's bottleneck and the one to give more workers.
+
+    '''
+    kind = 'stage'
+
+    def __init__(self, function, concurrency=INLINE, workers=1,
+                 queue_size=STAGE_QUEUE_SIZE, name=None):
+        '''Returns a Stage object.'''
+        if concurrency not in CONCURRENCY:
+            raise SitebucketError('Unknown stage concurrency: %s.'
+                                  % concurrency)
+        if workers < 1:
+            raise SitebucketError('Stages need at least one worker.')
+        self.function = function
+        self.concurrency = concurrency
+        self.workers = workers if concurrency != INLINE else 1
+        self.name = name or self.kind
+        self.next = None
+        self.pipeline = None
+        self.queue = Queue.Queue(queue_size) \
+            if concurrency != INLINE else None
+        self.pool = None
+        self.threads = []
+        self.latency = Histogram()
+        self.closed = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Clears the stage's metrics.'''
+        with self._lock:
+            self.received = 0
+            self.processed = 0
+            self.emitted = 0
+            self.errors = 0
+            self.busy = 0.0
+            self.blocked = 0.0
+            self.started_at = time.time()
+        self.latency.reset()
+
+    def output(self, item, result):
+        '''Returns what is passed to the next stage for an item and the
+        function's result for it, or None to drop the item.'''
+        return result
+
+    def put(self, item):
+        '''Processes an item, or queues it for the workers. Starts the
+        workers if they aren't running yet. Blocks while the queue is
+        full.'''
+        with self._lock:
+            self.received += 1
+        if self.queue is None:
+            self.__process([item])
+            return
+        if self.closed:
+            logger.warning("Dropped an item sent to closed stage %s."
+                           % self.name)
+            return
+        if not self.threads:
+            self.start()
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            start = time.time()
+            self.queue.put(item)
+            with self._lock:
+                self.blocked += time.time() - start
+
+    def start(self):
+        '''Starts the stage's worker threads, and its pool for process
+        stages. This is called automatically when the first item is
+        received.'''
+        with self._lock:
+            if self.threads or self.queue is None:
+                return
+            if self.concurrency == PROCESSES:
+                self.pool = multiprocessing.Pool(
+                    self.workers, _init_process, (self.function,))
+            for index in xrange(self.workers):
+                worker = threading.Thread(
+                    target=self.__work, name='%s-%s' % (self.name, index))
+                worker.daemon = True
+                worker.start()
+                self.threads.append(worker)
+
+    def __work(self):
+        '''Takes items off the queue in batches until it receives a
+        stop.'''
+        stopped = False
+        while not stopped:
+            items = []
+            batch_size = max(1, min(STAGE_BATCH_SIZE,
+                                    self.queue.qsize() // self.workers))
+            while len(items) < batch_size:
+                try:
+                    item = self.queue.get_nowait() if items \
+                        else self.queue.get()
+                except Queue.Empty:
+                    break
+                # Each worker takes exactly one stop.
+                if item is _STOP:
+                    stopped = True
+                    break
+                items.append(item)
+            try:
+                if items:
+                    self.__process(items)
+            finally:
+                for x in xrange(len(items) + stopped):
+                    self.queue.task_done()
+
+    def __process(self, items):
+        '''Applies the function to a list of items and passes the results
+        on.'''
+        start = time.time()
+        if self.pool is not None:
+            try:
+                results = self.pool.apply(_apply_batch, (items,))
+            except Exception:
+                results = [(False, traceback.format_exc())] * len(items)
+        else:
+            results = []
+            for item in items:
+                try:
+                    results.append((True, self.function(item)))
+                except Exception:
+                    results.append((False, traceback.format_exc()))
+        elapsed = time.time() - start
+
+        outputs = []
+        errors = 0
+        for item, (ok, result) in zip(items, results):
+            if not ok:
+                errors += 1
+                logger.error("Unhandled exception in pipeline stage %s:\n%s"
+                             % (self.name, result))
+                continue
+            result = self.output(item, result)
+            if result is not None:
+                outputs.append(result)
+
+        with self._lock:
+            self.processed += len(items)
+            self.emitted += len(outputs)
+            self.errors += errors
+            self.busy += elapsed
+        for x in items:
+            self.latency.record(elapsed / len(items))
+
+        if self.next is not None:
+            for result in outputs:
+                self.next.put(result)
+
+    def close(self, timeout=None):
+        '''Stops the workers after they have processed the items already
+        queued, waiting up to timeout seconds (forever if None). Returns
+        the number of items left unprocessed.'''
+        self.closed = True
+        with self._lock:
+            threads, self.threads = self.threads, []
+        if self.queue is None:
+            return 0
+
+        deadline = None if timeout is None else time.time() + timeout
+        for x in threads:
+            try:
+                self.queue.put(_STOP, timeout=remaining(deadline))
+            except Queue.Full:
+                break
+        for x in threads:
+            x.join(remaining(deadline))
+
+        if self.pool is not None:
+            if any(x.is_alive() for x in threads):
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+        return len([x for x in list(self.queue.queue) if x is not _STOP])
+
+    @property
+    def depth(self):
+        '''Returns the number of items waiting in the stage's queue.'''
+        return self.queue.qsize() if self.queue is not None else 0
+
+    @property
+    def utilization(self):
+        '''Returns the fraction of its workers' time the stage spent
+        processing items since it was created or reset.'''
+        elapsed = (time.time() - self.started_at) * self.workers
+        return min(self.busy / elapsed, 1.0) if elapsed > 0 else 0.0
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of stage metrics.
+
+        >>> sorted(TransformStage(len).stats.keys())
+        ['blocked', 'concurrency', 'depth', 'emitted', 'errors', 'latency', 'name', 'processed', 'queue_size', 'received', 'throughput', 'utilization', 'workers']
+
+        '''
+        elapsed = time.time() - self.started_at
+        return {
+            'name': self.name,
+            'concurrency': self.concurrency,
+            'workers': self.workers,
+            'received': self.received,
+            'processed': self.processed,
+            'emitted': self.emitted,
+            'errors': self.errors,
+            'depth': self.depth,
+            'queue_size': self.queue.maxsize if self.queue is not None else 0,
+            'blocked': self.blocked,
+            'throughput': self.processed / elapsed if elapsed > 0 else 0.0,
+            'utilization': self.utilization,
+            'latency': self.latency.stats,
+        }
+
+
+class FilterStage(Stage):
+    '''A stage that passes on only the items its predicate returns True
+    for. As the first stage of a pipeline it sees raw messages, so it can
+    drop unwanted messages before anything decodes them.
+
+    >>> stage = FilterStage(lambda token: '"delete"' not in token)
+    >>> stage.put('{"delete":{}}')
+    >>> stage.emitted
+    0
+
+    '''
+    kind = 'filter'
+
+    def __init__(self, predicate, **kwargs):
+        '''Returns a FilterStage object. Keyword arguments are identical to
+        Stage.'''
+        super(FilterStage, self).__init__(predicate, **kwargs)
+
+    def output(self, item, result):
+        return item if result else None
+
+
+class DecodeStage(Stage):
+    '''A stage that decodes raw messages. By default messages are decoded
+    into lazy message.Message objects. Pass json.loads as decode to get
+    dictionaries.'''
+    kind = 'decode'
+
+    def __init__(self, decode=Message, **kwargs):
+        '''Returns a DecodeStage object. Keyword arguments are identical to
+        Stage.'''
+        super(DecodeStage, self).__init__(decode, **kwargs)
+
+
+class TransformStage(Stage):
+    '''A stage that passes on its function's result for each item, for
+    enriching or reshaping messages. Returning None drops the item.'''
+    kind = 'transform'
+
+
+class SinkStage(Stage):
+    '''The last stage of a pipeline. sink is a callable, or a BaseParser
+    whose parse method is called with each item, like a sinks.BatchSink.
+    Closing the stage closes a BaseParser sink too.'''
+    kind = 'sink'
+
+    def __init__(self, sink, **kwargs):
+        '''Returns a SinkStage object. Keyword arguments are identical to
+        Stage.'''
+        self.parser = sink if isinstance(sink, BaseParser) else None
+        function = sink.parse if self.parser is not None else sink
+        if self.parser is not None and \
+           kwargs.get('concurrency') == PROCESSES:
+            raise SitebucketError('Parsers can only be used by inline or '
+                                  'thread sink stages.')
+        super(SinkStage, self).__init__(function, **kwargs)
+
+    def output(self, item, result):
+        return None
+
+    def close(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        dropped = super(SinkStage, self).close(timeout)
+        if self.parser is not None:
+            dropped += self.parser.close(remaining(deadline))
+        return dropped
+
+
+class Pipeline(BaseParser):
+    '''A Pipeline processes messages in a series of stages, for example a
+    raw filter, a decode, a transform and a sink, each with its own
+    concurrency and a bounded queue in front of it (see Stage). A Pipeline
+    is a parser: pass it to a stream or monitor in place of its parser, and
+    each stream passes its messages to the first stage. Closing the
+    pipeline, as ListenThreadMonitor.shutdown does, drains and stops each
+    stage in order.
+
+    Each stage reports its own throughput, queue depth and utilization, so
+    only the bottleneck stage needs more workers.
+
+    * stages -- a list of Stage objects. Stages can't be shared between pipelines.
+
+    Start a pipeline with process stages before starting the streams, so
+    its pools are forked before the stream threads exist.
+
+    >>> lengths = []
+    >>> pipeline = Pipeline([
+    ...     FilterStage(lambda token: '"for_user"' in token),
+    ...     DecodeStage(),
+    ...     TransformStage(lambda message: len(message['message']['text']),
+    ...                    concurrency=THREADS, workers=2),
+    ...     SinkStage(lengths.append)])
+    >>> pipeline.parse('{"for_user":1,"message":{"text":"hi!"}}')
+    >>> pipeline.parse('{"friends":[1,2]}')
+    >>> pipeline.close()
+    0
+    >>> lengths
+    [3]
+    >>> [(x['name'], x['received'], x['emitted']) for x in pipeline.stats['stages']]
+    [('filter', 2, 1), ('decode', 1, 1), ('transform', 1, 1), ('sink', 1, 0)]
+
+    '''
+    def __init__(self, stages):
+        '''Returns a Pipeline object.'''
+        if not stages:
+            raise SitebucketError('Pipelines need at least one stage.')
+        self.stages = list(stages)
+        names = [x.name for x in self.stages]
+        for stage, following in zip(self.stages, self.stages[1:] + [None]):
+            if stage.pipeline is not None:
+                raise SitebucketError('Stage %s is already in a pipeline.'
+                                      % stage.name)
+            if names.count(stage.name) > 1:
+                stage.name = '%s-%s' % (stage.name, self.stages.index(stage))
+            stage.pipeline = self
+            stage.next = following
+
+    def parse(self, token):
+        '''Passes the message to the first stage.'''
+        self.stages[0].put(token)
+
+    def start(self):
+        '''Starts the workers and pools of every stage. This is otherwise
+        done when each stage receives its first item.'''
+        for stage in self.stages:
+            stage.start()
+
+    def close(self, timeout=None):
+        '''Drains and stops every stage in order, so items already queued
+        flow through the remaining stages, then closes any parser sinks.
+        Waits up to timeout seconds (forever if None) and returns the
+        number of items that were left unprocessed.'''
+        deadline = None if timeout is None else time.time() + timeout
+        dropped = 0
+        for stage in self.stages:
+            dropped += stage.close(remaining(deadline))
+        return dropped
+
+    def reset(self):
+        '''Clears the metrics of every stage, to start a new measurement.'''
+        for stage in self.stages:
+            stage.reset()
+
+    @property
+    def bottleneck(self):
+        '''Returns the name of the stage with the highest utilization.
+
+        >>> Pipeline([DecodeStage(), SinkStage(len)]).bottleneck
+        'decode'
+
+        '''
+        return max(self.stages, key=lambda x: (x.utilization, x.depth)).name
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of pipeline metrics: the stats of each
+        stage, in order, and the bottleneck stage.
+
+        >>> sorted(Pipeline([SinkStage(len)]).stats.keys())
+        ['bottleneck', 'stages']
+
+        '''
+        return {
+            'stages': [x.stats for x in self.stages],
+            'bottleneck': self.bottleneck,
+        }
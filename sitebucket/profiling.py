@@ -0,0 +1,320 @@
+import sys
+import time
+import ctypes
+import ctypes.util
+import threading
+import collections
+import logging
+
+from stats import Histogram
+
+logger = logging.getLogger("sitebucket")
+
+SLOW_MESSAGE_THRESHOLD = .5
+SLOW_MESSAGE_PAYLOAD = 200
+SAMPLE_INTERVAL = .005
+CPU_SAMPLE_INTERVAL = 1.0
+TOP_STREAMS = 10
+
+STAGES = ('read', 'decode', 'parse')
+USAGE_KEYS = ('cpu', 'read', 'frame', 'parse', 'messages', 'bytes')
+
+# The clock_gettime clock id of the calling thread's CPU time on Linux.
+CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_thread_time():
+    '''Returns a function that returns the calling thread's CPU time in
+    seconds, or None if the platform doesn't have one.'''
+    if hasattr(time, 'thread_time'):
+        return time.thread_time
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or
+                              ctypes.util.find_library('c'))
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    clock_gettime.restype = ctypes.c_int
+
+    def thread_time():
+        spec = _timespec()
+        if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(spec)):
+            return None
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return thread_time
+
+# Returns the CPU time of the calling thread in seconds, like Python 3's
+# time.thread_time. None on platforms without a thread CPU clock.
+thread_time = _load_thread_time()
+
+
+class StreamUsage(object):
+    '''StreamUsage totals the resources one stream's thread has spent on
+    messages: CPU seconds, wall seconds spent reading, framing and parsing,
+    and the number of messages and bytes. cpu is None if the platform has
+    no thread CPU clock.
+
+    >>> usage = StreamUsage()
+    >>> usage.record(100, .5, .001, .25)
+    >>> usage.record(50, .5, .001, .25)
+    >>> usage.messages, usage.bytes, usage.parse
+    (2, 150, 0.5)
+
+    '''
+    __slots__ = USAGE_KEYS
+
+    def __init__(self):
+        '''Returns a StreamUsage object.'''
+        self.cpu = None
+        self.read = self.frame = self.parse = 0.0
+        self.messages = self.bytes = 0
+
+    def record(self, size, read_time, frame_time, parse_time):
+        '''Adds a message's size and timings.'''
+        self.messages += 1
+        self.bytes += size
+        self.read += read_time
+        self.frame += frame_time
+        self.parse += parse_time
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the stream's totals.'''
+        return dict((x, getattr(self, x)) for x in USAGE_KEYS)
+
+
+class Instrumentation(object):
+    '''Instrumentation records how long each stage of message processing
+    takes. Attach it to a stream (or pass it to a ListenThreadMonitor) to
+    turn timing on. Streams without instrumentation only pay for a single
+    attribute check per message.
+
+    The stages are:
+
+    * read -- time spent reading a message, measured from the end of the previous message. This includes time spent waiting for Twitter.
+    * parse -- time spent in the parser's parse method, including decoding.
+    * decode -- time spent decoding JSON. Only recorded by parsers that extend DefaultParser.
+
+    Instrumentation also keeps a StreamUsage for every stream, keyed by
+    stream id, with the stream's total read, frame and parse time. Frame
+    time is spent turning a complete message into a Frame and checking it
+    for a control URI, and is left out of read time. Where the platform has
+    a thread CPU clock (see thread_time), each stream's thread samples its
+    own CPU time at most every cpu_interval seconds and adds it to its
+    StreamUsage. top returns the heaviest streams, so a hot user or a slow
+    parser can be found without attaching a profiler.
+
+    Messages whose parse stage takes longer than slow_threshold seconds
+    are logged as warnings with the stream id and the first
+    payload_length characters of the message.
+
+    Keyword arguments:
+
+    * slow_threshold -- seconds of parsing after which a message is logged as slow
+    * payload_length -- the number of characters of a slow message to log
+    * cpu_interval -- the minimum number of seconds between samples of a stream thread's CPU time
+
+    >>> instrumentation = Instrumentation()
+    >>> instrumentation.record('parse', .01)
+    >>> instrumentation.stages['parse'].count
+    1
+
+    '''
+    def __init__(self, slow_threshold=SLOW_MESSAGE_THRESHOLD,
+                 payload_length=SLOW_MESSAGE_PAYLOAD,
+                 cpu_interval=CPU_SAMPLE_INTERVAL):
+        '''Returns an Instrumentation object.'''
+        self.slow_threshold = slow_threshold
+        self.payload_length = payload_length
+        self.cpu_interval = cpu_interval
+        self.stages = dict((x, Histogram()) for x in STAGES)
+        self.streams = {}
+        self.slow_messages = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        '''Records the duration of a stage.'''
+        self.stages[stage].record(seconds)
+
+    def stream(self, stream_id):
+        '''Returns the StreamUsage of a stream.'''
+        usage = self.streams.get(stream_id)
+        if usage is None:
+            with self._lock:
+                usage = self.streams.setdefault(stream_id, StreamUsage())
+        return usage
+
+    def message(self, stream_id, token, read_time, parse_time, frame_time=0.0):
+        '''Records the read, frame and parse time of a message and logs it
+        if it was slow.
+
+        >>> instrumentation = Instrumentation(slow_threshold=.1)
+        >>> instrumentation.message(1, '{"some":"json"}', .2, .3)
+        >>> instrumentation.slow_messages
+        1
+        >>> instrumentation.streams[1].bytes
+        15
+
+        '''
+        self.stages['read'].record(read_time)
+        self.stages['parse'].record(parse_time)
+        usage = self.streams.get(stream_id) or self.stream(stream_id)
+        usage.record(len(token), read_time, frame_time, parse_time)
+
+        if parse_time > self.slow_threshold:
+            with self._lock:
+                self.slow_messages += 1
+            payload = token.strip()
+            if len(payload) > self.payload_length:
+                payload = payload[:self.payload_length] + '...'
+            logger.warning("Slow message on stream %s: parsing took %.3f "
+                           "seconds. %s", stream_id, parse_time, payload)
+
+    def cpu(self, stream_id, seconds):
+        '''Adds CPU time used by a stream's thread.'''
+        usage = self.stream(stream_id)
+        usage.cpu = (usage.cpu or 0.0) + seconds
+
+    def top(self, count=TOP_STREAMS, key='cpu'):
+        '''Returns the count streams with the highest total of a StreamUsage
+        field, as (stream id, StreamUsage stats) pairs, heaviest first. Sorts
+        by parse time if key is 'cpu' and there is no thread CPU clock.
+
+        >>> instrumentation = Instrumentation()
+        >>> instrumentation.message(1, '{}', 0, .1)
+        >>> instrumentation.message(2, '{}', 0, .3)
+        >>> [x[0] for x in instrumentation.top(2, 'parse')]
+        [2, 1]
+
+        '''
+        if key not in USAGE_KEYS:
+            raise ValueError("'%s' isn't a StreamUsage field." % key)
+        if key == 'cpu' and thread_time is None:
+            key = 'parse'
+        streams = self.streams.items()
+        streams.sort(key=lambda x: getattr(x[1], key) or 0, reverse=True)
+        return [(stream_id, usage.stats) for stream_id, usage
+                in streams[:count]]
+
+    def retain(self, stream_ids):
+        '''Forgets the usage of streams that aren't in stream_ids.'''
+        stream_ids = set(stream_ids)
+        with self._lock:
+            for stream_id in self.streams.keys():
+                if stream_id not in stream_ids:
+                    del self.streams[stream_id]
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of stage timings.
+
+        >>> sorted(Instrumentation().stats.keys())
+        ['decode', 'parse', 'read', 'slow_messages']
+
+        '''
+        stats = dict((x, self.stages[x].stats) for x in STAGES)
+        stats['slow_messages'] = self.slow_messages
+        return stats
+
+
+def parser_chain(parser):
+    '''Returns a list of a parser and every parser it wraps, following
+    their parser attributes.
+
+    >>> from sitebucket import DefaultParser
+    >>> from sitebucket.dispatch import LaneDispatcher
+    >>> inner = DefaultParser()
+    >>> parser_chain(LaneDispatcher(inner))[1] is inner
+    True
+
+    '''
+    chain = []
+    while parser is not None and parser not in chain:
+        chain.append(parser)
+        parser = getattr(parser, 'parser', None)
+    return chain
+
+
+class SamplingProfiler(object):
+    '''The SamplingProfiler periodically samples the call stacks of a set of
+    threads and counts how often each stack is seen. It can be attached to
+    a running process (see ListenThreadMonitor.profile) without restarting
+    it, and it only costs anything while it runs.
+
+    Keyword arguments:
+
+    * threads -- a list of thread idents to sample. All threads are sampled if None.
+    * interval -- seconds between samples
+
+    >>> profiler = SamplingProfiler([threading.current_thread().ident])
+    >>> profiler.sample()
+    >>> profiler.samples
+    1
+    >>> len(profiler.top(1))
+    1
+
+    '''
+    def __init__(self, threads=None, interval=SAMPLE_INTERVAL):
+        '''Returns a SamplingProfiler object.'''
+        self.threads = set(threads) if threads is not None else None
+        self.interval = interval
+        self.stacks = collections.defaultdict(int)
+        self.samples = 0
+
+    def sample(self):
+        '''Records the current stack of every sampled thread.'''
+        this_thread = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if self.threads is not None and ident not in self.threads:
+                continue
+            if self.threads is None and ident == this_thread:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (code.co_filename, code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, duration):
+        '''Samples the threads every interval seconds for duration seconds.
+        Blocks until sampling is complete.'''
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+
+    def top(self, count=10):
+        '''Returns the count most frequently sampled functions (the
+        innermost frame of each stack) as (function, samples) pairs.'''
+        functions = collections.defaultdict(int)
+        for stack, samples in self.stacks.items():
+            functions[stack.rsplit(';', 1)[-1]] += samples
+        return sorted(functions.items(), key=lambda x: x[1],
+                      reverse=True)[:count]
+
+    def dump(self, f):
+        '''Writes the sampled stacks to a file object in the collapsed stack
+        format used by flame graph tools: one stack per line, with frames
+        separated by semicolons, followed by its sample count.
+
+        >>> from StringIO import StringIO
+        >>> profiler = SamplingProfiler()
+        >>> profiler.stacks['a.py:main;a.py:work'] = 3
+        >>> out = StringIO()
+        >>> profiler.dump(out)
+        >>> out.getvalue()
+        'a.py:main;a.py:work 3\\n'
+
+        '''
+        for stack, samples in sorted(self.stacks.items()):
+            f.write('%s %s\n' % (stack, samples))
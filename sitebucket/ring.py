@@ -0,0 +1,293 @@
+import mmap
+import time
+import struct
+import ctypes
+import threading
+import multiprocessing
+import logging
+
+from parser import BaseParser
+from error import SitebucketError
+from util import Frame
+
+logger = logging.getLogger("sitebucket")
+
+RING_SIZE = 16 * 1024 * 1024
+RING_FULL_WAIT = .0005
+RING_POLL_TIMEOUT = 1.0
+RING_BATCH_SIZE = 64
+RING_WAKE_TIMEOUT = .1
+
+# Each message is preceded by its length, receive time and stream id.
+HEADER = struct.Struct('<IdI')
+
+
+class RingBuffer(object):
+    '''A single producer, multiple consumer ring buffer of messages in
+    shared memory. One reader process writes frames into the ring and any
+    number of consumer processes take them out, each message going to
+    exactly one consumer. Messages are copied straight into and out of
+    shared memory, so they are never pickled or sent through a pipe, and
+    the frame's receive time and stream id travel with it.
+
+    Consumers take messages in batches and only sleep when the ring is
+    empty. The producer only signals a semaphore to wake them when a
+    consumer is actually sleeping, and only once until a consumer wakes,
+    so a busy ring costs no system calls per message. When
+    the ring is full, the producer waits for consumers to make room, which
+    slows down the streams feeding it instead of growing without bound.
+
+    The ring is an anonymous shared memory map, so it must be created
+    before the consumer processes are forked.
+
+    * size -- the capacity of the ring in bytes
+
+    >>> ring = RingBuffer(size=1024)
+    >>> ring.put(Frame('{"some":"json"}\\r\\n', received_at=10.0, stream_id=3))
+    >>> frame = ring.get()
+    >>> frame, frame.received_at, frame.stream_id
+    ('{"some":"json"}\\r\\n', 10.0, 3)
+    >>> ring.get(timeout=0) is None
+    True
+
+    '''
+    def __init__(self, size=RING_SIZE):
+        '''Returns a RingBuffer object.'''
+        self.size = size
+        self.buffer = mmap.mmap(-1, size)
+        # Bytes ever written and consumed. Only the producer moves the head
+        # and consumers only move the tail while holding the read lock.
+        self._head = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._tail = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._messages = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._full_waits = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._closed = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._waiting = multiprocessing.RawValue(ctypes.c_int, 0)
+        self._signalled = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._wake = multiprocessing.Semaphore(0)
+        self._read_lock = multiprocessing.Lock()
+
+    def __write(self, position, data):
+        offset = position % self.size
+        first = min(len(data), self.size - offset)
+        self.buffer[offset:offset + first] = data[:first]
+        if first < len(data):
+            self.buffer[:len(data) - first] = data[first:]
+
+    def __read(self, position, length):
+        offset = position % self.size
+        first = min(length, self.size - offset)
+        data = self.buffer[offset:offset + first]
+        if first < length:
+            data += self.buffer[:length - first]
+        return data
+
+    def put(self, token):
+        '''Writes a message into the ring, waiting while the ring is full.
+        Must only be called by one thread at a time.'''
+        length = len(token)
+        needed = HEADER.size + length
+        if needed > self.size:
+            raise SitebucketError('Message of %s bytes exceeds the ring size.'
+                                  % length)
+
+        head = self._head.value
+        while head + needed - self._tail.value > self.size:
+            if self._closed.value:
+                raise SitebucketError('The ring is closed.')
+            self._full_waits.value += 1
+            time.sleep(RING_FULL_WAIT)
+
+        if isinstance(token, Frame):
+            received_at = token.received_at or 0
+            stream_id = token.stream_id or 0
+        else:
+            received_at = stream_id = 0
+        offset = head % self.size
+        if offset + needed <= self.size:
+            HEADER.pack_into(self.buffer, offset, length, received_at,
+                             stream_id)
+            self.buffer[offset + HEADER.size:offset + needed] = token
+        else:
+            self.__write(head, HEADER.pack(length, received_at, stream_id))
+            self.__write(head + HEADER.size, token)
+        self._head.value = head + needed
+        self._messages.value += 1
+        if self._waiting.value and not self._signalled.value:
+            self._signalled.value = True
+            self._wake.release()
+
+    def get(self, timeout=None):
+        '''Returns the next message as a Frame, waiting up to timeout
+        seconds (forever if None) for one to arrive. Returns None if no
+        message arrived in time.'''
+        frames = self.get_batch(1, timeout)
+        return frames[0] if frames else None
+
+    def get_batch(self, count=RING_BATCH_SIZE, timeout=None):
+        '''Returns a list of up to count messages as Frames, waiting up to
+        timeout seconds (forever if None) for the first one to arrive.
+        Taking messages in batches means consumers contend for the ring
+        once per batch rather than once per message.
+
+        >>> ring = RingBuffer(size=1024)
+        >>> for x in range(3):
+        ...     ring.put('{"id":%s}\\r\\n' % x)
+        >>> ring.get_batch(2)
+        ['{"id":0}\\r\\n', '{"id":1}\\r\\n']
+        >>> ring.get_batch(2)
+        ['{"id":2}\\r\\n']
+
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._read_lock:
+                frames = self.__take(count)
+                if frames:
+                    return frames
+                self._waiting.value += 1
+            try:
+                # Check again now that the producer knows to wake us.
+                if self.empty:
+                    wait = RING_WAKE_TIMEOUT
+                    if deadline is not None:
+                        wait = min(wait, max(deadline - time.time(), 0))
+                    self._wake.acquire(True, wait)
+            finally:
+                with self._read_lock:
+                    self._waiting.value -= 1
+                    self._signalled.value = False
+            if deadline is not None and time.time() >= deadline \
+               and self.empty:
+                return []
+
+    def __take(self, count):
+        '''Reads up to count messages. Must be called with the read lock
+        held.'''
+        frames = []
+        size = self.size
+        tail = self._tail.value
+        head = self._head.value
+        while tail < head and len(frames) < count:
+            offset = tail % size
+            if offset + HEADER.size <= size:
+                length, received_at, stream_id = HEADER.unpack_from(
+                    self.buffer, offset)
+            else:
+                length, received_at, stream_id = HEADER.unpack(
+                    self.__read(tail, HEADER.size))
+            start = offset + HEADER.size
+            if start + length <= size:
+                data = self.buffer[start:start + length]
+            else:
+                data = self.__read(tail + HEADER.size, length)
+            frames.append(Frame(data, received_at or None, stream_id or None))
+            tail += HEADER.size + length
+        self._tail.value = tail
+        return frames
+
+    def close(self):
+        '''Tells consumers that no more messages will be written. Consumers
+        stop once they have taken every message already in the ring.'''
+        self._closed.value = True
+
+    @property
+    def closed(self):
+        return self._closed.value
+
+    @property
+    def empty(self):
+        return self._head.value == self._tail.value
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of ring metrics.
+
+        >>> sorted(RingBuffer(size=1024).stats.keys())
+        ['depth', 'full_waits', 'messages', 'size']
+
+        '''
+        return {
+            'size': self.size,
+            'depth': self._head.value - self._tail.value,
+            'messages': self._messages.value,
+            'full_waits': self._full_waits.value,
+        }
+
+
+class RingParser(BaseParser):
+    '''The producer side of a RingBuffer. Pass a RingParser to the streams
+    (or monitor) of a reader process to write every message into the ring.
+    Every stream in the process can share one RingParser.
+
+    * ring -- a RingBuffer
+
+    >>> ring = RingBuffer(size=1024)
+    >>> RingParser(ring).parse('{"some":"json"}\\r\\n')
+    >>> ring.get()
+    '{"some":"json"}\\r\\n'
+
+    '''
+    def __init__(self, ring):
+        '''Returns a RingParser object.'''
+        self.ring = ring
+        self._lock = threading.Lock()
+
+    def parse(self, token):
+        '''Writes the message into the ring.'''
+        with self._lock:
+            self.ring.put(token)
+
+    def close(self, timeout=None):
+        '''Closes the ring. Returns 0, since every message has already been
+        written to it.'''
+        self.ring.close()
+        return 0
+
+
+class RingConsumer(object):
+    '''The consumer side of a RingBuffer. run takes messages from the ring
+    and passes them to a parser until the ring is closed and empty. Use it
+    as the target of a consumer process:
+
+    >>> ring = RingBuffer()
+    >>> consumer = RingConsumer(ring, BaseParser())
+    >>> process = multiprocessing.Process(target=consumer.run)
+
+    * ring -- a RingBuffer
+    * parser -- an object that extends BaseParser
+
+    '''
+    def __init__(self, ring, parser):
+        '''Returns a RingConsumer object.'''
+        if not isinstance(parser, BaseParser):
+            raise SitebucketError('parser must extend BaseParser.')
+
+        self.ring = ring
+        self.parser = parser
+        self.parsed = 0
+
+    def run(self):
+        '''Parses messages from the ring until it is closed and empty.
+        Returns the number of messages parsed.
+
+        >>> class PrintParser(BaseParser):
+        ...     def parse(self, token):
+        ...         print token.strip()
+        >>> ring = RingBuffer(size=1024)
+        >>> ring.put('{"some":"json"}\\r\\n')
+        >>> ring.close()
+        >>> RingConsumer(ring, PrintParser()).run()
+        {"some":"json"}
+        1
+
+        '''
+        while not (self.ring.closed and self.ring.empty):
+            for token in self.ring.get_batch(timeout=RING_POLL_TIMEOUT):
+                try:
+                    self.parser.parse(token)
+                except Exception:
+                    logger.error("Unhandled exception encountered in ring "
+                                 "consumer.", exc_info=True)
+                self.parsed += 1
+        return self.parsed
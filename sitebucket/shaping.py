@@ -0,0 +1,365 @@
+import time
+import threading
+import collections
+import logging
+
+from parser import BaseParser
+from error import SitebucketError
+from util import extract_for_user
+
+logger = logging.getLogger("sitebucket")
+
+SHAPING_RATE = 10.0
+SHAPING_BURST = 50
+SHAPING_MAX_USERS = 100000
+SHAPING_IDLE_TIMEOUT = 300
+SAMPLE_EVERY = 10
+SPILL_QUEUE_SIZE = 10000
+SPILL_DRAIN_INTERVAL = 1.0
+EVICTED_DROPS_KEPT = 1000
+
+POLICIES = ('drop', 'sample', 'defer')
+
+
+class Bucket(object):
+    '''A user's token bucket, along with the number of their messages that
+    have been dropped, have overflowed and are waiting on the spill queue.
+
+    >>> bucket = Bucket(5, 0)
+    >>> bucket.refill(1, 2, 10)
+    >>> bucket.tokens, bucket.last
+    (7, 1)
+
+    '''
+    __slots__ = ('tokens', 'last', 'dropped', 'overflowed', 'deferred')
+
+    def __init__(self, tokens, last):
+        '''Returns a Bucket object.'''
+        self.tokens = tokens
+        self.last = last
+        self.dropped = self.overflowed = self.deferred = 0
+
+    def refill(self, now, rate, burst):
+        '''Adds the tokens earned since the last refill, up to burst.'''
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+
+
+class ShapingParser(BaseParser):
+    '''The ShapingParser limits how many messages each user can pass to the
+    wrapped parser, so one runaway account (a bot, or a user in a follow
+    storm) can't starve everyone else. Every for_user id gets a token
+    bucket that refills at rate messages per second and holds at most
+    burst messages. Messages without a for_user id, like control messages,
+    are never shaped.
+
+    Messages that arrive when a user's bucket is empty overflow, and are
+    handled according to policy:
+
+    * drop -- the message is discarded.
+    * sample -- one in every sample_every overflowing messages is passed on and the rest are discarded.
+    * defer -- the message is placed on a spill queue and parsed once the user's bucket refills. A user's messages stay in order. When the spill queue is full, messages are discarded.
+
+    Memory is bounded: at most max_users buckets are kept, and buckets idle
+    for idle_timeout seconds are evicted (an evicted user starts again with
+    a full bucket). Buckets with deferred messages are never evicted, so
+    there may be up to spill_size more. Discarded messages are counted per
+    user. When a bucket is evicted, its count is kept for the
+    EVICTED_DROPS_KEPT evicted users with the most discarded messages.
+
+    Place a ShapingParser in front of any other parser, including a
+    LaneDispatcher, so shaped messages are discarded before they are
+    queued or decoded.
+
+    Keyword arguments:
+
+    * parser -- an object that extends BaseParser
+    * rate -- messages per second each user may sustain
+    * burst -- the number of messages a user may send at once
+    * policy -- 'drop', 'sample' or 'defer'
+    * max_users -- the maximum number of buckets kept
+    * idle_timeout -- seconds after which an idle bucket is evicted
+    * sample_every -- with the sample policy, pass one in this many overflowing messages
+    * spill_size -- with the defer policy, the maximum number of deferred messages
+
+    >>> class ListParser(BaseParser):
+    ...     parsed = []
+    ...     def parse(self, token):
+    ...         self.parsed.append(token)
+    >>> shaper = ShapingParser(ListParser(), rate=1, burst=2)
+    >>> for x in range(5):
+    ...     shaper.parse('{"for_user":1,"message":{"text":"hi!"}}')
+    >>> len(ListParser.parsed)
+    2
+    >>> shaper.drops
+    {1: 3}
+
+    '''
+    def __init__(self, parser, rate=SHAPING_RATE, burst=SHAPING_BURST,
+                 policy='drop', max_users=SHAPING_MAX_USERS,
+                 idle_timeout=SHAPING_IDLE_TIMEOUT, sample_every=SAMPLE_EVERY,
+                 spill_size=SPILL_QUEUE_SIZE):
+        '''Returns a ShapingParser object.'''
+        if not isinstance(parser, BaseParser):
+            raise SitebucketError('parser must extend BaseParser.')
+        if policy not in POLICIES:
+            raise SitebucketError("'%s' is an invalid shaping policy."
+                                  % policy)
+
+        self.parser = parser
+        self.rate = float(rate)
+        self.burst = burst
+        self.policy = policy
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.sample_every = sample_every
+        self.spill_size = spill_size
+
+        # Buckets are ordered from least to most recently used.
+        self.buckets = collections.OrderedDict()
+        self.spill = collections.deque()
+        self.passed = 0
+        self.dropped = 0
+        self.deferred = 0
+        self.overflowed = 0
+        self.evictions = 0
+        # Discarded message counts of users whose buckets were evicted.
+        self.evicted_drops = {}
+        self._last_drain = time.time()
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+
+    def __bucket(self, user, now):
+        '''Returns the user's bucket, refilled to now and moved to the end
+        of the buckets. Evicts idle and excess buckets, except those with
+        deferred messages. Must be called with the lock held.'''
+        bucket = self.buckets.pop(user, None)
+        if bucket is None:
+            bucket = Bucket(self.burst, now)
+        else:
+            bucket.refill(now, self.rate, self.burst)
+        self.buckets[user] = bucket
+
+        excess = len(self.buckets) - self.max_users
+        evicted = []
+        for other, x in self.buckets.iteritems():
+            if x is bucket:
+                break
+            if x.deferred:
+                continue
+            if excess <= 0 and now - x.last < self.idle_timeout:
+                break
+            evicted.append(other)
+            excess -= 1
+        for other in evicted:
+            self.__retire(other, self.buckets.pop(other))
+        self.evictions += len(evicted)
+        return bucket
+
+    def __retire(self, user, bucket):
+        '''Keeps an evicted bucket's discarded message count, forgetting
+        the smallest count once EVICTED_DROPS_KEPT users are kept. Must be
+        called with the lock held.'''
+        if not bucket.dropped:
+            return
+        drops = self.evicted_drops
+        drops[user] = drops.get(user, 0) + bucket.dropped
+        if len(drops) > EVICTED_DROPS_KEPT:
+            del drops[min(drops, key=drops.get)]
+
+    def admit(self, user, now=None):
+        '''Takes a token from the user's bucket. Returns True if the user
+        had a token, False if the message overflows.
+
+        >>> shaper = ShapingParser(BaseParser(), rate=1, burst=1)
+        >>> shaper.admit(1, now=0), shaper.admit(1, now=0)
+        (True, False)
+        >>> shaper.admit(1, now=1)
+        True
+
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            bucket = self.__bucket(user, now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return True
+            return False
+
+    def parse(self, token):
+        '''Passes the message to the wrapped parser if its user has a token,
+        otherwise applies the overflow policy.'''
+        if self.spill and time.time() - self._last_drain >= \
+           SPILL_DRAIN_INTERVAL:
+            self.drain()
+
+        user = extract_for_user(token)
+        if user is None:
+            with self._lock:
+                self.passed += 1
+            self.parser.parse(token)
+            return
+
+        now = time.time()
+        with self._lock:
+            bucket = self.__bucket(user, now)
+            # If earlier messages are deferred, this one must wait too.
+            if bucket.tokens >= 1 and not bucket.deferred:
+                bucket.tokens -= 1
+                admitted = True
+            else:
+                admitted = self.__overflow(bucket, user, token)
+            if admitted:
+                self.passed += 1
+
+        if admitted:
+            self.parser.parse(token)
+
+    def __overflow(self, bucket, user, token):
+        '''Applies the overflow policy to a message. Returns True if the
+        message should be parsed anyway. Must be called with the lock
+        held.'''
+        bucket.overflowed += 1
+        self.overflowed += 1
+        if self.policy == 'sample' and \
+           bucket.overflowed % self.sample_every == 0:
+            return True
+        if self.policy == 'defer' and len(self.spill) < self.spill_size:
+            bucket.deferred += 1
+            self.deferred += 1
+            self.spill.append((user, token))
+            return False
+        bucket.dropped += 1
+        self.dropped += 1
+        return False
+
+    def drain(self, now=None):
+        '''Parses every deferred message whose user's bucket has refilled.
+        This is called periodically by parse and by ListenThreadMonitor's
+        maintain method. Returns the number of messages parsed.
+
+        A user's deferred count only goes down once each message has been
+        parsed, so their new messages keep queueing behind it until then.
+        Only one drain runs at a time: if another is running, this returns
+        0 straight away.
+
+        >>> class ListParser(BaseParser):
+        ...     parsed = []
+        ...     def parse(self, token):
+        ...         self.parsed.append(token)
+        >>> shaper = ShapingParser(ListParser(), rate=1, burst=1,
+        ...                        policy='defer')
+        >>> for x in range(3):
+        ...     shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        >>> len(ListParser.parsed), len(shaper.spill)
+        (1, 2)
+        >>> shaper.drain(now=shaper.buckets[1].last + 1)
+        1
+        >>> ListParser.parsed[-1]
+        '{"for_user":1,"message":{"id":1}}'
+
+        '''
+        if now is None:
+            now = time.time()
+        if not self._drain_lock.acquire(False):
+            return 0
+        try:
+            ready = []
+            with self._lock:
+                self._last_drain = now
+                blocked = set()
+                for x in xrange(len(self.spill)):
+                    user, token = self.spill.popleft()
+                    bucket = self.__bucket(user, now) \
+                        if user not in blocked else None
+                    if bucket is not None and bucket.tokens >= 1:
+                        bucket.tokens -= 1
+                        ready.append((bucket, token))
+                    else:
+                        blocked.add(user)
+                        self.spill.append((user, token))
+
+            for bucket, token in ready:
+                try:
+                    self.parser.parse(token)
+                except Exception:
+                    logger.error("Unhandled exception parsing a deferred "
+                                 "message.", exc_info=True)
+                with self._lock:
+                    bucket.deferred -= 1
+                    self.passed += 1
+        finally:
+            self._drain_lock.release()
+        return len(ready)
+
+    def close(self, timeout=None):
+        '''Parses every deferred message whose user's bucket has refilled,
+        discards the rest and closes the wrapped parser. Returns the number
+        of messages discarded and dropped by the wrapped parser.
+
+        >>> shaper = ShapingParser(BaseParser(), rate=1, burst=0,
+        ...                        policy='defer')
+        >>> shaper.parse('{"for_user":1}')
+        >>> shaper.close()
+        1
+
+        '''
+        self.drain()
+        with self._lock:
+            dropped = len(self.spill)
+            for user, token in self.spill:
+                bucket = self.buckets[user]
+                bucket.dropped += 1
+                bucket.deferred -= 1
+            self.spill.clear()
+            self.dropped += dropped
+        return dropped + self.parser.close(timeout)
+
+    @property
+    def drops(self):
+        '''Returns a dictionary mapping users to the number of their
+        messages that have been discarded, including users whose buckets
+        were evicted.'''
+        with self._lock:
+            drops = dict(self.evicted_drops)
+            for user, bucket in self.buckets.iteritems():
+                if bucket.dropped:
+                    drops[user] = drops.get(user, 0) + bucket.dropped
+            return drops
+
+    def top_drops(self, count=10):
+        '''Returns the count users with the most discarded messages as
+        (user, dropped) pairs.
+
+        >>> class NullParser(BaseParser):
+        ...     def parse(self, token):
+        ...         pass
+        >>> shaper = ShapingParser(NullParser(), rate=1, burst=1)
+        >>> for x in (1, 2, 2):
+        ...     shaper.parse('{"for_user":%s}' % x)
+        >>> shaper.top_drops()
+        [(2, 1)]
+
+        '''
+        drops = self.drops
+        return sorted(drops.items(), key=lambda x: x[1], reverse=True)[:count]
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of shaping metrics.
+
+        >>> sorted(ShapingParser(BaseParser()).stats.keys())
+        ['deferred', 'dropped', 'evictions', 'overflowed', 'passed', 'spill', 'top_drops', 'users']
+
+        '''
+        return {
+            'passed': self.passed,
+            'dropped': self.dropped,
+            'deferred': self.deferred,
+            'evictions': self.evictions,
+            'overflowed': self.overflowed,
+            'spill': len(self.spill),
+            'users': len(self.buckets),
+            'top_drops': self.top_drops(),
+        }
@@ -0,0 +1,220 @@
+import time
+import random
+import logging
+import oauth2 as oauth
+
+from listener import SiteStream, FOLLOW_LIMIT
+from thread import ListenThread
+from monitor import ListenThreadMonitor, MONITOR_SLEEP_INTERVAL
+from follow import FollowSet
+from clock import VirtualClock
+from error import SitebucketError
+from stats import Histogram
+
+logger = logging.getLogger("sitebucket")
+
+SIMULATED_CONNECT_DELAY = 2
+
+
+class SimulatedStream(SiteStream):
+    '''A SiteStream that never touches the network. Its thread connects it
+    in the simulation's virtual time, control requests are applied without
+    being sent and it never sleeps, so hundreds of thousands of them can be
+    managed by one monitor.'''
+
+    def sleep(self, stime=None, update_error_count=True,
+              close_connection=True):
+        '''Updates the stream's backoff state without sleeping.'''
+        self.running = False
+        if update_error_count:
+            self.error_count += 1
+        if stime is None:
+            self.retry_time *= self.retry_time
+
+    def add_users(self, follow):
+        '''Adds users to the stream if it is ready, as if its control URI
+        had accepted them.'''
+        if not self.ready:
+            raise SitebucketError('Stream %s is not ready.' % self.stream_id)
+        follow = FollowSet(follow) - self.follow
+        if len(self.follow) + len(follow) > FOLLOW_LIMIT:
+            raise SitebucketError('Adding %s users would exceed the follow '
+                                  'limit: %s.' % (len(follow), FOLLOW_LIMIT))
+        self.follow = self.follow | follow
+
+    def listen(self):
+        raise SitebucketError('Simulated streams can not listen.')
+
+
+class SimulatedThread(object):
+    '''Stands in for a ListenThread without starting an OS thread. Starting
+    it asks its monitor to connect the stream after the monitor's
+    connect_delay. The thread stays alive while the stream connects, runs
+    or backs off, until it is closed or its monitor fails it.'''
+    def __init__(self, stream, monitor):
+        '''Returns a SimulatedThread object.'''
+        self.stream = stream
+        self.monitor = monitor
+        self.daemon = True
+        self.ident = None
+        self.started = False
+        self.exited = False
+
+    @property
+    def connection_healthy(self):
+        '''Returns True unless the stream has failed, like
+        ListenThread.connection_healthy.'''
+        return ListenThread.connection_healthy.fget(self)
+
+    def start(self):
+        self.started = True
+        self.monitor.connect(self.stream)
+
+    def restart(self):
+        if self.is_alive():
+            raise SitebucketError('Thread for stream %s is still running.'
+                                  % self.stream.stream_id)
+        self.stream.disconnect_issued = False
+        self.stream.reset_throttles()
+        thread = SimulatedThread(self.stream, self.monitor)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.stream.disconnect()
+
+    def is_alive(self):
+        return self.started and not self.exited and \
+            not self.stream.disconnect_issued
+
+    def join(self, timeout=None):
+        pass
+
+
+class SimulatedMonitor(ListenThreadMonitor):
+    '''A ListenThreadMonitor whose streams are in-memory SimulatedStreams
+    and whose loop runs on a VirtualClock, for measuring how the control
+    plane (health checks, restarts, consolidation) scales with the number
+    of streams. Nothing is sent over the network and nothing sleeps.
+
+    Drive it with tick, which advances the clock by one monitor interval,
+    connects streams whose connect_delay has passed and runs maintain once.
+    fail and run's script inject failures: a failed stream has exhausted
+    its retries, so the monitor must notice it and restart it. The virtual
+    time from each failure until the stream is connected again is recorded
+    in restart_latency, and the wall time of every maintain pass in
+    tick_time.
+
+    Keyword arguments are identical to ListenThreadMonitor, except that
+    consumer and token are optional, with the following additions:
+
+    * connect_delay -- the virtual seconds a stream takes to connect
+    * seed -- the seed of the random generator that picks failed streams
+
+    >>> monitor = SimulatedMonitor(range(1, 1001))
+    >>> monitor.start_streams()
+    >>> monitor.tick()
+    >>> len(monitor.healthy_streams)
+    10
+    >>> monitor.fail(3)
+    >>> monitor.run_ticks(2)
+    >>> monitor.restart_latency.count, len(monitor.healthy_streams)
+    (3, 10)
+
+    '''
+    stream_class = SimulatedStream
+
+    def __init__(self, follow, consumer=None, token=None,
+                 connect_delay=SIMULATED_CONNECT_DELAY, seed=None, **kwargs):
+        '''Returns a SimulatedMonitor object.'''
+        self.connect_delay = connect_delay
+        self.random = random.Random(seed)
+        self.connecting = {}
+        self.failed_at = {}
+        self.tick_time = Histogram()
+        self.restart_latency = Histogram()
+        self.ticks = 0
+        self.thread_class = lambda stream: SimulatedThread(stream, self)
+        kwargs.setdefault('clock', VirtualClock())
+        super(SimulatedMonitor, self).__init__(
+            follow, consumer or oauth.Consumer('simulated', 'simulated'),
+            token or oauth.Token('simulated', 'simulated'), **kwargs)
+
+    def connect(self, stream):
+        '''Starts connecting a stream. It connects connect_delay virtual
+        seconds from now.'''
+        stream.initialized = True
+        stream.running = False
+        self.connecting[stream] = self.clock.time() + self.connect_delay
+
+    def start_streams(self):
+        '''Starts every stream, as run does.'''
+        for thread in self.threads:
+            thread.start()
+        self.running = True
+
+    def fail(self, count=1):
+        '''Fails count randomly chosen connected streams. Each stream
+        exhausts its retries and its thread exits.'''
+        connected = [x for x in self.threads if x.stream.running]
+        now = self.clock.time()
+        for thread in self.random.sample(connected, min(count,
+                                                        len(connected))):
+            thread.exited = True
+            thread.stream.running = False
+            thread.stream.error_count = thread.stream.retry_limit
+            self.failed_at[thread.stream.stream_id] = now
+
+    def tick(self, interval=MONITOR_SLEEP_INTERVAL):
+        '''Advances the clock by interval seconds, connects the streams
+        whose connect delay has passed and runs the monitor's maintenance
+        pass once.'''
+        self.clock.sleep(interval)
+        now = self.clock.time()
+        for stream, connect_at in self.connecting.items():
+            if connect_at > now:
+                continue
+            del self.connecting[stream]
+            if stream.disconnect_issued:
+                continue
+            stream.running = True
+            stream.control_uri = '/1.1/site/c/%s' % stream.stream_id
+            failed_at = self.failed_at.pop(stream.stream_id, None)
+            if failed_at is not None:
+                self.restart_latency.record(now - failed_at)
+
+        start = time.time()
+        self.maintain()
+        self.tick_time.record(time.time() - start)
+        self.ticks += 1
+
+    def run_ticks(self, ticks, script=None, interval=MONITOR_SLEEP_INTERVAL):
+        '''Runs a number of ticks.
+
+        * script -- (optional) a dictionary mapping tick numbers (counting from 0) to the number of streams to fail before that tick
+
+        '''
+        script = script or {}
+        for x in xrange(ticks):
+            if script.get(x):
+                self.fail(script[x])
+            self.tick(interval)
+
+    def run(self):
+        raise SitebucketError('Drive a SimulatedMonitor with tick.')
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of simulation metrics.
+
+        >>> sorted(SimulatedMonitor([1]).stats.keys())
+        ['connecting', 'restart_latency', 'streams', 'tick_time', 'ticks']
+
+        '''
+        return {
+            'streams': len(self.threads),
+            'connecting': len(self.connecting),
+            'ticks': self.ticks,
+            'tick_time': self.tick_time.stats,
+            'restart_latency': self.restart_latency.stats,
+        }
@@ -0,0 +1,311 @@
+import os
+import gzip
+import time
+import sqlite3
+import threading
+import logging
+
+from parser import BaseParser
+from stats import Histogram, LATENCY_BOUNDS, SIZE_BOUNDS
+from util import extract_for_user
+
+logger = logging.getLogger("sitebucket")
+
+SINK_BATCH_SIZE = 500
+SINK_MAX_DELAY = 1.0
+ROTATE_BYTES = 64 * 1024 * 1024
+ROTATE_INTERVAL = 3600
+
+
+class BatchSink(BaseParser):
+    '''BatchSink is a prototype for parsers that store messages in batches.
+    Messages are buffered and written together (group commit) once
+    batch_size messages are waiting or the oldest waiting message is
+    max_delay seconds old, whichever comes first. Sinks are thread safe, so
+    one sink can be shared by every stream in a monitor.
+
+    Sub-classes must override write, and may override convert to change
+    what is buffered for each message (or skip it, by returning None) and
+    release to free resources when the sink is closed.
+
+    Keyword arguments:
+
+    * batch_size -- the number of buffered messages that triggers a write
+    * max_delay -- the maximum number of seconds a message is buffered
+
+    Write latency and batch sizes are recorded in the write_latency and
+    batch_sizes histograms. A batch whose write fails is logged and
+    counted in dropped.
+
+    '''
+    def __init__(self, batch_size=SINK_BATCH_SIZE, max_delay=SINK_MAX_DELAY):
+        '''Returns a BatchSink object.'''
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.write_latency = Histogram(LATENCY_BOUNDS)
+        self.batch_sizes = Histogram(SIZE_BOUNDS)
+        self.written = 0
+        self.dropped = 0
+
+        self._batch = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+    def convert(self, token):
+        '''Returns the value buffered for a message. Returns the stripped
+        message by default.'''
+        return token.strip()
+
+    def write(self, batch):
+        '''This method must be overridden. It should store a list of
+        converted messages.'''
+        raise NotImplementedError
+
+    def release(self):
+        '''Frees any resources held by the sink. Called by close.'''
+        pass
+
+    def parse(self, token):
+        '''Buffers the message and writes the batch if it is full.'''
+        if self._flusher is None:
+            self.__start_flusher()
+
+        value = self.convert(token)
+        if value is None:
+            return
+
+        with self._lock:
+            self._batch.append(value)
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._batch) >= self.batch_size
+
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Sink write failed.", exc_info=True)
+
+    def flush(self):
+        '''Writes all buffered messages. If the write fails, the batch is
+        counted in dropped and the exception is raised.'''
+        with self._write_lock:
+            with self._lock:
+                batch, self._batch = self._batch, []
+                self._oldest = None
+
+            if not batch:
+                return
+
+            start = time.time()
+            try:
+                self.write(batch)
+            except Exception:
+                with self._lock:
+                    self.dropped += len(batch)
+                raise
+            self.write_latency.record(time.time() - start)
+            self.batch_sizes.record(len(batch))
+            self.written += len(batch)
+
+    def close(self, timeout=None):
+        '''Writes all buffered messages, stops the flusher thread and
+        releases the sink's resources. Returns the number of messages that
+        were dropped because their batch failed to write.'''
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout)
+
+        try:
+            self.flush()
+        except Exception:
+            logger.error("Final sink write failed.", exc_info=True)
+        self.release()
+        return self.dropped
+
+    def __start_flusher(self):
+        '''Starts a daemon thread that writes batches whose oldest message
+        has waited max_delay seconds.'''
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self.__flush_loop,
+                                             name='SinkFlusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __flush_loop(self):
+        while not self._closed.wait(self.max_delay / 4.0) \
+              and not self._closed.is_set():
+            oldest = self._oldest
+            if oldest is not None and time.time() - oldest >= self.max_delay:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.error("Sink write failed.", exc_info=True)
+
+    @property
+    def pending(self):
+        '''Returns the number of buffered messages.'''
+        return len(self._batch)
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of sink metrics.'''
+        return {
+            'written': self.written,
+            'pending': self.pending,
+            'dropped': self.dropped,
+            'write_latency': self.write_latency.stats,
+            'batch_size': self.batch_sizes.stats,
+        }
+
+
+class SQLiteSink(BatchSink):
+    '''A sink that inserts every message into a SQLite table with
+    executemany, committing one transaction per batch. The database is put
+    in WAL mode so readers don't block writes.
+
+    Each row stores the message's for_user id (when it has one), the time
+    it was received and the raw JSON.
+
+    Keyword arguments are identical to BatchSink with the following
+    additions:
+
+    * path -- the location of the SQLite database
+    * table -- the name of the table messages are inserted into
+
+    >>> sink = SQLiteSink(':memory:', batch_size=2)
+    >>> sink.parse('{"for_user":1,"message":{"text":"hi!"}}\\r\\n')
+    >>> sink.pending
+    1
+    >>> sink.parse('{"for_user":2,"message":{"text":"hi!"}}\\r\\n')
+    >>> sink.pending
+    0
+    >>> sink.db.execute('SELECT for_user, data FROM messages').fetchall()
+    [(1, u'{"for_user":1,"message":{"text":"hi!"}}'), (2, u'{"for_user":2,"message":{"text":"hi!"}}')]
+    >>> sink.close()
+    0
+
+    '''
+    def __init__(self, path, table='messages', batch_size=SINK_BATCH_SIZE,
+                 max_delay=SINK_MAX_DELAY):
+        '''Returns a SQLiteSink object.'''
+        super(SQLiteSink, self).__init__(batch_size, max_delay)
+        self.path = path
+        self.table = table
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY '
+                        'KEY, for_user INTEGER, received REAL, data TEXT)'
+                        % table)
+        self.db.commit()
+        self._insert = 'INSERT INTO %s (for_user, received, data) ' \
+                       'VALUES (?, ?, ?)' % table
+
+    def convert(self, token):
+        '''Returns a row for the message.'''
+        token = token.strip()
+        return (extract_for_user(token), time.time(),
+                token.decode('utf-8', 'replace'))
+
+    def write(self, batch):
+        '''Inserts a batch of rows in a single transaction. The transaction
+        is rolled back if the batch fails, so none of its rows are kept.'''
+        try:
+            self.db.executemany(self._insert, batch)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def release(self):
+        '''Closes the database connection.'''
+        self.db.close()
+
+
+class NDJSONFileSink(BatchSink):
+    '''A sink that appends messages to newline delimited JSON files, one
+    message per line. Each batch is written with a single call. Files are
+    rotated once they reach rotate_bytes bytes or are rotate_interval
+    seconds old, and are gzip compressed if compress is True.
+
+    Keyword arguments are identical to BatchSink with the following
+    additions:
+
+    * directory -- the directory files are created in
+    * prefix -- the prefix of every file name
+    * compress -- if True, files are gzip compressed
+    * rotate_bytes -- the uncompressed size at which a file is rotated
+    * rotate_interval -- the age in seconds at which a file is rotated
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> sink = NDJSONFileSink(directory, batch_size=2, rotate_bytes=50)
+    >>> for x in range(4):
+    ...     sink.parse('{"for_user":%s,"message":{"text":"hi!"}}\\r\\n' % x)
+    >>> sink.close()
+    0
+    >>> len(sink.files)
+    2
+    >>> gzip.open(sink.files[0]).read().splitlines()[0]
+    '{"for_user":0,"message":{"text":"hi!"}}'
+    >>> shutil.rmtree(directory)
+
+    '''
+    def __init__(self, directory, prefix='sitebucket', compress=True,
+                 rotate_bytes=ROTATE_BYTES, rotate_interval=ROTATE_INTERVAL,
+                 batch_size=SINK_BATCH_SIZE, max_delay=SINK_MAX_DELAY):
+        '''Returns a NDJSONFileSink object.'''
+        super(NDJSONFileSink, self).__init__(batch_size, max_delay)
+        self.directory = directory
+        self.prefix = prefix
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.files = []
+
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = None
+
+    def write(self, batch):
+        '''Appends a batch of messages to the current file, rotating it
+        first if necessary.'''
+        if self._file is None or self._file_bytes >= self.rotate_bytes \
+           or time.time() - self._file_opened >= self.rotate_interval:
+            self.rotate()
+
+        data = '\n'.join(batch) + '\n'
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+
+    def rotate(self):
+        '''Closes the current file and opens a new one.'''
+        self.release()
+
+        name = '%s-%s-%s.ndjson' % (self.prefix,
+                                    time.strftime('%Y%m%d-%H%M%S'),
+                                    len(self.files))
+        path = os.path.join(self.directory, name)
+        if self.compress:
+            path += '.gz'
+            self._file = gzip.open(path, 'ab')
+        else:
+            self._file = open(path, 'ab')
+
+        logger.info("Writing messages to %s." % path)
+        self.files.append(path)
+        self._file_bytes = 0
+        self._file_opened = time.time()
+
+    def release(self):
+        '''Closes the current file.'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,220 @@
+import logging
+
+from error import SitebucketError
+from clock import SYSTEM_CLOCK
+
+logger = logging.getLogger("sitebucket")
+
+STARTUP_CONCURRENCY = 10
+STARTUP_RATE = 5.0
+STARTUP_CONNECT_TIMEOUT = 60.0
+STARTUP_POLL_INTERVAL = .1
+DEFAULT_TIER = 100
+
+
+class StartupScheduler(object):
+    '''The StartupScheduler starts ListenThreads in waves instead of all at
+    once. No more than concurrency streams are allowed to be connecting at
+    the same time and no more than rate threads are started per second.
+    Threads following users in a higher priority tier are started first.
+
+    Ramp-up is incremental: schedule queues threads and each call to step
+    starts as many as the limits allow right now, without waiting, so a
+    ListenThreadMonitor keeps maintaining (and restarting) the streams it
+    has already started while the rest ramp up. start runs the whole
+    ramp-up in a blocking loop instead.
+
+    Keyword arguments:
+
+    * concurrency -- the maximum number of streams that may be connecting at once
+    * rate -- the maximum number of threads started per second
+    * tiers -- a dictionary mapping user ids to priority tiers. Lower tiers are started first. Users that aren't listed are in DEFAULT_TIER.
+    * connect_timeout -- seconds after which a stream that still hasn't connected no longer counts against the concurrency limit
+    * clock -- (optional) the clock.Clock used to pace ramp-up. ListenThreadMonitor sets this to its own clock automatically.
+
+    Pass a StartupScheduler to a ListenThreadMonitor to use it:
+
+    >>> from sitebucket import ListenThreadMonitor
+    >>> scheduler = StartupScheduler(concurrency=20, rate=10)
+    >>> monitor = ListenThreadMonitor(range(1, 1001), consumer, token,
+    ...                               startup=scheduler)
+
+    '''
+    def __init__(self, concurrency=STARTUP_CONCURRENCY, rate=STARTUP_RATE,
+                 tiers=None, connect_timeout=STARTUP_CONNECT_TIMEOUT,
+                 clock=None):
+        '''Returns a StartupScheduler object.'''
+        if concurrency < 1:
+            raise SitebucketError('Startup concurrency must be at least 1.')
+        self.concurrency = concurrency
+        self.rate = rate
+        self.tiers = tiers or {}
+        self.connect_timeout = connect_timeout
+        self.clock = clock or SYSTEM_CLOCK
+
+        self.threads = []
+        self.pending = []
+        self.started = {}
+        # Streams rather than threads, since a restarted stream gets a new
+        # thread.
+        self.connected = set()
+        self.started_at = None
+        self.last_start = None
+        self.time_to_all_connected = None
+
+    def priority(self, thread):
+        '''Returns the priority tier of a thread, which is the highest
+        priority (lowest) tier of any user its stream follows.
+
+        >>> from sitebucket import SiteStream, ListenThread
+        >>> scheduler = StartupScheduler(tiers={2: 0, 3: 1})
+        >>> scheduler.priority(ListenThread(SiteStream([1, 2], consumer, token)))
+        0
+        >>> scheduler.priority(ListenThread(SiteStream([1], consumer, token)))
+        100
+
+        '''
+        return min([self.tiers.get(x, DEFAULT_TIER) for x in thread.stream.follow]
+                   or [DEFAULT_TIER])
+
+    @property
+    def connecting(self):
+        '''Returns a list of started threads whose streams are still
+        attempting to connect.'''
+        now = self.clock.time()
+        return [x for x in self.started
+                if x.stream not in self.connected
+                and x.is_alive() and x.stream.retry_ok
+                and now - self.started[x] < self.connect_timeout]
+
+    @property
+    def complete(self):
+        '''Returns True once every scheduled thread has been started and its
+        stream has connected, given up (exhausted its retries) or been
+        disconnected.
+
+        >>> StartupScheduler().complete
+        True
+
+        '''
+        if self.pending:
+            return False
+        return all(x.stream in self.connected or not x.stream.retry_ok
+                   or x.stream.disconnect_issued for x in self.threads)
+
+    @property
+    def progress(self):
+        '''Returns a dictionary describing the progress of the ramp-up.
+
+        >>> sorted(StartupScheduler().progress.keys())
+        ['connected', 'elapsed', 'started', 'time_to_all_connected', 'total']
+
+        '''
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = self.clock.time() - self.started_at
+
+        return {
+            'total': len(self.threads),
+            'started': len(self.started),
+            'connected': len(self.connected),
+            'elapsed': elapsed,
+            'time_to_all_connected': self.time_to_all_connected,
+        }
+
+    def update(self):
+        '''Records which started threads have connected. Once every thread
+        has connected, time_to_all_connected is set and logged.'''
+        for thread in self.started:
+            if thread.stream not in self.connected and thread.stream.running:
+                self.connected.add(thread.stream)
+
+        if self.complete and self.time_to_all_connected is None \
+           and self.started_at is not None:
+            self.time_to_all_connected = self.clock.time() - self.started_at
+            logger.info("All %s streams connected in %.2f seconds."
+                        % (len(self.threads), self.time_to_all_connected))
+
+    def schedule(self, threads):
+        '''Queues threads that haven't been started to be started in
+        priority order by step.
+
+        * threads -- a list of ListenThread objects that haven't been started
+
+        '''
+        self.threads = sorted(threads, key=self.priority)
+        self.pending = list(self.threads)
+        self.started_at = self.clock.time()
+        logger.info("Starting %s threads, %s at a time."
+                    % (len(self.threads), self.concurrency))
+
+    def step(self):
+        '''Starts as many pending threads as the concurrency and rate limits
+        allow right now, and records which streams have connected. Returns
+        the number of threads started.
+
+        >>> scheduler = StartupScheduler()
+        >>> scheduler.schedule([])
+        >>> scheduler.step(), scheduler.complete
+        (0, True)
+
+        '''
+        self.update()
+        interval = 1.0 / self.rate if self.rate else 0
+        connecting = len(self.connecting)
+        count = 0
+        while self.pending and connecting < self.concurrency:
+            now = self.clock.time()
+            if self.last_start is not None and \
+               now - self.last_start < interval:
+                break
+            thread = self.pending.pop(0)
+            if thread.stream.disconnect_issued:
+                # Closed before its turn, e.g. replaced by consolidation.
+                continue
+            thread.start()
+            self.last_start = now
+            self.started[thread] = now
+            connecting += 1
+            count += 1
+
+            if len(self.started) % self.concurrency == 0:
+                logger.info("Started %s of %s threads. %s connected."
+                            % (len(self.started), len(self.threads),
+                               len(self.connected)))
+        return count
+
+    def delay(self):
+        '''Returns the number of seconds until step may start another
+        thread, or None if no threads are pending.'''
+        if not self.pending:
+            return None
+        if self.rate and self.last_start is not None:
+            wait = self.last_start + 1.0 / self.rate - self.clock.time()
+            return max(wait, STARTUP_POLL_INTERVAL)
+        return STARTUP_POLL_INTERVAL
+
+    def start(self, threads, stop=lambda: False):
+        '''Starts the specified threads in priority order, respecting the
+        concurrency and rate limits. Blocks until every thread has been
+        started or stop returns True.
+
+        * threads -- a list of ListenThread objects that haven't been started
+        * stop -- a callable that returns True when ramp-up should be aborted
+
+        >>> scheduler = StartupScheduler()
+        >>> scheduler.start([])
+        >>> scheduler.complete
+        True
+
+        '''
+        self.schedule(threads)
+        while self.pending:
+            if stop():
+                logger.info("Ramp-up aborted after starting %s of %s threads."
+                            % (len(self.started), len(self.threads)))
+                self.pending = []
+                break
+            if not self.step():
+                self.clock.sleep(self.delay() or 0)
+        self.update()
@@ -0,0 +1,118 @@
+import bisect
+import threading
+
+
+def _series(start, stop):
+    '''Returns a 1-2-5 series of bucket bounds from start to stop.
+
+    >>> _series(1, 100)
+    [1, 2, 5, 10, 20, 50, 100]
+
+    '''
+    bounds = []
+    scale = start
+    while scale <= stop:
+        for step in (1, 2, 5):
+            if scale * step <= stop:
+                bounds.append(scale * step)
+        scale *= 10
+    return bounds
+
+# Bucket bounds for durations in seconds, from a microsecond to an hour.
+LATENCY_BOUNDS = [x / 1000000.0 for x in _series(1, 10 ** 10)]
+
+# Bucket bounds for sizes and counts.
+SIZE_BOUNDS = [2 ** x for x in xrange(24)]
+
+
+class Histogram(object):
+    '''A thread safe histogram with fixed bucket bounds. Each recorded value
+    is counted in the first bucket whose bound is greater than or equal to
+    it, so percentiles are reported as bucket bounds.
+
+    * bounds -- a sorted list of bucket bounds. Values larger than the last bound are counted in an overflow bucket.
+
+    >>> histogram = Histogram([1, 2, 5, 10])
+    >>> for x in (.5, 1.5, 3, 4, 7, 20):
+    ...     histogram.record(x)
+    >>> histogram.count, histogram.min, histogram.max
+    (6, 0.5, 20)
+    >>> histogram.percentile(50)
+    5
+    >>> histogram.percentile(100)
+    20
+
+    '''
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        '''Returns a Histogram object.'''
+        self.bounds = list(bounds)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Clears all recorded values.'''
+        with self._lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def record(self, value):
+        '''Records a value.'''
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    @property
+    def mean(self):
+        '''Returns the mean of the recorded values, or None.
+
+        >>> Histogram().mean is None
+        True
+
+        '''
+        if not self.count:
+            return None
+        return self.total / float(self.count)
+
+    def percentile(self, percent):
+        '''Returns the bound of the bucket containing the specified
+        percentile, or None if nothing has been recorded. Values in the
+        overflow bucket are reported as the maximum recorded value.'''
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    @property
+    def stats(self):
+        '''Returns a dictionary summarizing the recorded values.
+
+        >>> sorted(Histogram().stats.keys())
+        ['count', 'max', 'mean', 'min', 'p50', 'p90', 'p99']
+
+        '''
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
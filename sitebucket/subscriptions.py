@@ -0,0 +1,218 @@
+import weakref
+import threading
+import collections
+import logging
+
+from parser import BaseParser
+from message import Message
+from error import SitebucketError
+from util import extract_for_user
+
+logger = logging.getLogger("sitebucket")
+
+
+class _HandlerRef(object):
+    '''A weak reference to a handler. Bound methods are held as a weak
+    reference to their object plus the underlying function, since a bound
+    method object dies as soon as it has been created.'''
+    __slots__ = ('ref', 'func')
+
+    def __init__(self, handler, callback):
+        try:
+            if getattr(handler, 'im_self', None) is not None:
+                self.ref = weakref.ref(handler.im_self, callback)
+                self.func = handler.im_func
+            else:
+                self.ref = weakref.ref(handler, callback)
+                self.func = None
+        except TypeError:
+            raise SitebucketError("%r can't be weakly referenced." % handler)
+
+    def __call__(self):
+        '''Returns the handler, or None if it has been garbage collected.'''
+        target = self.ref()
+        if target is None or self.func is None:
+            return target
+        return self.func.__get__(target, type(target))
+
+    def matches(self, handler):
+        if getattr(handler, 'im_self', None) is not None:
+            return self.ref() is handler.im_self and \
+                self.func is handler.im_func
+        return self.func is None and self.ref() is handler
+
+
+class SubscriptionRegistry(BaseParser):
+    '''The SubscriptionRegistry passes each user's messages to the handlers
+    subscribed to that user, like one websocket per logged in user. Finding
+    a message's handlers is a single dictionary lookup on the for_user id,
+    which is read from the raw message, so messages for users without
+    subscribers are dropped without being decoded.
+
+    Handlers are called with the for_user id and the message (a lazy
+    message.LazyObject) from the stream thread that delivered it. Every
+    message with a for_user id is delivered, not just tweets.
+
+    The registry only holds weak references to handlers, so a subscription
+    ends when its handler is garbage collected and the registry never keeps
+    a closed connection alive. The caller must keep a reference to each
+    handler it registers (a lambda passed straight to register is collected
+    at once). Bound methods are held by a weak reference to their object.
+
+    Subscriptions can be changed from any thread while streams are running.
+    Updates replace a user's handlers instead of modifying them, so parse
+    never waits on an update.
+
+    >>> class Socket(object):
+    ...     def send(self, for_user, message):
+    ...         print for_user, message['text']
+    >>> socket = Socket()
+    >>> registry = SubscriptionRegistry()
+    >>> registry.register(1, socket.send)
+    >>> registry.parse('{"for_user":1,"message":{"text":"hi!"}}')
+    1 hi!
+    >>> registry.parse('{"for_user":2,"message":{"text":"hi!"}}')
+    >>> del socket
+    >>> registry.parse('{"for_user":1,"message":{"text":"hi!"}}')
+    >>> registry.stats['users']
+    0
+
+    '''
+    def __init__(self):
+        '''Returns a SubscriptionRegistry object.'''
+        # Users map to a tuple of _HandlerRefs. Entries are only ever
+        # replaced or removed, so parse can read them without the lock.
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        # Users whose handlers have been collected. Weak reference callbacks
+        # can run at any time, even while the lock is held, so they only
+        # record the user and the next update prunes it.
+        self._dead = collections.deque()
+        self.messages = 0
+        self.dropped = 0
+        self.deliveries = 0
+        self.errors = 0
+
+    def register(self, user, handler):
+        '''Subscribes a handler to a user's messages. Registering the same
+        handler for a user twice does nothing.
+
+        * user -- the user id
+        * handler -- a callable taking the for_user id and the message
+
+        '''
+        self.update(register=[(user, handler)])
+
+    def unregister(self, user, handler=None):
+        '''Unsubscribes a handler from a user's messages, or every handler
+        if handler is None.'''
+        self.update(unregister=[(user, handler)])
+
+    def update(self, register=(), unregister=()):
+        '''Registers and unregisters many subscriptions at once, holding
+        the lock only once. Unsubscriptions are applied first.
+
+        * register -- an iterable of (user, handler) pairs
+        * unregister -- an iterable of (user, handler) pairs. A handler of None unsubscribes every handler of the user.
+
+        >>> def handler(for_user, message): pass
+        >>> registry = SubscriptionRegistry()
+        >>> registry.update(register=[(x, handler) for x in range(3)])
+        >>> registry.update(unregister=[(0, handler), (1, None)])
+        >>> registry.users
+        [2]
+
+        '''
+        with self._lock:
+            for user, handler in unregister:
+                user = int(user)
+                refs = self._subscriptions.get(user, ())
+                if handler is not None:
+                    refs = tuple(x for x in refs if not x.matches(handler))
+                    if refs:
+                        self._subscriptions[user] = refs
+                        continue
+                self._subscriptions.pop(user, None)
+
+            for user, handler in register:
+                user = int(user)
+                refs = self._subscriptions.get(user, ())
+                if any(x.matches(handler) for x in refs):
+                    continue
+                callback = lambda ref, user=user: self._dead.append(user)
+                self._subscriptions[user] = refs + \
+                    (_HandlerRef(handler, callback),)
+            self.__prune()
+
+    def prune(self):
+        '''Removes the subscriptions of handlers that have been garbage
+        collected. This is done whenever subscriptions are updated.'''
+        with self._lock:
+            self.__prune()
+
+    def __prune(self):
+        '''Must be called with the lock held.'''
+        while self._dead:
+            user = self._dead.popleft()
+            refs = tuple(x for x in self._subscriptions.get(user, ())
+                         if x.ref() is not None)
+            if refs:
+                self._subscriptions[user] = refs
+            else:
+                self._subscriptions.pop(user, None)
+
+    def handlers(self, user):
+        '''Returns a list of the live handlers subscribed to a user.'''
+        refs = self._subscriptions.get(int(user), ())
+        return [x for x in (ref() for ref in refs) if x is not None]
+
+    @property
+    def users(self):
+        '''Returns a sorted list of the users with subscriptions.'''
+        return sorted(self._subscriptions)
+
+    def parse(self, token):
+        '''Passes the message to every handler subscribed to its for_user
+        user. Messages for users without subscribers are dropped without
+        being decoded.'''
+        self.messages += 1
+        user = extract_for_user(token)
+        refs = self._subscriptions.get(user) if user is not None else None
+        if not refs:
+            self.dropped += 1
+            return
+
+        message = Message(token).get('message')
+        dead = False
+        for ref in refs:
+            handler = ref()
+            if handler is None:
+                dead = True
+                continue
+            self.deliveries += 1
+            try:
+                handler(user, message)
+            except Exception:
+                self.errors += 1
+                logger.error("Unhandled exception in subscription handler "
+                             "for user %s.", user, exc_info=True)
+        if dead and self._dead:
+            self.prune()
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of subscription metrics.
+
+        >>> sorted(SubscriptionRegistry().stats.keys())
+        ['deliveries', 'dropped', 'errors', 'handlers', 'messages', 'users']
+
+        '''
+        subscriptions = self._subscriptions.values()
+        return {
+            'messages': self.messages,
+            'dropped': self.dropped,
+            'deliveries': self.deliveries,
+            'errors': self.errors,
+            'users': len(subscriptions),
+            'handlers': sum(len(x) for x in subscriptions),
+        }
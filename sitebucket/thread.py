@@ -1,5 +1,7 @@
 import threading
 
+from error import SitebucketError
+
 class ListenThread(threading.Thread):
     '''ListenThread is a thread object wrapper for listener.SiteStream
     objects. Instantiate a ListenThread instance with a required SiteStream
@@ -23,8 +25,9 @@ class ListenThread(threading.Thread):
     def connection_healthy(self):
         ''' Returns true if the thread's stream object has not yet initialized
         its connection, its connection is healthy, or it is still attempting
-        to establish a connection. False if connecting failed and all 
-        allotted retry attempts have been exhausted.
+        to establish a connection (including sleeping between attempts).
+        False if connecting failed and all allotted retry attempts have been
+        exhausted, or if the thread has died.
         
         An uninitialized connection:
         
@@ -41,20 +44,23 @@ class ListenThread(threading.Thread):
         '''
         if not self.stream.initialized:
             return True
-            
-        return self.stream.running and self.stream.retry_ok
+        
+        return self.stream.retry_ok and self.is_alive()
     
     def restart(self):
         '''Restart resets the stream object's' failure flags and creates a new
         ListenThread object with the dead thread's stream object. Use this
         method to retry a connection if the connection_healthy property starts
-        to return False.
+        to return False. A thread that is still running must be closed and
+        allowed to exit first, or two threads would read the same stream.
         
         >>> thread = ListenThread(failed_stream)
         >>> thread.restart() #doctest: +SKIP
         <ListenThread(..., ...)>
         
         '''
+        if self.is_alive():
+            raise SitebucketError('Thread %s is still running.' % self.name)
         self.stream.disconnect_issued = False
         self.stream.reset_throttles()
         new_thread = ListenThread(self.stream)
@@ -0,0 +1,205 @@
+import math
+import time
+import threading
+import logging
+
+from parser import BaseParser
+from follow import FollowSet
+from error import SitebucketError
+from util import extract_for_user, grouper
+
+logger = logging.getLogger("sitebucket")
+
+RATE_HALF_LIFE = 60.0
+MINIMUM_RATE = .01
+
+
+class RateTracker(object):
+    '''The RateTracker keeps exponentially decaying byte and message rates
+    for every user that has received traffic. Recent traffic counts more
+    than old traffic, and a user's rate halves every half_life seconds
+    without new messages.
+
+    * half_life -- seconds for an idle user's rate to decay by half
+
+    >>> tracker = RateTracker(half_life=10)
+    >>> tracker.record(1, 500, now=0)
+    >>> tracker.record(1, 500, now=0)
+    >>> round(tracker.rate(1, now=0), 2)
+    69.31
+    >>> round(tracker.rate(1, now=10), 2)
+    34.66
+    >>> tracker.rate(2, now=10)
+    0.0
+
+    '''
+    def __init__(self, half_life=RATE_HALF_LIFE):
+        '''Returns a RateTracker object.'''
+        self.half_life = half_life
+        self._decay = math.log(2) / half_life
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def __decayed(self, entry, now):
+        '''Returns an entry's byte and message totals decayed to now.'''
+        total_bytes, total_messages, last = entry
+        factor = math.exp(-self._decay * max(now - last, 0))
+        return total_bytes * factor, total_messages * factor
+
+    def record(self, user, nbytes, now=None):
+        '''Records a message of nbytes bytes for the specified user.'''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._users.get(user)
+            if entry is None:
+                self._users[user] = (nbytes, 1, now)
+            else:
+                total_bytes, total_messages = self.__decayed(entry, now)
+                self._users[user] = (total_bytes + nbytes,
+                                     total_messages + 1, now)
+
+    def rate(self, user, now=None):
+        '''Returns the user's current rate in bytes per second.'''
+        if now is None:
+            now = time.time()
+        entry = self._users.get(user)
+        if entry is None:
+            return 0.0
+        return self.__decayed(entry, now)[0] * self._decay
+
+    def message_rate(self, user, now=None):
+        '''Returns the user's current rate in messages per second.
+
+        >>> tracker = RateTracker(half_life=10)
+        >>> tracker.record(1, 500, now=0)
+        >>> round(tracker.message_rate(1, now=0), 3)
+        0.069
+
+        '''
+        if now is None:
+            now = time.time()
+        entry = self._users.get(user)
+        if entry is None:
+            return 0.0
+        return self.__decayed(entry, now)[1] * self._decay
+
+    def rates(self, now=None):
+        '''Returns a dictionary mapping every user with traffic to their
+        rate in bytes per second. Users whose rate has decayed below
+        MINIMUM_RATE are forgotten.
+
+        >>> tracker = RateTracker(half_life=1)
+        >>> tracker.record(1, 100, now=0)
+        >>> tracker.rates(now=0).keys()
+        [1]
+        >>> tracker.rates(now=1000)
+        {}
+
+        '''
+        if now is None:
+            now = time.time()
+        rates = {}
+        with self._lock:
+            for user, entry in self._users.items():
+                rate = self.__decayed(entry, now)[0] * self._decay
+                if rate < MINIMUM_RATE:
+                    del self._users[user]
+                else:
+                    rates[user] = rate
+        return rates
+
+    def hot_users(self, threshold, now=None):
+        '''Returns a list of users whose byte rate exceeds threshold,
+        hottest first.
+
+        >>> tracker = RateTracker(half_life=10)
+        >>> tracker.record(1, 10000, now=0)
+        >>> tracker.record(2, 10, now=0)
+        >>> tracker.hot_users(100, now=0)
+        [1]
+
+        '''
+        rates = self.rates(now)
+        return sorted([x for x in rates if rates[x] > threshold],
+                      key=rates.get, reverse=True)
+
+
+class TrafficParser(BaseParser):
+    '''A parser that records the size of every message in a RateTracker,
+    keyed by the message's for_user id, before passing it to the wrapped
+    parser.
+
+    * parser -- an object that extends BaseParser
+    * tracker -- a RateTracker
+
+    >>> from sitebucket import DefaultParser
+    >>> parser = TrafficParser(DefaultParser(), RateTracker())
+    >>> parser.parse('{"for_user":1, "message":{"text":"hi!"}}')
+    For user 1: hi!
+    >>> parser.tracker.rate(1) > 0
+    True
+
+    '''
+    def __init__(self, parser, tracker):
+        '''Returns a TrafficParser object.'''
+        if not isinstance(parser, BaseParser):
+            raise SitebucketError('parser must extend BaseParser.')
+
+        self.parser = parser
+        self.tracker = tracker
+
+    def parse(self, token):
+        '''Records the message's size and passes it to the wrapped parser.'''
+        for_user = extract_for_user(token)
+        if for_user is not None:
+            self.tracker.record(for_user, len(token))
+        self.parser.parse(token)
+
+
+def pack(follow, rates, budget, limit):
+    '''Splits a follow list into groups of at most limit users whose
+    combined byte rate stays under budget wherever possible. Users with
+    traffic are placed first, hottest first, into the first group with room
+    for them (first-fit decreasing). A user whose rate exceeds the budget by
+    itself gets a dedicated group of its own. Users without traffic then
+    fill the remaining room in the other groups.
+
+    * follow -- a FollowSet
+    * rates -- a dictionary mapping users to their byte rates
+    * budget -- the maximum byte rate of a group
+    * limit -- the maximum number of users in a group
+
+    >>> pack(FollowSet(range(1, 8)), {1: 90, 2: 60, 3: 30}, 100, 3)
+    [FollowSet([1, 4, 5]), FollowSet([2, 3, 6]), FollowSet([7])]
+    >>> pack(FollowSet(range(1, 5)), {1: 500}, 100, 3)
+    [FollowSet([1]), FollowSet([2, 3, 4])]
+
+    '''
+    hot = sorted([x for x in rates if x in follow], key=rates.get,
+                 reverse=True)
+    groups = []
+    loads = []
+
+    for user in hot:
+        for index, group in enumerate(groups):
+            if len(group) < limit and loads[index] + rates[user] <= budget:
+                group.append(user)
+                loads[index] += rates[user]
+                break
+        else:
+            groups.append([user])
+            loads.append(rates[user])
+
+    cold = follow - hot
+    position = 0
+    for index, group in enumerate(groups):
+        if loads[index] > budget:
+            continue
+        room = limit - len(group)
+        group.extend(cold[position:position + room])
+        position += room
+
+    groups = [FollowSet(x) for x in groups]
+    groups.extend(grouper(limit, cold[position:]))
+    return groups
@@ -1,3 +1,7 @@
+import re
+import time
+import calendar
+
 def grouper(n, l):
     ''' Split an iterable object into subgroups of size n or smaller.
     Source: http://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks-in-python
@@ -6,4 +10,175 @@ def grouper(n, l):
     ['abc', 'def', 'g']
     '''
     for i in xrange(0, len(l), n):
-        yield l[i:i+n]
\ No newline at end of file
+        yield l[i:i+n]
+
+def remaining(deadline):
+    ''' Returns the number of seconds left until a deadline (a time.time()
+    value), never less than 0, or None if deadline is None. Use it to share
+    one deadline between several blocking calls that take a timeout.
+    
+    >>> remaining(None) is None
+    True
+    >>> remaining(time.time() - 10)
+    0
+    '''
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+FOR_USER_RE = re.compile(r'"for_user"\s*:\s*"?(\d+)')
+MESSAGE_RE = re.compile(r'"message"\s*:\s*')
+
+def extract_for_user(token):
+    ''' Returns the for_user id of a raw site stream message without
+    decoding it, or None if the message doesn't have one.
+    
+    >>> extract_for_user('{"for_user":1888,"message":{"text":"hi"}}')
+    1888
+    >>> extract_for_user('{"for_user":"1888","message":{}}')
+    1888
+    >>> extract_for_user('{"control":{}}') is None
+    True
+    '''
+    match = FOR_USER_RE.search(token)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+class Frame(str):
+    ''' A complete message read from a stream. Frames are strings, so any
+    parser can treat them as raw JSON, but they are also stamped with the
+    time they were received and the id of the stream that received them.
+    
+    >>> frame = Frame('{"some":"json"}', received_at=10.0, stream_id=3)
+    >>> frame
+    '{"some":"json"}'
+    >>> frame.received_at, frame.stream_id
+    (10.0, 3)
+    >>> frame.strip().received_at
+    Traceback (most recent call last):
+      ...
+    AttributeError: 'str' object has no attribute 'received_at'
+    '''
+    def __new__(cls, data, received_at=None, stream_id=None):
+        frame = str.__new__(cls, data)
+        frame.received_at = received_at
+        frame.stream_id = stream_id
+        return frame
+
+
+TIMESTAMP_MS_RE = re.compile(r'"timestamp_ms"\s*:\s*"?(\d+)')
+CREATED_AT_RE = re.compile(r'"([^"]+)"')
+JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+COLON_RE = re.compile(r'\s*:\s*')
+MONTHS = dict((month, index + 1) for index, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec')))
+
+def parse_created_at(created_at):
+    ''' Converts a Twitter created_at string to seconds since the epoch.
+    Returns None if the string can't be parsed.
+    
+    >>> parse_created_at('Wed Aug 27 13:08:45 +0000 2008')
+    1219842525
+    >>> parse_created_at('Wed Aug 27 15:08:45 +0200 2008')
+    1219842525
+    >>> parse_created_at('yesterday') is None
+    True
+    '''
+    try:
+        weekday, month, day, clock, offset, year = created_at.split()
+        hour, minute, second = clock.split(':')
+        seconds = calendar.timegm((int(year), MONTHS[month], int(day),
+                                   int(hour), int(minute), int(second)))
+        sign = -1 if offset[0] == '-' else 1
+        return seconds - sign * (int(offset[1:3]) * 3600 +
+                                 int(offset[3:5]) * 60)
+    except (ValueError, KeyError, IndexError):
+        return None
+
+def find_field(token, name, start=0):
+    ''' Returns the index of the value of a field of the raw JSON object
+    that starts at index start, without decoding it. Fields of nested
+    objects are skipped. Returns None if the object has no such field.
+    
+    >>> token = '{"user":{"id":1},"id":2}'
+    >>> token[find_field(token, 'id'):]
+    '2}'
+    >>> find_field(token, 'name') is None
+    True
+    '''
+    key = '"%s"' % name
+    depth = 0
+    for match in JSON_TOKEN_RE.finditer(token, start):
+        x = match.group()
+        if x == '{' or x == '[':
+            depth += 1
+        elif x == '}' or x == ']':
+            depth -= 1
+            if depth <= 0:
+                return None
+        elif depth == 1 and x == key:
+            colon = COLON_RE.match(token, match.end())
+            if colon:
+                return colon.end()
+    return None
+
+def find_object_end(token, start=0):
+    ''' Returns the index just past the end of the raw JSON object or
+    array that starts at index start, without decoding it. Returns None if
+    it isn't closed.
+    
+    >>> token = '{"message":{"text":"}"},"x":2}'
+    >>> token[11:find_object_end(token, 11)]
+    '{"text":"}"}'
+    >>> find_object_end('{"text":', 0) is None
+    True
+    '''
+    depth = 0
+    for match in JSON_TOKEN_RE.finditer(token, start):
+        x = match.group()
+        if x == '{' or x == '[':
+            depth += 1
+        elif x == '}' or x == ']':
+            depth -= 1
+            if depth <= 0:
+                return match.end()
+    return None
+
+def extract_timestamp(token):
+    ''' Returns the time a raw message was created, in seconds since the
+    epoch, without decoding it. The message's timestamp_ms field is used if
+    it has one, otherwise the created_at field of the message itself (the
+    message object of a site stream envelope). created_at fields of nested
+    objects, like a tweet's user, are ignored. Returns None if there is no
+    timestamp.
+    
+    >>> extract_timestamp('{"for_user":1,"message":{"timestamp_ms":"1219842525500"}}')
+    1219842525.5
+    >>> extract_timestamp('{"for_user":1,"message":{"created_at":"Wed Aug 27 13:08:45 +0000 2008"}}')
+    1219842525
+    >>> extract_timestamp('{"user":{"created_at":"Wed Aug 27 13:08:45 +0000 2008"}}') is None
+    True
+    >>> extract_timestamp('{"friends":[]}') is None
+    True
+    '''
+    match = TIMESTAMP_MS_RE.search(token)
+    if match:
+        return int(match.group(1)) / 1000.0
+    
+    start = token.find('{')
+    if start < 0:
+        return None
+    if FOR_USER_RE.search(token):
+        start = find_field(token, 'message', start)
+        if start is None:
+            return None
+    index = find_field(token, 'created_at', start)
+    if index is None:
+        return None
+    match = CREATED_AT_RE.match(token, index)
+    if match:
+        return parse_created_at(match.group(1))
+    return None
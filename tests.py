@@ -4,7 +4,8 @@ import httplib
 
 import oauth2 as oauth
 
-from sitebucket import SiteStream
+from sitebucket import SiteStream, ListenThread
+from sitebucket.parser import BaseParser
 
 REAL_HTTPSConnection = httplib.HTTPSConnection
 REAL_HTTPConnection = httplib.HTTPConnection
@@ -159,6 +160,1846 @@ class SiteStreamConnectTests(unittest.TestCase):
         resp = self.stream.connect()
         self.assertEqual(resp, None)
 
+class SignedRequestTests(unittest.TestCase):
+    def setUp(self):
+        self.stream = SiteStream(follow, oauth.Consumer('c key', 'c~secret'),
+                                 oauth.Token('t/key', 't&secret'))
+    
+    def oauth_request(self, nonce, timestamp):
+        request = oauth.Request('GET', self.stream.url, parameters={
+            'oauth_version': '1.0',
+            'oauth_nonce': nonce,
+            'oauth_timestamp': timestamp,
+            'follow': ','.join(map(str, self.stream.follow)),
+            'with': self.stream.stream_with,
+            'oauth_token': self.stream.token.key,
+            'oauth_consumer_key': self.stream.consumer.key,
+        })
+        request.sign_request(oauth.SignatureMethod_HMAC_SHA1(),
+                             self.stream.consumer, self.stream.token)
+        return request
+    
+    def header_params(self, headers):
+        import urllib
+        params = headers['Authorization'][len('OAuth '):].split(', ')
+        return dict((k, urllib.unquote(v.strip('"')))
+                    for k, v in (x.split('=', 1) for x in params))
+    
+    def test_matches_oauth2(self):
+        '''The cached signature should match python-oauth2's.'''
+        path, headers = self.stream.signed_request('12345678', 1300000000)
+        expected = self.oauth_request('12345678', 1300000000)
+        params = self.header_params(headers)
+        self.assertEqual(params['oauth_signature'], expected['oauth_signature'])
+        self.assertEqual(params['oauth_consumer_key'], 'c key')
+        self.assertEqual(path, '/2b/site.json?follow=1%2C2%2C3%2C4&with=user')
+    
+    def test_follow_change_invalidates(self):
+        '''Reassigning follow should rebuild the cached pieces.'''
+        self.stream.signed_request('1', 1)
+        self.stream.follow = self.stream.follow | [5]
+        path, headers = self.stream.signed_request('1', 1)
+        self.assertTrue('follow=1%2C2%2C3%2C4%2C5&' in path)
+        self.assertEqual(self.header_params(headers)['oauth_signature'],
+                         self.oauth_request('1', 1)['oauth_signature'])
+    
+    def test_connect_sends_header(self):
+        '''connect should send the credentials in an Authorization header
+        rather than the URL.'''
+        requests = []
+        class RecordingConnection(MockConnection):
+            def request(self, *args, **kwargs):
+                requests.append((args, kwargs))
+        httplib.HTTPSConnection = lambda *args, **kwargs: RecordingConnection()
+        try:
+            self.stream.connect()
+        finally:
+            httplib.HTTPSConnection = REAL_HTTPSConnection
+        (method, path), kwargs = requests[0]
+        self.assertEqual(method, 'GET')
+        self.assertFalse('oauth' in path)
+        self.assertTrue('Authorization' in kwargs['headers'])
+
+class CompressedStreamTests(unittest.TestCase):
+    '''Streams messages from a local stand-in for the site streams
+    endpoint.'''
+    messages = ['{"for_user":%s,"message":{"id":%s,"text":"%s"}}\r\n'
+                % (x % 4, x, 'hello ' * (x % 7)) for x in range(200)]
+    chunked = False
+    
+    def setUp(self):
+        import threading
+        import BaseHTTPServer
+        from sitebucket import listener
+        test = self
+        self.requests = []
+        
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.requests.append(dict(self.headers))
+                encoding = self.headers.get('accept-encoding', '')
+                if test.chunked:
+                    self.protocol_version = 'HTTP/1.1'
+                self.send_response(200)
+                if 'gzip' in encoding:
+                    self.send_header('Content-Encoding', 'gzip')
+                if test.chunked:
+                    self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                test.serve(self.wfile, 'gzip' in encoding)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.handle_request)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        self.protocol = listener.PROTOCOL
+        listener.PROTOCOL = 'http://'
+        httplib.HTTPConnection = REAL_HTTPConnection
+    
+    def tearDown(self):
+        from sitebucket import listener
+        listener.PROTOCOL = self.protocol
+        self.server.server_close()
+    
+    def serve(self, wfile, compress):
+        '''Writes every message, flushing each one so that the client has to
+        decompress them as they arrive.'''
+        import zlib
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for message in self.messages:
+            if compress:
+                message = compressor.compress(message) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self.chunked:
+                message = '%x\r\n%s\r\n' % (len(message), message)
+            wfile.write(message)
+            wfile.flush()
+    
+    def listen(self, compression):
+        messages = self.messages
+        class StopParser(ListParser):
+            def parse(self, token):
+                ListParser.parse(self, token)
+                if len(self.parsed) == len(messages):
+                    stream.disconnect_issued = True
+        stream = SiteStream([1, 2, 3], consumer, token,
+                            parser=StopParser(), compression=compression)
+        stream.host = '127.0.0.1:%s' % self.server.server_address[1]
+        stream.listen()
+        self.thread.join(5)
+        return stream
+    
+    def test_compressed(self):
+        '''A compressed stream should request gzip and frame every message
+        after decompressing it.'''
+        stream = self.listen(True)
+        self.assertEqual(stream.parser.parsed, self.messages)
+        self.assertEqual(self.requests[0]['accept-encoding'], 'gzip, deflate')
+        self.assertEqual(stream.decompressor.encoding, 'gzip')
+        self.assertEqual(stream.bytes_decompressed,
+                         sum(map(len, self.messages)))
+        self.assertTrue(stream.bytes_received < stream.bytes_decompressed)
+        self.assertEqual(stream.bytes_received,
+                         stream.decompressor.compressed_bytes)
+    
+    def test_uncompressed(self):
+        '''Streams should not request compression unless it is enabled.'''
+        stream = self.listen(False)
+        self.assertEqual(stream.parser.parsed, self.messages)
+        self.assertEqual(self.requests[0].get('accept-encoding'), 'identity')
+        self.assertEqual(stream.decompressor, None)
+        self.assertEqual(stream.bytes_received, stream.bytes_decompressed)
+    
+    def count_reads(self, compression):
+        '''Listens and returns the number of HTTPResponse.read calls.'''
+        read = httplib.HTTPResponse.read
+        calls = []
+        def counting_read(response, amt=None):
+            calls.append(amt)
+            return read(response, amt)
+        httplib.HTTPResponse.read = counting_read
+        try:
+            stream = self.listen(compression)
+        finally:
+            httplib.HTTPResponse.read = read
+        self.assertEqual(stream.parser.parsed, self.messages)
+        return len(calls)
+    
+    def test_block_reads(self):
+        '''A stream that isn't chunked should be read from the socket in
+        blocks rather than a byte at a time.'''
+        self.assertEqual(self.count_reads(True), 0)
+    
+    def test_chunked_block_reads(self):
+        '''A chunked stream should be read a chunk at a time, plus a byte
+        for each chunk's size line.'''
+        self.chunked = True
+        self.assertTrue(self.count_reads(True) <= 2 * len(self.messages))
+    
+    def test_chunked_uncompressed(self):
+        '''An uncompressed chunked stream should be read in blocks too.'''
+        self.chunked = True
+        self.assertTrue(self.count_reads(False) <= 2 * len(self.messages))
+
+class ShutdownTests(unittest.TestCase):
+    '''Shuts down a monitor whose streams are blocked reading from a local
+    stand-in for the site streams endpoint.'''
+    message = '{"for_user":1,"message":{"id":%s}}\r\n'
+    
+    def setUp(self):
+        import threading
+        import SocketServer
+        import BaseHTTPServer
+        from sitebucket import listener
+        self.release = threading.Event()
+        release = self.release
+        
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                for x in range(3):
+                    self.wfile.write(ShutdownTests.message % x)
+                self.wfile.flush()
+                # Send nothing more, leaving the client blocked reading.
+                release.wait(30)
+            
+            def log_message(self, *args):
+                pass
+        
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            
+            def handle_error(self, request, client_address):
+                # Clients disconnecting mid-response are expected.
+                pass
+        
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        
+        self.protocol = listener.PROTOCOL
+        listener.PROTOCOL = 'http://'
+        httplib.HTTPConnection = REAL_HTTPConnection
+    
+    def tearDown(self):
+        from sitebucket import listener
+        listener.PROTOCOL = self.protocol
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def start(self, parser):
+        import time
+        from sitebucket import ListenThreadMonitor
+        monitor = ListenThreadMonitor(range(1, 301), consumer, token,
+                                      parser=parser)
+        for thread in monitor.threads:
+            thread.stream.host = '127.0.0.1:%s' % self.server.server_address[1]
+            thread.start()
+        # Each of the three streams is sent three messages.
+        while monitor.bandwidth['received'] < 9 * len(self.message % 0):
+            time.sleep(.01)
+        return monitor
+    
+    def test_unblocks_streams(self):
+        '''shutdown should stop streams blocked reading right away rather
+        than after their read timeout.'''
+        monitor = self.start(ListParser())
+        report = monitor.shutdown(deadline=10)
+        self.assertEqual(report['streams'], 3)
+        self.assertEqual(report['unstopped'], [])
+        self.assertEqual(report['dropped'], 0)
+        self.assertTrue(report['elapsed'] < 5)
+        self.assertFalse(any(x.is_alive() for x in monitor.threads))
+    
+    def test_drains_dispatcher(self):
+        '''Messages queued in a LaneDispatcher should be parsed before
+        shutdown returns.'''
+        from sitebucket.dispatch import LaneDispatcher
+        inner = ListParser()
+        monitor = self.start(LaneDispatcher(inner, lanes=2))
+        report = monitor.shutdown(deadline=10)
+        self.assertEqual(report['dropped'], 0)
+        self.assertEqual(len(inner.parsed), 9)
+        self.assertEqual(monitor.parser.workers, [])
+    
+    def test_running_monitor(self):
+        '''Streams started by a maintenance pass that is running when
+        shutdown is called should be stopped and joined too.'''
+        import threading
+        from sitebucket import ListenThreadMonitor
+        host = '127.0.0.1:%s' % self.server.server_address[1]
+        in_pass = threading.Event()
+        
+        class Monitor(ListenThreadMonitor):
+            def maintain(self):
+                in_pass.set()
+                # Let shutdown close the current streams first.
+                while not self.disconnect_issued:
+                    self._wake.wait(.01)
+                self.add_follows([1000], start=False)
+                self.threads[-1].stream.host = host
+                self.threads[-1].start()
+        
+        monitor = Monitor(range(1, 101), consumer, token, parser=ListParser())
+        for thread in monitor.threads:
+            thread.stream.host = host
+        monitor.start()
+        in_pass.wait(5)
+        report = monitor.shutdown(deadline=10)
+        self.assertEqual(report['streams'], 2)
+        self.assertEqual(report['unstopped'], [])
+        self.assertFalse(monitor.is_alive())
+        self.assertFalse(any(x.is_alive() for x in monitor.threads))
+    
+    def test_reports_dropped(self):
+        '''Deferred messages that can't be parsed by the deadline should be
+        reported as dropped.'''
+        from sitebucket.shaping import ShapingParser
+        shaper = ShapingParser(ListParser(), rate=.001, burst=1,
+                               policy='defer')
+        monitor = self.start(shaper)
+        report = monitor.shutdown(deadline=10)
+        self.assertEqual(report['dropped'], 8)
+        self.assertEqual(len(shaper.spill), 0)
+
+class TierTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.lag import LagTracker
+        self.lag = LagTracker()
+        self.monitor = ListenThreadMonitor(range(1, 201), consumer, token,
+                                           parser=NullParser(), lag=self.lag,
+                                           tiers={1: 0, 2: 0, 3: 1, 4: 100})
+    
+    def test_placement(self):
+        '''Priority users should get small dedicated streams of their own
+        tier, placed first.'''
+        self.assertEqual([(x.stream.tier, list(x.stream.follow)[:3])
+                          for x in self.monitor.threads],
+                         [(0, [1, 2]), (1, [3]), (100, [4, 5, 6]),
+                          (100, [104, 105, 106])])
+    
+    def test_add_follows(self):
+        '''Users added with a tier should be placed by that tier.'''
+        from sitebucket.monitor import PRIORITY_STREAM_SIZE
+        self.monitor.add_follows(range(1000, 1030), start=False, tier=0)
+        added = self.monitor.threads[-2:]
+        self.assertEqual([len(x.stream.follow) for x in added],
+                         [PRIORITY_STREAM_SIZE, 30 - PRIORITY_STREAM_SIZE])
+        self.assertEqual(self.monitor.tier(1000), 0)
+        self.monitor.remove_follows([1000])
+        self.assertEqual(self.monitor.tier(1000), 100)
+    
+    def test_restart_order(self):
+        '''Unhealthy priority streams should be restarted first.'''
+        restarted = []
+        for thread in reversed(self.monitor.threads):
+            thread.stream.initialized = True
+            thread.stream.error_count = thread.stream.retry_limit
+            thread.restart = lambda thread=thread: restarted.append(
+                thread.stream.tier) or thread
+        self.monitor.restart_unhealthy_streams()
+        self.assertEqual(restarted, [0, 1, 100, 100])
+    
+    def test_tier_lag(self):
+        '''Lag should be recorded per tier.'''
+        for thread in self.monitor.threads[:2]:
+            thread.stream.on_receive('{"for_user":1,"message":{"timestamp_ms"'
+                                     ':"1000000"}}\r\n')
+        self.assertEqual(self.lag.tiers[0].count, 1)
+        self.assertEqual(self.lag.tiers[1].count, 1)
+        self.assertEqual(self.lag.tiers[100].count, 0)
+        self.assertEqual(sorted(self.lag.stats['tiers']), [0, 1, 100])
+    
+    def test_dispatch_priority(self):
+        '''Queued priority messages should be parsed before bulk messages
+        that arrived earlier, while each user stays in order.'''
+        import threading
+        from sitebucket.dispatch import LaneDispatcher
+        started = threading.Event()
+        release = threading.Event()
+        class BlockingParser(ListParser):
+            def parse(self, token):
+                if not started.is_set():
+                    started.set()
+                    release.wait(5)
+                ListParser.parse(self, token)
+        inner = BlockingParser()
+        dispatcher = LaneDispatcher(inner, lanes=1, tiers={1: 0})
+        message = '{"for_user":%s,"message":{"id":%s}}'
+        dispatcher.parse(message % (2, 0))
+        started.wait(5)
+        for x in range(1, 4):
+            dispatcher.parse(message % (2, x))
+            dispatcher.parse(message % (1, x))
+        release.set()
+        dispatcher.close()
+        self.assertEqual(inner.parsed, [message % (2, 0)] +
+                         [message % (1, x) for x in range(1, 4)] +
+                         [message % (2, x) for x in range(1, 4)])
+    
+    def test_retiered_user_stays_in_order(self):
+        '''A user moved to a priority tier while their messages are queued
+        should not overtake their own queued messages.'''
+        import threading
+        from sitebucket.dispatch import LaneDispatcher
+        started = threading.Event()
+        release = threading.Event()
+        class BlockingParser(ListParser):
+            def parse(self, token):
+                if not started.is_set():
+                    started.set()
+                    release.wait(5)
+                ListParser.parse(self, token)
+        inner = BlockingParser()
+        tiers = {}
+        dispatcher = LaneDispatcher(inner, lanes=1, tiers=tiers)
+        message = '{"for_user":%s,"message":{"id":%s}}'
+        dispatcher.parse(message % (2, 0))
+        started.wait(5)
+        dispatcher.parse(message % (1, 1))
+        dispatcher.parse(message % (3, 1))
+        tiers[1] = 0
+        dispatcher.parse(message % (1, 2))
+        release.set()
+        dispatcher.close()
+        self.assertEqual(inner.parsed, [message % (2, 0), message % (1, 1),
+                                        message % (3, 1), message % (1, 2)])
+    
+    def test_untiered_monitor(self):
+        '''A monitor without tiers should leave its LaneDispatcher
+        unprioritized until users are added to a tier.'''
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.dispatch import LaneDispatcher
+        dispatcher = LaneDispatcher(NullParser())
+        monitor = ListenThreadMonitor(range(1, 11), consumer, token,
+                                      parser=dispatcher)
+        self.assertEqual(dispatcher.tiers, None)
+        monitor.add_follows([11], start=False, tier=0)
+        self.assertTrue(dispatcher.tiers is monitor.tiers)
+
+class KeywordRouterTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.keywords import KeywordRouter
+        self.router = KeywordRouter()
+        self.delivered = []
+    
+    def handler(self, rule, message):
+        self.delivered.append((rule, message['message']['id']))
+    
+    def tweet(self, id, text):
+        import simplejson as json
+        return json.dumps({'for_user': 1, 'message': {'id': id, 'text': text,
+                           'user': {'id': 2}}}) + '\r\n'
+    
+    def test_routing(self):
+        '''Tweets should be delivered once to every rule they match.'''
+        self.router.add_rule('a', ['New York', 'nyc'], self.handler)
+        self.router.add_rule('b', ['york'], self.handler)
+        self.router.add_rule('c', [u'caf\xe9'], self.handler)
+        self.router.parse(self.tweet(1, u'NYC or new  york?'))
+        self.router.parse(self.tweet(2, u'Yorkshire'))
+        self.router.parse(self.tweet(3, u'CAF\xc9 au lait'))
+        self.assertEqual(sorted(self.delivered), [('a', 1), ('b', 1),
+                                                  ('c', 3)])
+        self.assertEqual(self.router.stats['deliveries'], 3)
+    
+    def test_updates(self):
+        '''Changed and removed rules should stop matching their old
+        phrases, including after the automatons are merged.'''
+        from sitebucket import keywords
+        self.router.update(add=dict((x, (['word%s' % x], self.handler))
+                                    for x in range(keywords.DELTA_RULE_LIMIT)))
+        self.assertEqual(self.router.rebuilds, 1)
+        self.router.add_rule(0, ['other'], self.handler)
+        self.router.remove_rule(1)
+        self.router.parse(self.tweet(1, 'word0 word1 word2 other'))
+        self.assertEqual(sorted(self.delivered), [(0, 1), (2, 1)])
+    
+    def test_ignores_non_tweets(self):
+        '''Messages without tweet text should be ignored.'''
+        self.router.add_rule('a', ['x'], self.handler)
+        self.router.parse('{"friends":[1,2]}\r\n')
+        self.router.parse('{"for_user":1,"message":{"delete":{"id":1}}}\r\n')
+        self.assertEqual(self.delivered, [])
+
+class SubscriptionRegistryTests(unittest.TestCase):
+    class Socket(object):
+        def __init__(self):
+            self.sent = []
+        
+        def send(self, for_user, message):
+            self.sent.append((for_user, message['id']))
+    
+    def setUp(self):
+        from sitebucket.subscriptions import SubscriptionRegistry
+        self.registry = SubscriptionRegistry()
+    
+    def message(self, for_user, id):
+        return '{"for_user":%s,"message":{"id":%s,"text":"hi",' \
+               '"user":{"id":9}}}\r\n' % (for_user, id)
+    
+    def test_dispatch(self):
+        '''Messages should reach every handler subscribed to their user
+        and no others.'''
+        a, b = self.Socket(), self.Socket()
+        self.registry.update(register=[(1, a.send), (1, b.send),
+                                       (2, b.send), (1, a.send)])
+        self.registry.parse(self.message(1, 10))
+        self.registry.parse(self.message(2, 11))
+        self.registry.parse(self.message(3, 12))
+        self.registry.parse('{"friends":[1,2]}\r\n')
+        self.assertEqual(a.sent, [(1, 10)])
+        self.assertEqual(b.sent, [(1, 10), (2, 11)])
+        self.assertEqual(self.registry.stats['dropped'], 2)
+        self.assertEqual(self.registry.stats['handlers'], 3)
+    
+    def test_unsubscribed_messages_not_decoded(self):
+        '''Messages for users without subscribers shouldn't be
+        decoded.'''
+        from sitebucket import subscriptions
+        real_Message = subscriptions.Message
+        decoded = []
+        subscriptions.Message = lambda token: decoded.append(token)
+        try:
+            self.registry.parse(self.message(1, 10))
+        finally:
+            subscriptions.Message = real_Message
+        self.assertEqual(decoded, [])
+    
+    def test_weak_references(self):
+        '''Subscriptions should end when their handler is garbage
+        collected.'''
+        socket = self.Socket()
+        handler = lambda for_user, message: None
+        self.registry.register(1, socket.send)
+        self.registry.register(2, handler)
+        del socket, handler
+        self.registry.prune()
+        self.assertEqual(self.registry.users, [])
+        self.registry.parse(self.message(1, 10))
+        self.assertEqual(self.registry.stats['deliveries'], 0)
+    
+    def test_unregister(self):
+        '''Unregistering should remove one handler or all of a user's
+        handlers.'''
+        a, b = self.Socket(), self.Socket()
+        self.registry.update(register=[(1, a.send), (1, b.send),
+                                       (2, a.send)])
+        self.registry.unregister(1, a.send)
+        self.assertEqual(self.registry.handlers(1), [b.send])
+        self.registry.unregister(2)
+        self.assertEqual(self.registry.users, [1])
+    
+    def test_updates_while_parsing(self):
+        '''Subscriptions should be safe to change while another thread
+        parses messages.'''
+        import threading
+        sockets = [self.Socket() for x in range(50)]
+        stop = threading.Event()
+        def parse():
+            while not stop.is_set():
+                for x in range(50):
+                    self.registry.parse(self.message(x, x))
+        thread = threading.Thread(target=parse)
+        thread.start()
+        try:
+            for x in range(200):
+                self.registry.update(register=enumerate(y.send for y in sockets))
+                self.registry.update(unregister=[(y, None) for y in range(50)])
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(self.registry.stats['errors'], 0)
+        self.assertEqual(self.registry.users, [])
+
+class BatchSinkTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.sinks import BatchSink
+        class Sink(BatchSink):
+            fail = True
+            def write(self, batch):
+                if self.fail:
+                    raise IOError('disk full')
+        self.sink = Sink(batch_size=3, max_delay=60)
+    
+    def test_failed_final_write(self):
+        '''Messages lost by a failed final write should be reported by
+        close.'''
+        for x in range(2):
+            self.sink.parse('{"for_user":%s}\r\n' % x)
+        self.assertEqual(self.sink.close(), 2)
+        self.assertEqual(self.sink.stats['dropped'], 2)
+    
+    def test_failed_write_while_parsing(self):
+        '''A failed write triggered by parse should be counted instead of
+        raised into the stream.'''
+        for x in range(5):
+            self.sink.parse('{"for_user":%s}\r\n' % x)
+        self.assertEqual(self.sink.dropped, 3)
+        self.sink.fail = False
+        self.assertEqual(self.sink.close(), 3)
+        self.assertEqual(self.sink.written, 2)
+    
+    def test_sqlite_failed_batch_rolled_back(self):
+        '''Rows inserted before a batch failed should be rolled back, not
+        committed with the next batch.'''
+        import shutil, tempfile
+        from sitebucket.sinks import SQLiteSink
+        class Sink(SQLiteSink):
+            def convert(self, token):
+                row = SQLiteSink.convert(self, token)
+                if '"bad"' in token:
+                    # SQLite can't bind an arbitrary object.
+                    row = row[:2] + (object(),)
+                return row
+        directory = tempfile.mkdtemp()
+        try:
+            sink = Sink(directory + '/messages.db', batch_size=3,
+                        max_delay=60)
+            for x in ('1', '"bad"', '2', '3', '4', '5'):
+                sink.parse('{"for_user":%s}\r\n' % x)
+            self.assertEqual(sink.close(), 3)
+            import sqlite3
+            db = sqlite3.connect(directory + '/messages.db')
+            rows = db.execute('SELECT for_user FROM messages').fetchall()
+            db.close()
+            self.assertEqual(rows, [(3,), (4,), (5,)])
+        finally:
+            shutil.rmtree(directory)
+
+class ColumnarSinkTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import columnar
+        if columnar.numpy is None:
+            self.skipTest('numpy is not installed.')
+        self.columnar = columnar
+    
+    def test_columns(self):
+        '''Tweets should be converted to columns, reading the author's id
+        even when it isn't the user object's first field.'''
+        from sitebucket.util import Frame
+        batches = []
+        sink = self.columnar.ColumnarSink(callback=batches.append)
+        sink.parse(Frame('{"for_user":7,"message":{"id":1,"text":"caf\\u00e9",'
+                         '"user":{"id":2},"timestamp_ms":"1500"}}\r\n',
+                         received_at=2.0))
+        sink.parse('{"for_user":8,"message":{"id":3,"text":"x",'
+                   '"user":{"name":"a","id":4}}}\r\n')
+        sink.parse('{"for_user":8,"message":{"delete":{"id":1}}}\r\n')
+        sink.close()
+        batch, = batches
+        self.assertEqual(batch['id'].tolist(), [1, 3])
+        self.assertEqual(batch['for_user'].tolist(), [7, 8])
+        self.assertEqual(batch['user_id'].tolist(), [2, 4])
+        self.assertEqual(batch['created_at'][0], 1.5)
+        self.assertEqual(batch['received_at'][0], 2.0)
+        self.assertEqual([batch.text(0), batch.text(1)], [u'caf\xe9', u'x'])
+    
+    def test_files(self):
+        '''Batches saved to a directory should load back unchanged.'''
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            sink = self.columnar.ColumnarSink(directory=directory,
+                                              batch_size=2)
+            for x in range(3):
+                sink.parse('{"for_user":1,"message":{"id":%s,"text":"hi",'
+                           '"user":{"id":2}}}\r\n' % x)
+            sink.close()
+            self.assertEqual(len(sink.files), 2)
+            batch = self.columnar.ColumnarBatch.load(sink.files[1])
+            self.assertEqual(batch['id'].tolist(), [2])
+            self.assertEqual(batch.text(0), u'hi')
+        finally:
+            shutil.rmtree(directory)
+    
+    def test_requires_numpy(self):
+        '''Creating a sink without numpy should raise an error.'''
+        from sitebucket.error import SitebucketError
+        numpy, self.columnar.numpy = self.columnar.numpy, None
+        try:
+            self.assertRaises(SitebucketError, self.columnar.ColumnarSink,
+                              callback=list)
+        finally:
+            self.columnar.numpy = numpy
+
+class LagTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.lag import LagTracker
+        self.lag = LagTracker()
+    
+    def test_stream_records_lag(self):
+        '''A stream with a LagTracker should record the delivery and
+        processing lag of every message once it has been parsed.'''
+        stream = SiteStream(follow, consumer, token, parser=NullParser(),
+                            lag=self.lag)
+        created = int((__import__('time').time() - 5) * 1000)
+        stream.on_receive('{"message":{"timestamp_ms":"%s"}}\r\n' % created)
+        stream.on_receive('{"friends":[]}\r\n')
+        self.assertEqual(self.lag.processing.count, 2)
+        self.assertEqual(self.lag.delivery.count, 1)
+        self.assertTrue(4 < self.lag.delivery.max < 10)
+        self.assertEqual(self.lag.streams[stream.stream_id].count, 1)
+        self.assertTrue(self.lag.last_completed_at is not None)
+    
+    def test_dispatched_lag(self):
+        '''When a monitor's parser is a LaneDispatcher, lag should be
+        recorded by the lane workers rather than the streams.'''
+        from sitebucket import ListenThreadMonitor, LaneDispatcher
+        dispatcher = LaneDispatcher(NullParser())
+        monitor = ListenThreadMonitor(follow, consumer, token,
+                                      parser=dispatcher, lag=self.lag)
+        stream = monitor.threads[0].stream
+        self.assertEqual(stream.lag, None)
+        stream.on_receive('{"for_user":1,"message":{"timestamp_ms":"0"}}\r\n')
+        dispatcher.close()
+        self.assertEqual(self.lag.processing.count, 1)
+        self.assertEqual(self.lag.streams.keys(), [stream.stream_id])
+
+class ShapingTests(unittest.TestCase):
+    def shaper(self, **kwargs):
+        from sitebucket.shaping import ShapingParser
+        self.parser = ListParser()
+        return ShapingParser(self.parser, rate=1, burst=1, **kwargs)
+    
+    def test_other_users_unaffected(self):
+        '''A flooding user should not use up other users' tokens, and
+        messages without a for_user id should never be shaped.'''
+        shaper = self.shaper()
+        for x in range(100):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        shaper.parse('{"for_user":2,"message":{"id":0}}')
+        shaper.parse('{"control":{}}')
+        self.assertEqual(shaper.passed, 3)
+        self.assertEqual(shaper.drops, {1: 99})
+    
+    def test_sample(self):
+        '''The sample policy should pass one in sample_every overflowing
+        messages.'''
+        shaper = self.shaper(policy='sample', sample_every=10)
+        for x in range(101):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        self.assertEqual(shaper.passed, 11)
+        self.assertEqual(shaper.dropped, 90)
+    
+    def test_defer_preserves_order(self):
+        '''Deferred messages should be parsed in order, and the spill queue
+        should be bounded.'''
+        shaper = self.shaper(policy='defer', spill_size=3)
+        for x in range(5):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        self.assertEqual(len(shaper.spill), 3)
+        self.assertEqual(shaper.dropped, 1)
+        later = shaper.buckets[1].last + 10
+        self.assertEqual(shaper.drain(now=later), 1)
+        self.assertEqual(shaper.drain(now=later + 10), 1)
+        self.assertEqual([x[-3] for x in self.parser.parsed], ['0', '1', '2'])
+    
+    def test_bounded_memory(self):
+        '''Buckets should be evicted once max_users is exceeded.'''
+        shaper = self.shaper(max_users=10)
+        for x in range(100):
+            shaper.parse('{"for_user":%s,"message":{"id":0}}' % x)
+        self.assertEqual(len(shaper.buckets), 10)
+        self.assertEqual(shaper.evictions, 90)
+    
+    def test_evicted_drops_kept(self):
+        '''A noisy user's discarded messages should still be counted after
+        their bucket is evicted.'''
+        shaper = self.shaper(max_users=2)
+        for x in range(10):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        for user in range(2, 5):
+            shaper.parse('{"for_user":%s,"message":{"id":0}}' % user)
+        self.assertFalse(1 in shaper.buckets)
+        shaper.parse('{"for_user":1,"message":{"id":10}}')
+        shaper.parse('{"for_user":1,"message":{"id":11}}')
+        self.assertEqual(shaper.drops, {1: 10})
+        self.assertEqual(shaper.top_drops(1), [(1, 10)])
+        self.assertEqual(shaper.stats['overflowed'], 10)
+    
+    def test_idle_eviction(self):
+        '''Buckets idle for idle_timeout seconds should be evicted.'''
+        shaper = self.shaper(idle_timeout=60)
+        shaper.admit(1, now=0)
+        shaper.admit(2, now=30)
+        shaper.admit(3, now=75)
+        self.assertEqual(shaper.buckets.keys(), [2, 3])
+    
+    def test_deferred_never_evicted(self):
+        '''Buckets with deferred messages should not be evicted, so the
+        user's later messages stay behind them.'''
+        shaper = self.shaper(policy='defer', max_users=2)
+        for x in range(2):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        for x in range(2, 10):
+            shaper.parse('{"for_user":%s,"message":{"id":0}}' % x)
+        self.assertTrue(1 in shaper.buckets)
+        self.assertEqual(shaper.buckets[1].deferred, 1)
+        self.assertEqual(len(shaper.buckets), 2)
+        shaper.parse('{"for_user":1,"message":{"id":2}}')
+        self.assertEqual(len(shaper.spill), 2)
+        later = shaper.buckets[1].last + 100
+        self.assertEqual(shaper.drain(now=later), 1)
+        self.assertEqual(shaper.buckets[1].deferred, 1)
+        self.assertEqual(shaper.close(), 1)
+        self.assertEqual(shaper.buckets[1].deferred, 0)
+        self.assertEqual([x[-3] for x in self.parser.parsed
+                          if '"for_user":1,' in x], ['0', '1'])
+    
+    def test_deferred_held_while_parsing(self):
+        '''A user's new messages should be deferred while their spilled
+        message is still being parsed.'''
+        import time
+        shaper = self.shaper(policy='defer')
+        parsed = []
+        class ReenteringParser(BaseParser):
+            def parse(self, token):
+                parsed.append(token[-3])
+                if token[-3] == '1':
+                    shaper.parse('{"for_user":1,"message":{"id":2}}')
+        shaper.parser = ReenteringParser()
+        for x in range(2):
+            shaper.parse('{"for_user":1,"message":{"id":%s}}' % x)
+        # The bucket refills quickly, but message 2 arrives while message 1
+        # is being parsed, so it has to wait.
+        shaper.rate, shaper.burst = 1000, 5
+        time.sleep(.01)
+        self.assertEqual(shaper.drain(), 1)
+        self.assertEqual(parsed, ['0', '1'])
+        self.assertEqual(shaper.buckets[1].deferred, 1)
+        time.sleep(.01)
+        self.assertEqual(shaper.drain(), 1)
+        self.assertEqual(parsed, ['0', '1', '2'])
+        self.assertEqual(shaper.stats['passed'], 3)
+
+class RingTests(unittest.TestCase):
+    def test_consumer_processes(self):
+        '''Every message written to a small ring should be parsed exactly
+        once by one of several consumer processes, including messages that
+        wrap around the end of the ring.'''
+        import multiprocessing
+        from sitebucket.ring import RingBuffer, RingParser, RingConsumer
+        ring = RingBuffer(size=256)
+        total = multiprocessing.Value('l', 0)
+        consumers = [multiprocessing.Process(
+                         target=RingConsumer(ring, SumParser(total)).run)
+                     for x in range(2)]
+        [x.start() for x in consumers]
+        parser = RingParser(ring)
+        for x in range(1000):
+            parser.parse('{"for_user":1,"message":{"id":%s}}\r\n' % x)
+        parser.close()
+        [x.join(10) for x in consumers]
+        self.assertEqual(total.value, sum(range(1000)))
+        self.assertEqual(ring.stats['messages'], 1000)
+        self.assertTrue(ring.empty)
+
+class FileMembershipTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = self.dir + '/members'
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+    
+    def test_concurrent_joins(self):
+        '''Nodes joining from several processes at once should not lose
+        each other's heartbeats.'''
+        import multiprocessing
+        from sitebucket.partition import FileMembership
+        def join(prefix):
+            membership = FileMembership(self.path)
+            for x in range(20):
+                membership.join('%s-%s' % (prefix, x))
+        processes = [multiprocessing.Process(target=join, args=(x,))
+                     for x in range(4)]
+        [x.start() for x in processes]
+        [x.join(30) for x in processes]
+        self.assertEqual(len(FileMembership(self.path).nodes()), 80)
+    
+    def test_expiry(self):
+        '''Nodes without a recent heartbeat should expire, and be left out
+        of the file the next time it is written.'''
+        import time
+        from sitebucket.partition import FileMembership
+        membership = FileMembership(self.path, ttl=60)
+        membership.join('stale')
+        membership.join('live')
+        with open(self.path, 'w') as f:
+            f.write('stale %r\nlive %r\n' % (time.time() - 120,
+                                              time.time()))
+        self.assertEqual(membership.nodes(), ['live'])
+        membership.join('new')
+        with open(self.path) as f:
+            self.assertFalse('stale' in f.read())
+
+class PartitionRebalanceTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.partition import PartitionedMonitor, SQLiteMembership
+        self.connections = []
+        httplib.HTTPSConnection = self.connection
+        
+        self.follow = range(1, 10001)
+        self.membership = SQLiteMembership(':memory:')
+        self.membership.join('b')
+        self.monitor = PartitionedMonitor('a', self.membership, self.follow,
+                                          consumer, token)
+        self.monitor.running = True
+        for x in self.monitor.threads:
+            x.stream.running = True
+            x.stream.control_uri = '/1.1/site/c/%s' % x.stream.stream_id
+        self.old = list(self.monitor.threads)
+    
+    def tearDown(self):
+        httplib.HTTPSConnection = REAL_HTTPSConnection
+    
+    def connection(self, *args, **kwargs):
+        connection = MockControlConnection()
+        self.connections.append(connection)
+        return connection
+    
+    def assert_following(self):
+        '''Checks that the streams follow exactly the node's share.'''
+        from sitebucket.follow import FollowSet
+        assigned = self.monitor.ring.assign(FollowSet(self.follow), 'a')
+        streams = [x.stream.follow for x in self.monitor.threads]
+        self.assertEqual(sum(len(x) for x in streams), len(assigned))
+        self.assertEqual(self.monitor.follow, assigned)
+        for x in streams:
+            self.assertEqual(x - assigned, FollowSet())
+    
+    def test_node_joins(self):
+        '''Users lost to a joining node should be removed from their
+        streams in place, so every stream survives.'''
+        self.membership.join('c')
+        self.monitor.rebalance()
+        self.assertEqual(self.monitor.threads, self.old)
+        self.assertTrue(all(x.stream.control_uri for x in self.old))
+        self.assert_following()
+        paths = set(x.requests[0][1].rsplit('/', 1)[1]
+                    for x in self.connections)
+        self.assertEqual(paths, set(['remove_user.json']))
+    
+    def test_node_leaves(self):
+        '''Users gained from a leaving node should be added to ready
+        streams with room before any new streams are created.'''
+        sizes = [len(x.stream.follow) for x in self.old]
+        self.membership.join('c')
+        self.monitor.rebalance()
+        self.membership.leave('c')
+        self.monitor.rebalance()
+        self.assertEqual(self.monitor.threads, self.old)
+        self.assertEqual([len(x.stream.follow) for x in self.old], sizes)
+        self.assert_following()
+
+class SumParser(BaseParser):
+    def __init__(self, total):
+        self.total = total
+    
+    def parse(self, token):
+        import simplejson as json
+        with self.total.get_lock():
+            self.total.value += json.loads(token)['message']['id']
+
+class EventLoopParserTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import coroutine
+        if coroutine.asyncio is None:
+            self.skipTest('trollius is not installed.')
+        self.coroutine = coroutine
+    
+    def sleeping_parser(self, seconds):
+        asyncio, From = self.coroutine.asyncio, self.coroutine.From
+        
+        class SleepingParser(self.coroutine.AsyncBaseParser):
+            def parse(self, token):
+                yield From(asyncio.sleep(seconds))
+        return SleepingParser()
+    
+    def test_concurrent_handlers(self):
+        '''Slow coroutines should run concurrently, up to the concurrency
+        limit, without blocking the caller.'''
+        parser = self.coroutine.EventLoopParser(self.sleeping_parser(.2),
+                                                concurrency=50)
+        start = __import__('time').time()
+        for x in range(50):
+            parser.parse('{"some":"json"}\r\n')
+        self.assertEqual(parser.close(), 0)
+        self.assertTrue(__import__('time').time() - start < 2)
+        self.assertEqual(parser.completed, 50)
+    
+    def test_backpressure(self):
+        '''parse should block once pending messages are outstanding, and
+        close should report messages it gave up on.'''
+        parser = self.coroutine.EventLoopParser(self.sleeping_parser(.2),
+                                                concurrency=1, pending=1)
+        start = __import__('time').time()
+        parser.parse('{"some":"json"}\r\n')
+        parser.parse('{"some":"json"}\r\n')
+        self.assertTrue(__import__('time').time() - start >= .15)
+        self.assertEqual(parser.close(timeout=0), 1)
+    
+    def test_failures(self):
+        '''Exceptions raised by a coroutine should be counted and logged.'''
+        class FailingParser(self.coroutine.AsyncBaseParser):
+            def parse(self, token):
+                raise ValueError(token)
+                yield
+        parser = self.coroutine.EventLoopParser(FailingParser())
+        parser.parse('{"some":"json"}\r\n')
+        parser.close()
+        self.assertEqual(parser.failed, 1)
+
+class MessageTests(unittest.TestCase):
+    def test_matches_decoded(self):
+        '''Every field of a Message should match the decoded dictionary.'''
+        import simplejson as json
+        from sitebucket.message import Message
+        token = ('{"for_user":7,"message":{"id":12,"text":"say \\"hi\\" '
+                 '\\u2603","truncated":false,"geo":null,"score":-1.5e2,'
+                 '"user":{"id":3},"entities":{"urls":[]}}}\r\n')
+        content = json.loads(token)
+        message = Message(token)
+        self.assertEqual(message['for_user'], 7)
+        for key in ('id', 'text', 'truncated', 'geo', 'score'):
+            self.assertEqual(message['message'][key],
+                             content['message'][key])
+        self.assertFalse(message['message'].is_decoded)
+        self.assertEqual(message['message']['entities'],
+                         content['message']['entities'])
+    
+    def test_nested_fields_are_not_scanned(self):
+        '''Fields of nested objects, like the tweet in a favorite event,
+        should not be mistaken for fields of the message.'''
+        from sitebucket.message import Message
+        message = Message('{"for_user":1,"message":{"event":"favorite",'
+                          '"target_object":{"id":5,"text":"hi!"}}}')
+        self.assertFalse('text' in message['message'])
+        self.assertRaises(KeyError, lambda: message['message']['id'])
+    
+    def test_fields_after_message(self):
+        '''The message should be found by matching braces when the envelope
+        has fields after it.'''
+        from sitebucket.message import Message
+        message = Message('{"for_user":1,"message":{"text":"hi",'
+                          '"user":{"id":3}},"x":2}\r\n')
+        self.assertEqual(message['message']['text'], 'hi')
+        self.assertEqual(message['message']['user'], {'id': 3})
+        self.assertEqual(message['x'], 2)
+    
+    def test_lazy_parser(self):
+        '''A lazy DefaultParser should pass Messages to handle.'''
+        from sitebucket import DefaultParser
+        from sitebucket.message import Message
+        from sitebucket.profiling import Instrumentation
+        handled = []
+        parser = DefaultParser(lazy=True)
+        parser.instrumentation = Instrumentation()
+        parser.handle = handled.append
+        parser.parse('{"for_user":1,"message":{"text":"hi!"}}')
+        self.assertTrue(isinstance(handled[0], Message))
+        self.assertEqual(parser.instrumentation.stages['decode'].count, 1)
+
+class CachingParserTests(unittest.TestCase):
+    def test_lazy(self):
+        '''A CachingParser wrapping a lazy DefaultParser should share one
+        LazyObject between envelopes and leave it undecoded.'''
+        from sitebucket import DefaultParser
+        from sitebucket.cache import CachingParser
+        from sitebucket.message import LazyObject
+        handled = []
+        parser = DefaultParser(lazy=True)
+        parser.handle = handled.append
+        caching = CachingParser(parser)
+        tweet = '{"id":5,"text":"hi!","user":{"id":3}}'
+        for user in (1, 2):
+            caching.parse('{"for_user":%s,"message":%s}\r\n' % (user, tweet))
+        message = handled[0]['message']
+        self.assertTrue(isinstance(message, LazyObject))
+        self.assertTrue(handled[1]['message'] is message)
+        self.assertEqual(message['text'], 'hi!')
+        self.assertFalse(message.is_decoded)
+    
+    def test_trailing_fields(self):
+        '''Envelopes with fields after the message should be parsed
+        whole.'''
+        from sitebucket import DefaultParser
+        from sitebucket.cache import CachingParser
+        handled = []
+        parser = DefaultParser()
+        parser.handle = handled.append
+        CachingParser(parser).parse('{"for_user":1,"message":{"id":5,'
+                                    '"text":"}"},"x":2}\r\n')
+        self.assertEqual(handled[0]['x'], 2)
+        self.assertEqual(handled[0]['message']['text'], '}')
+    
+    def test_monitor_with_dispatcher(self):
+        '''A monitor's decode_cache should be placed inside a
+        LaneDispatcher parser.'''
+        from sitebucket import ListenThreadMonitor, DefaultParser
+        from sitebucket.cache import CachingParser, DecodeCache
+        from sitebucket.dispatch import LaneDispatcher
+        dispatcher = LaneDispatcher(DefaultParser())
+        monitor = ListenThreadMonitor([1, 2], consumer, token,
+                                      parser=dispatcher,
+                                      decode_cache=DecodeCache())
+        self.assertTrue(monitor.parser is dispatcher)
+        self.assertTrue(isinstance(dispatcher.parser, CachingParser))
+
+class StandbyTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.thread import ListenThread
+        self.connections = []
+        httplib.HTTPSConnection = self.connection
+        
+        self.monitor = ListenThreadMonitor(follow, consumer, token, standby=1)
+        self.standby = ListenThread(SiteStream([], consumer, token))
+        self.standby.stream.running = True
+        self.standby.stream.control_uri = '/1.1/site/c/1'
+        self.monitor.standby_threads.append(self.standby)
+        
+        self.failed = self.monitor.threads[0]
+        self.failed.stream.initialized = True
+        self.failed.stream.error_count = self.failed.stream.retry_limit
+    
+    def tearDown(self):
+        httplib.HTTPSConnection = REAL_HTTPSConnection
+    
+    def connection(self, *args, **kwargs):
+        connection = MockControlConnection()
+        self.connections.append(connection)
+        return connection
+    
+    def test_failover(self):
+        '''A failed stream's users should be moved onto a ready standby
+        stream through its control URI.'''
+        self.monitor.restart_unhealthy_streams()
+        self.assertEqual(self.monitor.threads, [self.standby])
+        self.assertEqual(self.monitor.standby_threads, [])
+        self.assertEqual(list(self.standby.stream.follow), follow)
+        self.assertTrue(self.failed.stream.disconnect_issued)
+        
+        method, path, body = self.connections[0].requests[0]
+        self.assertEqual((method, path), ('POST', '/1.1/site/c/1/add_user.json'))
+        self.assertTrue('user_id=1%2C2%2C3%2C4' in body)
+    
+    def test_follow_limit(self):
+        '''Adding users beyond FOLLOW_LIMIT should be refused.'''
+        from sitebucket.error import SitebucketError
+        from sitebucket.listener import FOLLOW_LIMIT
+        self.assertRaises(SitebucketError, self.standby.stream.add_users,
+                          range(FOLLOW_LIMIT + 1))
+        self.assertEqual(self.connections, [])
+
+class LayoutTests(unittest.TestCase):
+    def setUp(self):
+        import os, tempfile
+        from sitebucket.layout import LayoutCheckpoint
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'layout.json')
+        self.layout = LayoutCheckpoint(self.path)
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+    
+    def test_restore(self):
+        '''A restarted monitor should rebuild the saved streams, with the
+        same users, stream ids and backoff state, without regrouping.'''
+        from sitebucket import ListenThreadMonitor
+        monitor = ListenThreadMonitor(range(1, 251), consumer, token,
+                                      layout=self.layout)
+        monitor.threads[1].stream.error_count = 3
+        monitor.threads[1].stream.retry_time = 40
+        monitor.save_layout(force=True)
+        
+        restored = ListenThreadMonitor(range(1, 261), consumer, token,
+                                       layout=self.layout)
+        saved = [x.stream for x in monitor.threads]
+        streams = [x.stream for x in restored.threads]
+        self.assertEqual([x.stream_id for x in streams[:3]],
+                         [x.stream_id for x in saved])
+        self.assertEqual([list(x.follow) for x in streams[:3]],
+                         [list(x.follow) for x in saved])
+        self.assertEqual((streams[1].error_count, streams[1].retry_time),
+                         (3, 40))
+        self.assertEqual(list(streams[3].follow), range(251, 261))
+        self.assertTrue(streams[3].stream_id > saved[-1].stream_id)
+    
+    def test_unfollowed_users_dropped(self):
+        '''Users no longer being followed should not be restored.'''
+        from sitebucket import ListenThreadMonitor
+        ListenThreadMonitor(range(1, 151), consumer, token,
+                            layout=self.layout).save_layout()
+        restored = ListenThreadMonitor(range(1, 51), consumer, token,
+                                       layout=self.layout)
+        self.assertEqual([list(x.stream.follow) for x in restored.threads],
+                         [range(1, 51)])
+    
+    def test_corrupt_checkpoint(self):
+        '''An unreadable checkpoint should fall back to grouping the follow
+        list.'''
+        from sitebucket import ListenThreadMonitor
+        with open(self.path, 'w') as f:
+            f.write('{"version": 1, "streams": [')
+        monitor = ListenThreadMonitor(range(1, 151), consumer, token,
+                                      layout=self.layout)
+        self.assertEqual(len(monitor.threads), 2)
+    
+    def test_atomic_save(self):
+        '''Saving should leave only the checkpoint in its directory.'''
+        import os
+        self.layout.save('user', [])
+        self.layout.save('user', [{'stream_id': 1, 'follow': [1]}])
+        self.assertEqual(os.listdir(self.directory), ['layout.json'])
+        self.assertEqual(self.layout.load('user')[0]['follow'], [1])
+
+class SimulationTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.simulation import SimulatedMonitor
+        self.monitor = SimulatedMonitor(range(1, 1001), seed=1)
+        self.monitor.start_streams()
+        self.monitor.tick()
+    
+    def test_virtual_clock(self):
+        '''Sleeping and waiting on a VirtualClock should advance it without
+        blocking, unless the event is already set.'''
+        import threading, time
+        from sitebucket.clock import VirtualClock
+        clock = VirtualClock(10)
+        start = time.time()
+        clock.sleep(3600)
+        event = threading.Event()
+        self.assertFalse(clock.wait(event, 60))
+        event.set()
+        self.assertTrue(clock.wait(event, 60))
+        self.assertEqual(clock.time(), 3670)
+        self.assertTrue(time.time() - start < 1)
+    
+    def test_restart(self):
+        '''Failed streams should be restarted and reconnected, and the
+        time they were down recorded.'''
+        monitor = self.monitor
+        self.assertEqual(len(monitor.healthy_streams), 10)
+        monitor.run_ticks(6, {0: 2, 3: 1})
+        self.assertEqual(len(monitor.healthy_streams), 10)
+        self.assertEqual(monitor.restart_latency.count, 3)
+        self.assertEqual(monitor.ticks, 7)
+        self.assertEqual(sorted(monitor.follow),
+                         sorted(x for t in monitor.threads
+                                for x in t.stream.follow))
+    
+    def test_slow_connect(self):
+        '''Streams that take longer than a monitor interval to connect
+        should be left to connect instead of being restarted.'''
+        from sitebucket.monitor import MONITOR_SLEEP_INTERVAL
+        from sitebucket.simulation import SimulatedMonitor
+        monitor = SimulatedMonitor(range(1, 1001),
+                                   connect_delay=MONITOR_SLEEP_INTERVAL + 5)
+        monitor.start_streams()
+        first = list(monitor.threads)
+        monitor.run_ticks(2)
+        self.assertEqual(monitor.threads, first)
+        self.assertEqual(sum(x.stream.running for x in monitor.threads), 10)
+        
+        monitor.fail(3)
+        monitor.run_ticks(3)
+        self.assertEqual(monitor.restart_latency.count, 3)
+        self.assertEqual(monitor.restart_latency.max,
+                         2 * MONITOR_SLEEP_INTERVAL + 10)
+        self.assertEqual(sum(x.stream.running for x in monitor.threads), 10)
+    
+    def test_consolidate(self):
+        '''Consolidation should sleep in virtual time and keep every
+        user.'''
+        import time
+        from sitebucket import monitor as monitor_module
+        interval = monitor_module.CONSOLIDATE_SLEEP_INTERVAL
+        monitor_module.CONSOLIDATE_SLEEP_INTERVAL = 3600
+        try:
+            monitor = self.monitor
+            for user in range(2001, 2004):
+                monitor.add_follows([user])
+            start, now = time.time(), monitor.clock.time()
+            monitor.consolidate_streams()
+            self.assertTrue(time.time() - start < 1)
+            self.assertTrue(monitor.clock.time() >= now + 3600)
+        finally:
+            monitor_module.CONSOLIDATE_SLEEP_INTERVAL = interval
+        monitor.run_ticks(3)
+        self.assertEqual(len(monitor.threads), 11)
+        self.assertEqual(len(monitor.healthy_streams), 11)
+        self.assertEqual(sorted(x for t in monitor.threads
+                                for x in t.stream.follow),
+                         range(1, 1001) + range(2001, 2004))
+    
+    def test_remove_follows(self):
+        '''Removing every user of some streams should close only those
+        streams.'''
+        monitor = self.monitor
+        monitor.remove_follows(range(1, 201))
+        self.assertEqual(len(monitor.threads), 8)
+        self.assertEqual(min(monitor.follow), 201)
+    
+    def test_splice(self):
+        '''Small updates to a large FollowSet should match a full
+        merge.'''
+        import random
+        from sitebucket.follow import FollowSet
+        rand = random.Random(0)
+        large = set(rand.sample(xrange(100000), 10000))
+        small = set(rand.sample(xrange(100000), 100)) | set([0, 99999])
+        self.assertEqual(list(FollowSet(large) | FollowSet(small)),
+                         sorted(large | small))
+        self.assertEqual(list(FollowSet(small) | FollowSet(large)),
+                         sorted(large | small))
+        self.assertEqual(list(FollowSet(large) - FollowSet(small)),
+                         sorted(large - small))
+
+class BlockingListenThread(ListenThread):
+    '''A ListenThread whose run waits for its stream to be disconnected,
+    like a stream connecting or sleeping between attempts.'''
+    def run(self):
+        import time
+        while not self.stream.disconnect_issued:
+            time.sleep(.005)
+
+class IdleListenThread(ListenThread):
+    '''A ListenThread that is started but never connects.'''
+    def start(self):
+        self.started = True
+
+class RebalanceTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.clock import VirtualClock
+        self.clock = VirtualClock()
+        self.monitor = ListenThreadMonitor(range(1, 11), consumer, token,
+                                           stream_budget=1000,
+                                           clock=self.clock)
+        self.monitor.thread_class = IdleListenThread
+        self.monitor.traffic.record(1, 200000)
+        self.monitor.traffic.record(2, 200000)
+        self.monitor.running = True
+        self.old = self.monitor.threads[0]
+    
+    def test_connected(self):
+        '''Replacements should be started without waiting for them, and
+        swapped in on the first pass after they connect.'''
+        self.monitor.rebalance_streams()
+        self.assertEqual(self.monitor.threads, [self.old])
+        new = self.monitor.rebalancing[0][1]
+        self.assertTrue(all(x.started for x in new))
+        for x in new:
+            x.stream.running = True
+        self.monitor.rebalance_streams()
+        self.assertEqual(self.monitor.rebalancing, [])
+        self.assertEqual(sorted(len(x.stream.follow)
+                                for x in self.monitor.threads), [1, 1, 8])
+        self.assertTrue(self.old.stream.disconnect_issued)
+    
+    def test_lag_tiers_kept(self):
+        '''Maintenance passes should keep the lag tiers of pending
+        replacements, so per-tier lag is still recorded after a swap.'''
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.lag import LagTracker
+        lag = LagTracker()
+        monitor = ListenThreadMonitor(range(1, 11), consumer, token,
+                                      stream_budget=1000, lag=lag,
+                                      tiers={1: 0, 2: 0, 3: 0},
+                                      clock=self.clock)
+        monitor.thread_class = IdleListenThread
+        monitor.traffic.record(1, 200000)
+        monitor.traffic.record(2, 200000)
+        monitor.running = True
+        monitor.maintain()
+        new = monitor.rebalancing[0][1]
+        self.assertEqual([x.stream.tier for x in new], [0, 0, 0])
+        monitor.maintain()
+        for x in new:
+            x.stream.running = True
+        monitor.maintain()
+        self.assertEqual(monitor.rebalancing, [])
+        self.assertEqual(dict((x.stream.stream_id, x.stream.tier)
+                              for x in monitor.threads), lag.stream_tiers)
+    
+    def test_cooldown(self):
+        '''Replacements that don't connect by the deadline should be closed,
+        and the stream shouldn't be split again until the cooldown ends.'''
+        from sitebucket import monitor
+        self.monitor.rebalance_streams()
+        new = self.monitor.rebalancing[0][1]
+        self.monitor.rebalance_streams()
+        self.assertEqual(len(self.monitor.rebalancing), 1)
+        self.clock.advance(monitor.REBALANCE_CONNECT_TIMEOUT)
+        self.monitor.rebalance_streams()
+        self.assertEqual(self.monitor.rebalancing, [])
+        self.assertEqual(self.monitor.threads, [self.old])
+        self.assertTrue(all(x.stream.disconnect_issued for x in new))
+        self.assertFalse(self.old.stream.disconnect_issued)
+        self.clock.advance(monitor.REBALANCE_COOLDOWN - 1)
+        self.monitor.rebalance_streams()
+        self.assertEqual(self.monitor.rebalancing, [])
+        self.clock.advance(1)
+        self.monitor.rebalance_streams()
+        self.assertEqual(len(self.monitor.rebalancing), 1)
+
+class StreamHealthTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import ListenThreadMonitor
+        self.monitor = ListenThreadMonitor(follow, consumer, token)
+        self.thread = BlockingListenThread(self.monitor.threads[0].stream)
+        self.monitor.threads[0] = self.thread
+        self.thread.stream.initialized = True
+        self.thread.start()
+    
+    def tearDown(self):
+        self.thread.close()
+        self.thread.join()
+    
+    def test_connecting_is_healthy(self):
+        '''A stream that is connecting or backing off in a live thread
+        should be healthy and left alone.'''
+        self.assertTrue(self.thread.connection_healthy)
+        self.monitor.restart_unhealthy_streams()
+        self.assertTrue(self.monitor.threads[0] is self.thread)
+        self.assertFalse(self.thread.stream.disconnect_issued)
+    
+    def test_no_restart_while_alive(self):
+        '''A failed stream whose thread is still running should be closed,
+        and only restarted once the thread has exited.'''
+        from sitebucket.error import SitebucketError
+        self.assertRaises(SitebucketError, self.thread.restart)
+        self.thread.stream.error_count = self.thread.stream.retry_limit
+        self.monitor.restart_unhealthy_streams()
+        self.assertTrue(self.monitor.threads[0] is self.thread)
+        self.assertTrue(self.thread.stream.disconnect_issued)
+        
+        self.thread.join()
+        self.thread.restart = lambda: 'restarted'
+        self.monitor.restart_unhealthy_streams()
+        self.assertEqual(self.monitor.threads[0], 'restarted')
+    
+    def test_dead_thread_is_unhealthy(self):
+        '''A stream whose thread has died should be unhealthy.'''
+        self.thread.close()
+        self.thread.join()
+        self.assertFalse(self.thread.connection_healthy)
+
+class MockControlConnection(object):
+    def __init__(self, status=200):
+        self.requests = []
+        self.status = status
+    
+    def request(self, method, path, body=None, headers=None):
+        self.requests.append((method, path, body))
+    
+    def getresponse(self):
+        response = MockResponseObject()
+        response.status = self.status
+        return response
+    
+    def close(self):
+        pass
+
+class NullParser(BaseParser):
+    def parse(self, token):
+        pass
+
+class ListParser(BaseParser):
+    def __init__(self):
+        self.parsed = []
+    
+    def parse(self, token):
+        self.parsed.append(token)
+
+class InstrumentationTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket.profiling import Instrumentation
+        self.instrumentation = Instrumentation(slow_threshold=.01)
+    
+    def test_stage_timings(self):
+        '''An instrumented stream should record read and parse timings for
+        every message, and a DefaultParser should record decode timings.'''
+        from sitebucket import DefaultParser
+        parser = DefaultParser()
+        parser.instrumentation = self.instrumentation
+        stream = SiteStream(follow, consumer, token, parser=parser,
+                            instrumentation=self.instrumentation)
+        stream.on_receive('{"some":"json"}\r\n')
+        stream.on_receive('{"some":"json"}\r\n')
+        stats = self.instrumentation.stats
+        self.assertEqual(stats['read']['count'], 2)
+        self.assertEqual(stats['parse']['count'], 2)
+        self.assertEqual(stats['decode']['count'], 2)
+        self.assertEqual(stats['slow_messages'], 0)
+    
+    def test_default_parser_not_shared(self):
+        '''An instrumented monitor with the default parser should not
+        instrument the parser of other monitors.'''
+        from sitebucket import ListenThreadMonitor
+        monitor = ListenThreadMonitor(follow, consumer, token,
+                                      instrumentation=self.instrumentation)
+        other = ListenThreadMonitor(follow, consumer, token)
+        self.assertTrue(monitor.parser is not other.parser)
+        self.assertEqual(other.parser.instrumentation, None)
+    
+    def test_stream_usage(self):
+        '''Every stream's CPU and wall time should be totalled, and top
+        should rank the stream with the busiest parser first.'''
+        from sitebucket import profiling
+        self.instrumentation.cpu_interval = 0
+        class BusyParser(BaseParser):
+            def parse(self, token):
+                sum(xrange(200000))
+        quiet = SiteStream(follow, consumer, token, parser=NullParser(),
+                           instrumentation=self.instrumentation)
+        busy = SiteStream(follow, consumer, token, parser=BusyParser(),
+                          instrumentation=self.instrumentation)
+        # Each stream has its own thread, as it would in a ListenThread.
+        import threading
+        for stream in (quiet, busy):
+            thread = threading.Thread(target=lambda: [
+                stream.on_receive('{"some":"json"}\r\n') for x in range(3)])
+            thread.start()
+            thread.join()
+        top = self.instrumentation.top(2)
+        self.assertEqual([x[0] for x in top],
+                         [busy.stream_id, quiet.stream_id])
+        self.assertEqual(top[0][1]['messages'], 3)
+        self.assertEqual(top[0][1]['bytes'], 51)
+        if profiling.thread_time is not None:
+            self.assertTrue(top[0][1]['cpu'] > top[1][1]['cpu'])
+    
+    def test_thread_time(self):
+        '''thread_time should only count the calling thread's CPU
+        time.'''
+        import threading
+        from sitebucket.profiling import thread_time
+        if thread_time is None:
+            self.skipTest('No thread CPU clock on this platform.')
+        start = thread_time()
+        busy = threading.Thread(target=lambda: sum(xrange(2000000)))
+        busy.start()
+        busy.join()
+        self.assertTrue(thread_time() - start < .05)
+        start = thread_time()
+        sum(xrange(2000000))
+        self.assertTrue(thread_time() - start > .005)
+    
+    def test_slow_messages(self):
+        '''Messages that take longer than slow_threshold to parse should be
+        counted as slow.'''
+        stream = SiteStream(follow, consumer, token, parser=SlowParser(),
+                            instrumentation=self.instrumentation)
+        stream.on_receive('{"some":"json"}\r\n')
+        self.assertEqual(self.instrumentation.slow_messages, 1)
+    
+    def test_monitor_profile(self):
+        '''ListenThreadMonitor.profile should sample running threads.'''
+        from sitebucket import ListenThreadMonitor
+        monitor = ListenThreadMonitor(follow, consumer, token)
+        thread = monitor.threads[0]
+        thread.stream.listen = lambda: __import__('time').sleep(.2)
+        thread.start()
+        profiler = monitor.profile(.05, interval=.01)
+        thread.join()
+        self.assertTrue(profiler.samples > 0)
+        self.assertTrue(profiler.top(1))
+
+class SlowParser(BaseParser):
+    def parse(self, token):
+        import time
+        time.sleep(.02)
+
+class StartupSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        from sitebucket import startup
+        self.poll_interval = startup.STARTUP_POLL_INTERVAL
+        startup.STARTUP_POLL_INTERVAL = 0
+        self.scheduler = startup.StartupScheduler(concurrency=2, rate=0,
+                                                  tiers={5: 0})
+        self.threads = [MockListenThread(self.scheduler, [x]) 
+                        for x in range(1, 7)]
+    
+    def tearDown(self):
+        from sitebucket import startup
+        startup.STARTUP_POLL_INTERVAL = self.poll_interval
+    
+    def test_concurrency_limit(self):
+        '''StartupScheduler.start should never start a thread while
+        concurrency streams are still connecting.'''
+        self.scheduler.start(self.threads)
+        self.assertTrue(all(x.started for x in self.threads))
+        self.assertTrue(max(x.connecting_at_start for x in self.threads) < 2)
+    
+    def test_priority_order(self):
+        '''Threads following users in a higher priority tier should be
+        started first.'''
+        self.scheduler.start(self.threads)
+        self.assertEqual(self.threads[4].start_order, 0)
+    
+    def test_time_to_all_connected(self):
+        '''time_to_all_connected should be recorded once every stream has
+        connected.'''
+        self.scheduler.start(self.threads)
+        while not self.scheduler.complete:
+            self.scheduler.update()
+        self.assertNotEqual(self.scheduler.time_to_all_connected, None)
+        self.assertEqual(self.scheduler.progress['connected'], 6)
+    
+    def test_stop(self):
+        '''Ramp-up should be aborted when stop returns True.'''
+        self.scheduler.start(self.threads, stop=lambda: True)
+        self.assertFalse(any(x.started for x in self.threads))
+    
+    def test_step(self):
+        '''step should start only what the limits allow, without
+        waiting.'''
+        self.scheduler.schedule(self.threads)
+        self.assertEqual(self.scheduler.step(), 2)
+        self.assertEqual(self.scheduler.step(), 0)
+        self.assertEqual(len(self.scheduler.pending), 4)
+        self.assertEqual(self.scheduler.delay(), 0)
+    
+    def test_complete_with_failed_stream(self):
+        '''Ramp-up should complete even if a stream gives up.'''
+        failed = self.threads[0].stream
+        failed.retry_ok = False
+        failed.polls = -10 ** 6
+        self.scheduler.start(self.threads)
+        while not self.scheduler.complete:
+            self.scheduler.update()
+        self.assertEqual(self.scheduler.progress['connected'], 5)
+    
+    def test_virtual_clock(self):
+        '''Ramp-up should be paced by the scheduler's clock, which a
+        monitor shares with its scheduler.'''
+        from sitebucket import ListenThreadMonitor
+        from sitebucket.clock import VirtualClock
+        clock = VirtualClock()
+        scheduler = self.scheduler
+        scheduler.rate, scheduler.concurrency = 1, 10
+        ListenThreadMonitor([], consumer, token, startup=scheduler,
+                            clock=clock)
+        self.assertTrue(scheduler.clock is clock)
+        scheduler.schedule(self.threads)
+        self.assertEqual(scheduler.step(), 1)
+        self.assertEqual(scheduler.step(), 0)
+        self.assertEqual(scheduler.delay(), 1)
+        clock.advance(1)
+        self.assertEqual(scheduler.step(), 1)
+        # start sleeps on the clock between starts instead of blocking.
+        threads = [MockListenThread(scheduler, [x]) for x in range(7, 10)]
+        scheduler.start(threads)
+        self.assertTrue(all(x.started for x in threads))
+        self.assertEqual(clock.time(), 4)
+    
+    def test_concurrency_validated(self):
+        '''A concurrency below 1 should be rejected.'''
+        from sitebucket.startup import StartupScheduler
+        from sitebucket.error import SitebucketError
+        self.assertRaises(SitebucketError, StartupScheduler, concurrency=0)
+
+class LaneDispatcherTests(unittest.TestCase):
+    def test_per_user_order(self):
+        '''Each user's messages should be parsed in the order they were
+        received, even though lanes run in parallel.'''
+        from sitebucket.dispatch import LaneDispatcher
+        parser = OrderRecordingParser()
+        dispatcher = LaneDispatcher(parser, lanes=4)
+        for seq in range(50):
+            for user in range(1, 9):
+                dispatcher.parse('{"for_user":%s,"message":{"seq":%s}}'
+                                 % (user, seq))
+        self.assertEqual(dispatcher.close(), 0)
+        self.assertEqual(sorted(parser.seen.keys()), range(1, 9))
+        for user, seqs in parser.seen.items():
+            self.assertEqual(seqs, range(50))
+    
+    def test_parser_errors_do_not_stop_lanes(self):
+        '''An exception raised by the parser should be logged and the lane
+        should keep running.'''
+        from sitebucket.dispatch import LaneDispatcher
+        parser = OrderRecordingParser()
+        dispatcher = LaneDispatcher(parser, lanes=1)
+        dispatcher.parse('not json')
+        dispatcher.parse('{"for_user":1,"message":{"seq":0}}')
+        dispatcher.close()
+        self.assertEqual(parser.seen, {1: [0]})
+        self.assertEqual(dispatcher.processed, [2])
+    
+    def test_close_full_lane(self):
+        '''Closing should give up on a full lane at the deadline and count
+        its messages as dropped.'''
+        import time
+        from sitebucket.dispatch import LaneDispatcher
+        parser = BlockedParser()
+        dispatcher = LaneDispatcher(parser, lanes=1, queue_size=1)
+        dispatcher.parse('{"for_user":1}')
+        while dispatcher.lane_depths[0]:
+            time.sleep(.005)
+        dispatcher.parse('{"for_user":1}')
+        start = time.time()
+        self.assertEqual(dispatcher.close(timeout=.2), 1)
+        self.assertTrue(time.time() - start < 2)
+        parser.release.set()
+
+class PipelineTests(unittest.TestCase):
+    def test_stages(self):
+        '''Messages should be filtered, decoded, transformed and sunk, and
+        every stage should count what it did.'''
+        from sitebucket.pipeline import Pipeline, FilterStage, DecodeStage, \
+            TransformStage, SinkStage, THREADS
+        sink = ListParser()
+        pipeline = Pipeline([
+            FilterStage(lambda token: '"for_user"' in token),
+            DecodeStage(),
+            TransformStage(lambda message: message['for_user'],
+                           concurrency=THREADS, workers=4),
+            SinkStage(sink, concurrency=THREADS)])
+        for user in range(100):
+            pipeline.parse('{"for_user":%s,"message":{"text":"hi!"}}' % user)
+            pipeline.parse('{"control":{}}')
+        self.assertEqual(pipeline.close(), 0)
+        self.assertEqual(sorted(sink.parsed), range(100))
+        filter, decode, transform, sink_stage = pipeline.stats['stages']
+        self.assertEqual((filter['received'], filter['emitted']), (200, 100))
+        self.assertEqual(transform['processed'], 100)
+        self.assertEqual(sink_stage['processed'], 100)
+        self.assertEqual(transform['workers'], 4)
+    
+    def test_processes(self):
+        '''Process stages should run their function in worker processes.'''
+        import os
+        from sitebucket.pipeline import Pipeline, TransformStage, SinkStage, \
+            PROCESSES
+        results = []
+        pipeline = Pipeline([
+            TransformStage(lambda token: (len(token), os.getpid()),
+                           concurrency=PROCESSES, workers=2),
+            SinkStage(results.append)])
+        pipeline.start()
+        for x in range(200):
+            pipeline.parse('x' * x)
+        self.assertEqual(pipeline.close(5), 0)
+        self.assertEqual(sorted(x[0] for x in results), range(200))
+        self.assertFalse(os.getpid() in set(x[1] for x in results))
+    
+    def test_errors(self):
+        '''Exceptions should be counted and the stage should keep
+        running.'''
+        from sitebucket.pipeline import Pipeline, TransformStage, SinkStage, \
+            THREADS, PROCESSES
+        for concurrency in (THREADS, PROCESSES):
+            results = []
+            pipeline = Pipeline([
+                TransformStage(lambda token: 10 / int(token),
+                               concurrency=concurrency),
+                SinkStage(results.append)])
+            for token in ('1', '0', '5'):
+                pipeline.parse(token)
+            pipeline.close(5)
+            self.assertEqual(sorted(results), [2, 10])
+            self.assertEqual(pipeline.stages[0].errors, 1)
+    
+    def test_bottleneck(self):
+        '''A slow stage should fill its queue, block the stages feeding it
+        and be reported as the bottleneck.'''
+        import time
+        from sitebucket.pipeline import Pipeline, DecodeStage, SinkStage, \
+            THREADS
+        pipeline = Pipeline([
+            DecodeStage(),
+            SinkStage(lambda message: time.sleep(.01), concurrency=THREADS,
+                      queue_size=2, name='slow')])
+        for x in range(10):
+            pipeline.parse('{"for_user":1}')
+        stats = pipeline.stats
+        self.assertEqual(stats['bottleneck'], 'slow')
+        self.assertTrue(stats['stages'][1]['blocked'] > 0)
+        self.assertTrue(stats['stages'][1]['depth'] <= 2)
+        self.assertEqual(pipeline.close(), 0)
+    
+    def test_close(self):
+        '''Closing should close parser sinks, and stages can't be shared
+        between pipelines.'''
+        from sitebucket.sinks import BatchSink
+        from sitebucket.error import SitebucketError
+        from sitebucket.pipeline import Pipeline, SinkStage, THREADS
+        class Sink(BatchSink):
+            def write(self, batch):
+                self.batches = getattr(self, 'batches', []) + [batch]
+        sink = Sink(batch_size=100)
+        stage = SinkStage(sink, concurrency=THREADS)
+        pipeline = Pipeline([stage])
+        pipeline.parse('{"for_user":1}\r\n')
+        self.assertEqual(pipeline.close(), 0)
+        self.assertEqual(sink.batches, [['{"for_user":1}']])
+        self.assertRaises(SitebucketError, Pipeline, [stage])
+
+class BlockedParser(BaseParser):
+    def __init__(self):
+        import threading
+        self.release = threading.Event()
+    
+    def parse(self, token):
+        self.release.wait(30)
+
+class OrderRecordingParser(BaseParser):
+    def __init__(self):
+        self.seen = {}
+    
+    def parse(self, token):
+        import random, time
+        import simplejson as json
+        content = json.loads(token)
+        time.sleep(random.random() / 10000)
+        self.seen.setdefault(content['for_user'], []).append(
+            content['message']['seq'])
+
+class MockConnectingStream(object):
+    '''A stream that reports itself as connected after being polled a few
+    times.'''
+    def __init__(self, follow):
+        self.follow = follow
+        self.retry_ok = True
+        self.disconnect_issued = False
+        self.started = False
+        self.polls = 0
+    
+    @property
+    def running(self):
+        if self.started:
+            self.polls += 1
+        return self.polls > 3
+
+class MockListenThread(object):
+    def __init__(self, scheduler, follow):
+        self.scheduler = scheduler
+        self.stream = MockConnectingStream(follow)
+        self.started = False
+    
+    def is_alive(self):
+        return self.started
+    
+    def start(self):
+        self.connecting_at_start = len(self.scheduler.connecting)
+        self.start_order = len(self.scheduler.started)
+        self.started = self.stream.started = True
+
 def Mock_HTTPConnection(conn_exception=None, status=200, *args, **kwargs):
     
     def fun(*args, **kwargs):
@@ -219,6 +2060,11 @@ class MockResponseObject(object):
 
 if __name__ == '__main__':
     from sitebucket import listener, parser, thread, monitor, error, util
+    from sitebucket import partition, startup, dispatch, cache, traffic
+    from sitebucket import stats, sinks, profiling, lag, shaping, ring
+    from sitebucket import coroutine, message, layout, compression, keywords, \
+        subscriptions, columnar, clock, simulation, pipeline
+    from sitebucket import follow as follow_module
     from sitebucket.parser import BaseParser
     
     monitor.CONSOLIDATE_SLEEP_INTERVAL = 0
@@ -240,6 +2086,30 @@ if __name__ == '__main__':
     doctest.testmod(monitor, extraglobs=extraglobs)
     doctest.testmod(error)
     doctest.testmod(util)
+    doctest.testmod(partition, extraglobs=extraglobs)
+    doctest.testmod(follow_module)
+    doctest.testmod(startup, extraglobs=extraglobs)
+    doctest.testmod(dispatch)
+    doctest.testmod(cache)
+    doctest.testmod(traffic)
+    doctest.testmod(stats)
+    doctest.testmod(sinks)
+    doctest.testmod(profiling)
+    doctest.testmod(lag)
+    doctest.testmod(shaping)
+    doctest.testmod(ring)
+    doctest.testmod(message)
+    doctest.testmod(layout)
+    doctest.testmod(compression)
+    doctest.testmod(keywords)
+    doctest.testmod(subscriptions)
+    doctest.testmod(clock)
+    doctest.testmod(simulation)
+    doctest.testmod(pipeline)
+    if columnar.numpy is not None:
+        doctest.testmod(columnar)
+    if coroutine.asyncio is not None:
+        doctest.testmod(coroutine)
     doctest.testfile('README.markdown')
     print "Done!"
     